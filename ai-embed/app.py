@@ -3,28 +3,61 @@ ai-embed: Lightweight embedding + FAISS search service.
 
 Architecture:
   - Embeddings: HuggingFace Inference API (no local model, ~0 MB RAM)
-  - Vector storage: FAISS IndexFlatIP in-memory (~1 MB for 100 zones)
+  - Vector storage: FAISS in-memory; IndexFlatIP by default, HNSW / IVF /
+    IVF-PQ via INDEX_TYPE once the corpus passes EXACT_SEARCH_THRESHOLD;
+    fp16 / SQ8 / PQ vector codes via VECTOR_STORAGE
   - Total RAM: ~80 MB (vs 500 MB with local PyTorch model)
 
 Endpoints:
   GET  /healthz         Health + vector count
   POST /embed           Embed text(s) via HF API
+  POST /embed/stream    NDJSON {id, text} in, NDJSON {id, embedding} out as
+                        each length-sorted batch is embedded (no size cap)
   POST /upsert          Rebuild FAISS index from items (full replace)
+  GET  /sync/manifest   {id: content hash}, model and generation of the index
+  POST /sync/apply      Only added / changed / deleted items vs a base
+                        generation (409 when the index moved on)
+  POST /delete          Tombstone ids (excluded from searches at once,
+                        compacted away in the background)
   POST /search          Basic semantic search
   POST /hybrid-search   Weighted free_text + vibes search
+  Search bodies accept near {lat, lng, radius_m} / bbox filters (zone
+  center + radiusM / poly from the payload, on a lat/lng grid) and an
+  optional distance_decay_m score term.
+  POST /search/batch, /hybrid-search/batch
+                        Many queries per request: one HF call, one FAISS
+                        search per distinct filter
+  GET  /metrics         Prometheus text: per-stage latency histograms
+                        (HF call, filter, ANN, rerank, rebuild...) + counters
+
+Shared code: this image is built from ai-embed/ alone, so the modules it
+shares with ai/ (metrics.py, geo_index.py, embedding_format.py, bulk_embed.py,
+index_factory.py) are copies of ai/'s, kept identical by ai/tests/test_vendored.py.
 """
 
+import asyncio
+import atexit
+import hashlib
+import json
 import os
-import math
-from typing import Any, Dict, List, Optional, Union
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import faiss
 import httpx
 import logging
 import numpy as np
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, Field
+
+from bulk_embed import NDJSONStream, stream_embeddings
+from embedding_format import negotiate, render
+from geo_index import GeoIndex
+from index_factory import IndexSpec, build_index, index_kind, index_storage, search_params, vector_bytes
+from metrics import Registry, SIZE_BUCKETS
 
 # =================== Config ===================
 
@@ -36,11 +69,83 @@ MODEL_NAME = os.getenv(
 )
 PORT = int(os.getenv("PORT", 8088))
 
+# Index family (INDEX_TYPE: FLAT | HNSW | IVF | IVFPQ, FLAT below
+# EXACT_SEARCH_THRESHOLD vectors or with too little data to train IVF), its
+# knobs and the vector codes (VECTOR_STORAGE: fp32 | fp16 | sq8 | pq), read
+# by index_factory.py like in ai/. Unless EXACT_RERANK=0 a float32 copy is
+# kept on disk (memory-mapped) and the top k * RERANK_FACTOR compressed hits
+# are re-scored against it.
+INDEX_SPEC = IndexSpec.from_env()
+EXACT_RERANK = INDEX_SPEC.storage != "fp32" and os.getenv("EXACT_RERANK", "1") == "1"
+# The file is process-private (workers / containers sharing /tmp must not map
+# each other's copy): the default carries the pid and is removed on exit.
+EXACT_VECTORS_PATH = os.getenv("EXACT_VECTORS_PATH") or os.path.join(
+    tempfile.gettempdir(), f"ai-embed-vectors-{os.getpid()}.npy")
+if EXACT_RERANK and not os.getenv("EXACT_VECTORS_PATH"):
+    atexit.register(lambda: os.path.exists(EXACT_VECTORS_PATH) and os.remove(EXACT_VECTORS_PATH))
+
+# /embed/stream: records read (then length-sorted) per window, texts per HF call,
+# max bytes per NDJSON line. Memory stays at one window whatever the upload size.
+EMBED_STREAM_WINDOW = int(os.getenv("EMBED_STREAM_WINDOW", "512"))
+EMBED_STREAM_BATCH = int(os.getenv("EMBED_STREAM_BATCH", "64"))
+EMBED_STREAM_MAX_LINE = int(os.getenv("EMBED_STREAM_MAX_LINE", str(1 << 20)))
+
+# Max queries per /search/batch or /hybrid-search/batch request
+SEARCH_BATCH_MAX = int(os.getenv("SEARCH_BATCH_MAX", "64"))
+
+# Geo grid cell size (degrees) for near/bbox filters; with distance_decay_m,
+# top_k * GEO_DECAY_FETCH hits are fetched before re-ranking by distance
+GEO_CELL_DEG = float(os.getenv("GEO_CELL_DEG", "0.05"))
+GEO_DECAY_FETCH = int(os.getenv("GEO_DECAY_FETCH", "4"))
+
+# /delete only tombstones rows; past this share of the index a background
+# task rebuilds it without them
+TOMBSTONE_COMPACT_RATIO = float(os.getenv("TOMBSTONE_COMPACT_RATIO", "0.2"))
+
+# =================== Metrics ===================
+# Rendered in Prometheus text format on GET /metrics (metrics.py, the same
+# module as ai/metrics.py). Recording is a bisect and a few additions under
+# a lock, cheap enough to leave on.
+
+metrics = Registry("ai_embed")
+REQUEST_SECONDS = metrics.histogram("request_seconds", "HTTP request latency by route", ("path",))
+STAGE_SECONDS = metrics.histogram(
+    "stage_seconds",
+    "Latency per stage (hf_call, encode, filter, ann incl. exact re-score, rerank by distance, format, serialize, "
+    "index_build, partitions, persist)",
+    ("stage",),
+)
+HF_REQUESTS = metrics.counter("hf_requests_total", "HF inference attempts by outcome", ("status",))
+BATCH_SIZE = metrics.histogram("batch_size", "Items per HF call / batch endpoint / upsert", ("kind",), SIZE_BUCKETS)
+CANDIDATES = metrics.histogram("search_candidates", "Rows left after filters, per query", buckets=SIZE_BUCKETS)
+FILTERED_OUT = metrics.counter("search_filtered_out_total", "Rows excluded by filters, summed over queries")
+INDEX_REBUILDS = metrics.counter("index_rebuilds_total", "FAISS index rebuilds (one per /upsert)")
+COMPACTIONS = metrics.counter("index_compactions_total", "Background rebuilds dropping tombstoned rows")
+
+
+class _TimedJSONResponse(JSONResponse):
+    """Records JSON rendering time as the "serialize" stage"""
+
+    def render(self, content: Any) -> bytes:
+        with STAGE_SECONDS.time(stage="serialize"):
+            return super().render(content)
+
+
 # =================== App ===================
 
-app = FastAPI(title="ai-embed", description="HF-backed embedding + FAISS search")
+app = FastAPI(title="ai-embed", description="HF-backed embedding + FAISS search",
+              default_response_class=_TimedJSONResponse)
 logger = logging.getLogger("uvicorn.error")
 
+
+@app.middleware("http")
+async def _time_requests(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    REQUEST_SECONDS.observe_since(start, path=route.path if route is not None else "unmatched")
+    return response
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
@@ -56,8 +161,29 @@ app.add_middleware(
 # =================== FAISS state (in-memory, rebuilt on /upsert) ===================
 
 _index: Optional[faiss.Index] = None
-_meta: List[Dict[str, Any]] = []  # [{id, type, payload}]
+_meta: List[Dict[str, Any]] = []  # [{id, type, payload, hash}]
+_rows_by_id: Dict[str, int] = {}  # id -> row in _meta / the index
 _dim: Optional[int] = None
+_exact: Optional[np.ndarray] = None  # memory-mapped float32 rows (EXACT_RERANK)
+# Bumped on every write; /sync/apply only applies deltas computed against it
+_generation = 0
+_write_lock = asyncio.Lock()
+
+# Tombstoned (deleted, not yet compacted) rows; _live is their complement,
+# None while there are none, and is ANDed into every filter mask
+_dead: np.ndarray = np.zeros(0, dtype=bool)
+_live: Optional[np.ndarray] = None
+_tombstones = 0
+_compaction: Optional[asyncio.Task] = None
+
+# Row masks per type / province / vibe, used to build FAISS bitmap selectors
+# so filters are applied inside the search instead of after it
+_type_masks: Dict[str, np.ndarray] = {}
+_province_masks: Dict[str, np.ndarray] = {}
+_vibe_masks: Dict[str, np.ndarray] = {}
+
+# Located rows on a lat/lng grid (geo_index.py, labels = row numbers)
+_geo = GeoIndex(cell_deg=GEO_CELL_DEG)
 
 # =================== Pydantic models ===================
 
@@ -78,18 +204,44 @@ class UpsertItem(BaseModel):
     text: str
     vector: Optional[List[float]] = None  # pre-computed — skips HF API call
     payload: Optional[Dict[str, Any]] = {}
+    hash: Optional[str] = None  # client-side content hash, echoed by /sync/manifest
 
 
 class UpsertRequest(BaseModel):
     items: List[UpsertItem]
 
 
+class DeleteRequest(BaseModel):
+    ids: List[str] = Field(..., min_length=1)
+
+
+class SyncApplyRequest(BaseModel):
+    base_generation: int
+    upsert: List[UpsertItem] = []
+    delete: List[str] = []
+
+
+class GeoNear(BaseModel):
+    lat: float = Field(..., ge=-90, le=90)
+    lng: float = Field(..., ge=-180, le=180)
+    radius_m: Optional[float] = Field(None, gt=0)  # None = distance reference only
+
+
 class SearchRequest(BaseModel):
     query: str
     top_k: Optional[int] = 10
     filter_type: Optional[str] = None
     filter_province: Optional[str] = None
     min_score: Optional[float] = None
+    # Recall/latency knobs for ANN indexes (defaults: HNSW_EF_SEARCH / IVF_NPROBE)
+    ef_search: Optional[int] = None
+    nprobe: Optional[int] = None
+    # Location: near circle and/or bbox [min_lat, min_lng, max_lat, max_lng]
+    # restrict candidates; distance_decay_m (needs near) scales scores by
+    # exp(-distance / distance_decay_m)
+    near: Optional[GeoNear] = None
+    bbox: Optional[List[float]] = Field(None, min_length=4, max_length=4)
+    distance_decay_m: Optional[float] = Field(None, gt=0)
 
 
 class HybridSearchRequest(BaseModel):
@@ -100,6 +252,19 @@ class HybridSearchRequest(BaseModel):
     filter_type: Optional[str] = None
     filter_province: Optional[str] = None
     boost_vibes: Optional[float] = 1.2
+    ef_search: Optional[int] = None
+    nprobe: Optional[int] = None
+    near: Optional[GeoNear] = None
+    bbox: Optional[List[float]] = Field(None, min_length=4, max_length=4)
+    distance_decay_m: Optional[float] = Field(None, gt=0)
+
+
+class BatchSearchRequest(BaseModel):
+    queries: List[SearchRequest] = Field(..., min_length=1, max_length=SEARCH_BATCH_MAX)
+
+
+class BatchHybridSearchRequest(BaseModel):
+    queries: List[HybridSearchRequest] = Field(..., min_length=1, max_length=SEARCH_BATCH_MAX)
 
 
 # =================== HF Inference helper ===================
@@ -113,11 +278,14 @@ def _normalize_texts(texts: List[str]) -> List[str]:
     return out
 
 
-import asyncio
-
 async def _get_embeddings(texts: List[str]) -> List[List[float]]:
     """Embed texts via HuggingFace Inference API with retry. Returns list of float vectors."""
-    texts = _normalize_texts(texts)
+    BATCH_SIZE.observe(len(texts), kind="hf")
+    with STAGE_SECONDS.time(stage="encode"):
+        return await _hf_embeddings(_normalize_texts(texts))
+
+
+async def _hf_embeddings(texts: List[str]) -> List[List[float]]:
 
     if not HF_TOKEN:
         raise HTTPException(status_code=500, detail="HF_TOKEN is not configured")
@@ -136,7 +304,10 @@ async def _get_embeddings(texts: List[str]) -> List[List[float]]:
     for attempt in range(3):
         try:
             async with httpx.AsyncClient(timeout=60.0) as client:
+                start = time.perf_counter()
                 r = await client.post(url, json=payload, headers=headers)
+                STAGE_SECONDS.observe_since(start, stage="hf_call")
+                HF_REQUESTS.inc(status=r.status_code)
                 # 503 = model loading, retry with backoff
                 if r.status_code == 503:
                     retry_after = int(r.headers.get("X-Wait-For-Model", "20"))
@@ -158,6 +329,8 @@ async def _get_embeddings(texts: List[str]) -> List[List[float]]:
                         return [data]
                 raise ValueError(f"Unexpected HF response shape: {str(data)[:200]}")
         except (httpx.HTTPError, ValueError) as e:
+            if not isinstance(e, httpx.HTTPStatusError):
+                HF_REQUESTS.inc(status="error")
             last_err = e
             if attempt < 2:
                 await asyncio.sleep(2 ** attempt)  # 1s, 2s backoff
@@ -170,12 +343,188 @@ async def _get_embeddings(texts: List[str]) -> List[List[float]]:
 # =================== FAISS helpers ===================
 
 
-def _rebuild_index(vecs: np.ndarray):
-    global _index, _dim
-    _dim = vecs.shape[1]
-    new_idx = faiss.IndexFlatIP(_dim)
-    new_idx.add(vecs)
-    _index = new_idx
+def _build_index(vecs: np.ndarray) -> faiss.Index:
+    """Index of the family fitting len(vecs); labels are the row numbers"""
+    start = time.perf_counter()
+    n, dim = vecs.shape
+    new_idx = build_index(dim, INDEX_SPEC, vecs, np.arange(n, dtype=np.int64))
+    INDEX_REBUILDS.inc()
+    STAGE_SECONDS.observe_since(start, stage="index_build")
+    return new_idx
+
+
+def _write_exact(vecs: np.ndarray) -> Optional[np.ndarray]:
+    """
+    Replace the float32 copy used to re-score compressed hits and map it
+    (a search still holding the old mapping keeps reading the old file).
+    """
+    if not EXACT_RERANK:
+        return None
+    tmp = EXACT_VECTORS_PATH + ".tmp.npy"
+    np.save(tmp, vecs)
+    os.replace(tmp, EXACT_VECTORS_PATH)
+    return np.load(EXACT_VECTORS_PATH, mmap_mode="r")
+
+
+def _top_rows(sims: np.ndarray, rows: np.ndarray, k: int):
+    """(scores, indices) of the k best rows per query, padded with -1 like FAISS."""
+    scores = np.full((len(sims), k), -np.inf, dtype=np.float32)
+    indices = np.full((len(sims), k), -1, dtype=np.int64)
+    top = np.argsort(-sims, axis=1, kind="stable")[:, :k]
+    scores[:, :top.shape[1]] = np.take_along_axis(sims, top, axis=1)
+    indices[:, :top.shape[1]] = rows[top] if rows.ndim == 1 else np.take_along_axis(rows, top, axis=1)
+    return scores, indices
+
+
+def _search(q: np.ndarray, k: int, mask: Optional[np.ndarray],
+            ef_search: Optional[int] = None, nprobe: Optional[int] = None):
+    """
+    Search the current index for every row of q, restricted to `mask`
+    rows when given.
+
+    ANN indexes score the allowed rows exactly when fewer than
+    EXACT_SEARCH_THRESHOLD pass the filter (graph/list probing loses
+    recall on very selective filters). With EXACT_RERANK the top
+    k * RERANK_FACTOR compressed hits are re-scored in float32.
+    """
+    with STAGE_SECONDS.time(stage="ann"):
+        return _search_index(q, k, mask, ef_search, nprobe)
+
+
+def _search_index(q: np.ndarray, k: int, mask: Optional[np.ndarray],
+                  ef_search: Optional[int], nprobe: Optional[int]):
+    kind = index_kind(_index)
+    exact = _exact
+    if mask is not None and kind != "FLAT" and int(mask.sum()) < INDEX_SPEC.exact_threshold:
+        rows = np.flatnonzero(mask)
+        vecs = exact[rows] if exact is not None else _index.reconstruct_batch(rows)
+        return _top_rows(q @ vecs.T, rows, k)
+
+    sel = None
+    if mask is not None:
+        bitmap = np.packbits(mask, bitorder="little")  # must outlive the search
+        sel = faiss.IDSelectorBitmap(bitmap)
+    params = search_params(_index, sel, ef_search, nprobe)
+    if exact is None:
+        return _index.search(q, k, params=params)
+
+    _, indices = _index.search(q, min(k * INDEX_SPEC.rerank, _index.ntotal), params=params)
+    sims = np.einsum("qkd,qd->qk", exact[np.maximum(indices, 0)], q)
+    sims[indices < 0] = -np.inf
+    return _top_rows(sims, indices, k)
+
+
+def _partitions(meta: List[Dict[str, Any]]):
+    """Boolean row masks for every type, province and (lowercased) vibe."""
+    n = len(meta)
+    types: Dict[str, np.ndarray] = {}
+    provinces: Dict[str, np.ndarray] = {}
+    vibes: Dict[str, np.ndarray] = {}
+    for row, m in enumerate(meta):
+        payload = m.get("payload") or {}
+        types.setdefault(m.get("type"), np.zeros(n, dtype=bool))[row] = True
+        provinces.setdefault(payload.get("province"), np.zeros(n, dtype=bool))[row] = True
+        for v in payload.get("vibes") or []:
+            vibes.setdefault(str(v).lower(), np.zeros(n, dtype=bool))[row] = True
+    return types, provinces, vibes
+
+
+def _geo_grid(meta: List[Dict[str, Any]]) -> GeoIndex:
+    """Grid over the located rows, for near/bbox filters and distances."""
+    return GeoIndex(cell_deg=GEO_CELL_DEG).with_changes(
+        np.zeros(0, dtype=np.int64), ((row, m.get("payload")) for row, m in enumerate(meta)))
+
+
+def _geo_mask(near: Optional[GeoNear], bbox: Optional[List[float]]) -> Optional[np.ndarray]:
+    """Row mask for a near circle and/or bbox (None when neither applies)."""
+    if (near is None or near.radius_m is None) and bbox is None:
+        return None
+    mask = np.ones(len(_meta), dtype=bool)
+    if near is not None and near.radius_m is not None:
+        hit = np.zeros(len(_meta), dtype=bool)
+        hit[_geo.within_radius(near.lat, near.lng, near.radius_m)[0]] = True
+        mask &= hit
+    if bbox is not None:
+        hit = np.zeros(len(_meta), dtype=bool)
+        hit[_geo.within_bbox(*bbox)] = True
+        mask &= hit
+    return mask
+
+
+def _fetch_k(req: Any, allowed: int) -> int:
+    """Hits to fetch: top_k, or more when they get re-ranked by distance."""
+    k = min(req.top_k, allowed)
+    if req.near is not None and req.distance_decay_m:
+        return min(k * GEO_DECAY_FETCH, allowed)
+    return k
+
+
+def _geo_rank(req: Any, scores: np.ndarray, indices: np.ndarray):
+    """
+    Apply distance_decay_m and cut to top_k. Returns (scores, indices,
+    distance_m or None without near); rows with no location keep their score.
+    """
+    if req.near is None:
+        return scores[:req.top_k], indices[:req.top_k], None
+    with STAGE_SECONDS.time(stage="rerank"):
+        return _distance_rank(req, scores, indices)
+
+
+def _distance_rank(req: Any, scores: np.ndarray, indices: np.ndarray):
+    # NaN for rows without a location and for empty (-1) slots
+    dist = _geo.distances(indices, req.near.lat, req.near.lng)
+    if req.distance_decay_m:
+        factor = np.where(np.isnan(dist), 1.0, np.exp(-np.nan_to_num(dist) / req.distance_decay_m))
+        scores = np.where(indices >= 0, scores * factor, -np.inf)
+        order = np.argsort(-scores, kind="stable")
+        scores, indices, dist = scores[order], indices[order], dist[order]
+    return scores[:req.top_k], indices[:req.top_k], dist[:req.top_k]
+
+
+def _filter_params(
+    filter_type: Optional[str],
+    filter_province: Optional[str],
+    avoid: Optional[List[str]] = None,
+    near: Optional[GeoNear] = None,
+    bbox: Optional[List[float]] = None,
+):
+    """
+    Combine filters into one boolean row mask (turned into a FAISS bitmap
+    selector by _search).
+
+    Returns (allowed_count, mask or None when nothing is filtered).
+    """
+    with STAGE_SECONDS.time(stage="filter"):
+        allowed, mask = _combine_filters(filter_type, filter_province, avoid, near, bbox)
+    CANDIDATES.observe(allowed)
+    FILTERED_OUT.inc(_index.ntotal - allowed)
+    return allowed, mask
+
+
+def _combine_filters(filter_type: Optional[str], filter_province: Optional[str], avoid: Optional[List[str]],
+                     near: Optional[GeoNear], bbox: Optional[List[float]]):
+    n = _index.ntotal
+    mask = _geo_mask(near, bbox)
+    if filter_type:
+        typ = _type_masks.get(filter_type, np.zeros(n, dtype=bool))
+        mask = typ if mask is None else mask & typ
+    if filter_province:
+        prov = _province_masks.get(filter_province, np.zeros(n, dtype=bool))
+        mask = prov if mask is None else mask & prov
+    for a in avoid or []:
+        hit = _vibe_masks.get(a.lower())
+        if hit is not None:
+            mask = ~hit if mask is None else mask & ~hit
+    if _live is not None:
+        if mask is None:
+            return n - _tombstones, _live
+        mask = mask & _live
+    if mask is None:
+        return n, None
+    allowed = int(mask.sum())
+    if allowed == 0:
+        return 0, None
+    return allowed, mask
 
 
 # =================== Endpoints ===================
@@ -191,38 +540,77 @@ async def healthz():
         "model": MODEL_NAME,
         "vectors": vectors,
         "metadata": len(_meta),
+        "tombstones": _tombstones,
+        "generation": _generation,
+        "index_type": index_kind(_index) if _index is not None else None,
+        # Codes actually built (pq falls back to sq8 until there is enough data to train it)
+        "vector_storage": index_storage(_index) if _index is not None else INDEX_SPEC.storage,
+        "vector_bytes": vector_bytes(_index) if _index is not None else 0,
+        "exact_rerank": _exact is not None,
     }
 
 
+def _index_samples():
+    """Index gauges, read at scrape time"""
+    vectors = _index.ntotal if _index is not None else 0
+    return [
+        ("index_vectors", "gauge", "Vectors in the FAISS index", [({}, vectors)]),
+        ("index_tombstones", "gauge", "Deleted rows awaiting compaction", [({}, _tombstones)]),
+    ]
+
+
+metrics.collector(_index_samples)
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.post("/embed", response_model=EmbedResponse)
-async def embed(req: EmbedRequest):
+async def embed(req: EmbedRequest, request: Request, format: Optional[str] = None, dtype: Optional[str] = None):
     raw = req.texts if req.texts is not None else req.text
     if raw is None:
         raise HTTPException(status_code=422, detail="Provide 'text' or 'texts' field")
+    # JSON float lists (default), raw little-endian rows or the same bytes
+    # base64-packed: ?format= / ?dtype= or the Accept header (embedding_format.py)
+    fmt, dtype = negotiate(request.headers.get("accept"), format, dtype)
     texts = raw if isinstance(raw, list) else [raw]
     vectors = await _get_embeddings(texts)
-    return {"vectors": vectors}
+    body = render(vectors, fmt, dtype, "vectors")
+    # The packed body is not an EmbedResponse: send it as is
+    return JSONResponse(body) if fmt == "base64" else body
 
 
-@app.post("/upsert")
-async def upsert(req: UpsertRequest):
-    global _meta
+@app.post("/embed/stream")
+async def embed_stream(request: Request):
+    """
+    NDJSON {id, text} in, NDJSON {id, embedding} out per length-sorted batch
+    (bulk_embed.py): match results by id; a final {"done": true, ...} line.
+    """
+    async def encode(texts: List[str]) -> np.ndarray:
+        return np.asarray(await _get_embeddings(texts), dtype=np.float32)
+
+    return NDJSONStream(stream_embeddings(request.stream(), encode, EMBED_STREAM_WINDOW, EMBED_STREAM_BATCH,
+                                          EMBED_STREAM_MAX_LINE))
+
+
+def _content_hash(item: UpsertItem) -> str:
+    """Same as ai/metadata_store.content_hash; used when the client sends no hash"""
+    body = json.dumps({"type": item.type, "text": item.text, "payload": item.payload or {}},
+                      ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(body.encode("utf-8")).hexdigest()
 
-    items = req.items
-    if not items:
-        return {"added": 0, "removed": 0, "total": 0}
 
+async def _item_vectors(items: List[UpsertItem]) -> Tuple[np.ndarray, List[UpsertItem], int]:
+    """(normalized vectors, items in vector order, how many needed the HF API)"""
     # Partition: items with pre-computed vectors vs items needing HF API
     items_with_vec = [i for i in items if i.vector]
     items_need_embed = [i for i in items if not i.vector]
 
-    all_vecs: List[List[float]] = []
-    all_items: List[UpsertItem] = []
-
     # Use pre-computed vectors (no HF API call)
-    for item in items_with_vec:
-        all_vecs.append(item.vector)
-        all_items.append(item)
+    all_vecs: List[List[float]] = [i.vector for i in items_with_vec]
+    all_items: List[UpsertItem] = list(items_with_vec)
 
     # Call HF API only for items without cached vectors
     if items_need_embed:
@@ -231,17 +619,147 @@ async def upsert(req: UpsertRequest):
         all_vecs.extend(new_vecs)
         all_items.extend(items_need_embed)
 
+    if not all_items:
+        return np.zeros((0, _dim or 0), dtype=np.float32), [], 0
     vecs = np.array(all_vecs, dtype=np.float32)
     faiss.normalize_L2(vecs)
+    return vecs, all_items, len(items_need_embed)
+
+
+def _build(vecs: np.ndarray, meta: List[Dict[str, Any]]):
+    """Index, exact copy, filter masks and geo grid for new rows (no shared state touched)."""
+    index = exact = None
+    if len(meta):
+        index = _build_index(vecs)
+        with STAGE_SECONDS.time(stage="persist"):
+            exact = _write_exact(vecs)
+    with STAGE_SECONDS.time(stage="partitions"):
+        return index, exact, _partitions(meta), _geo_grid(meta)
+
+
+async def _install(vecs: np.ndarray, meta: List[Dict[str, Any]]):
+    """
+    Replace the index and its row metadata (no tombstones), then bump the
+    generation. The rebuild runs in a worker thread so searches keep being
+    served; the swap itself happens on the event loop, between requests.
+    """
+    global _meta, _rows_by_id, _index, _exact, _dim, _generation, _dead, _live, _tombstones
+    global _type_masks, _province_masks, _vibe_masks, _geo
+    index, exact, partitions, geo = await asyncio.to_thread(_build, vecs, meta)
+    if index is not None:
+        _dim = index.d
+    _index, _exact = index, exact
+    _meta, _rows_by_id = meta, {m["id"]: row for row, m in enumerate(meta)}
+    _dead, _live, _tombstones = np.zeros(len(meta), dtype=bool), None, 0
+    _type_masks, _province_masks, _vibe_masks = partitions
+    _geo = geo
+    _generation += 1
+
+
+def _rows_vectors(rows: List[int]) -> np.ndarray:
+    """Current float32 vectors of index rows (exact copy when kept, else decoded codes)"""
+    if not rows or _index is None:
+        return np.zeros((0, _dim or 0), dtype=np.float32)
+    rows = np.asarray(rows, dtype=np.int64)
+    return np.array(_exact[rows] if _exact is not None else _index.reconstruct_batch(rows), dtype=np.float32)
 
-    _rebuild_index(vecs)
-    _meta = [{"id": i.id, "type": i.type, "payload": i.payload} for i in all_items]
+
+@app.post("/upsert")
+async def upsert(req: UpsertRequest):
+    items = req.items
+    if not items:
+        return {"added": 0, "removed": 0, "total": 0}
+    BATCH_SIZE.observe(len(items), kind="upsert")
+
+    async with _write_lock:
+        vecs, all_items, embedded = await _item_vectors(items)
+        await _install(vecs, [{"id": i.id, "type": i.type, "payload": i.payload, "hash": i.hash or _content_hash(i)}
+                        for i in all_items])
 
     logger.info(
-        f"Upserted {len(all_items)} items (cached={len(items_with_vec)}, "
-        f"embedded={len(items_need_embed)}) dim={_dim}"
+        f"Upserted {len(all_items)} items (cached={len(all_items) - embedded}, "
+        f"embedded={embedded}) dim={_dim}"
     )
-    return {"added": len(all_items), "removed": 0, "total": len(all_items)}
+    return {"added": len(all_items), "removed": 0, "total": len(all_items), "generation": _generation}
+
+
+@app.get("/sync/manifest")
+async def sync_manifest():
+    """{id: content hash} of the index, to diff against before /sync/apply"""
+    return {"model": MODEL_NAME, "generation": _generation, "count": len(_meta) - _tombstones,
+            "items": {m["id"]: m.get("hash") for m, dead in zip(_meta, _dead) if not dead}}
+
+
+@app.post("/sync/apply")
+async def sync_apply(req: SyncApplyRequest):
+    """
+    Apply added / changed (upsert) and removed (delete) items relative to
+    base_generation; unchanged rows keep their vectors. 409 if another write
+    landed since the client read the manifest.
+    """
+    async with _write_lock:
+        if req.base_generation != _generation:
+            raise HTTPException(status_code=409,
+                                detail=f"Stale base generation {req.base_generation}, index is at {_generation}")
+        changed = {i.id: i for i in req.upsert}
+        gone = set(req.delete) - set(changed)
+        if not changed and not any(not _dead[row] for row in map(_rows_by_id.get, gone) if row is not None):
+            return {"added": 0, "removed": 0, "deleted": 0, "total": len(_meta) - _tombstones,
+                    "generation": _generation}
+
+        BATCH_SIZE.observe(len(changed), kind="upsert")
+        vecs, new_items, embedded = await _item_vectors(list(changed.values()))
+        # Rows are picked after the HF call so /delete calls made meanwhile
+        # count; the rebuild drops tombstoned rows too
+        live = [row for row, dead in enumerate(_dead) if not dead]
+        keep = [row for row in live if _meta[row]["id"] not in changed and _meta[row]["id"] not in gone]
+        replaced = sum(1 for row in live if _meta[row]["id"] in changed)
+        deleted = len(live) - len(keep) - replaced
+        parts = [v for v in (_rows_vectors(keep), vecs) if len(v)]
+        await _install(np.vstack(parts) if parts else vecs,
+                       [_meta[row] for row in keep]
+                       + [{"id": i.id, "type": i.type, "payload": i.payload, "hash": i.hash or _content_hash(i)}
+                          for i in new_items])
+
+    logger.info(f"Sync applied: {len(changed)} upserted (embedded={embedded}), {deleted} deleted, "
+                f"{len(_meta)} total")
+    return {"added": len(changed), "removed": replaced, "deleted": deleted, "total": len(_meta), "generation": _generation}
+
+
+async def _compact():
+    """Rebuild the index without its tombstoned rows (under the write lock, like any write)."""
+    async with _write_lock:
+        if not _tombstones:
+            return
+        dropped = _tombstones
+        keep = np.flatnonzero(~_dead).tolist()
+        vecs = await asyncio.to_thread(_rows_vectors, keep)
+        await _install(vecs, [_meta[row] for row in keep])
+    COMPACTIONS.inc()
+    logger.info(f"Compacted {dropped} tombstones, {len(_meta)} rows left")
+
+
+@app.post("/delete")
+async def delete(req: DeleteRequest):
+    """
+    Tombstone ids: searches skip them from the next request on (one more
+    mask in the filter bitmap, nothing per hit); the index is rebuilt
+    without them once they pass TOMBSTONE_COMPACT_RATIO. Unknown ids are
+    ignored. Waits for a write in progress, like any other write.
+    """
+    global _generation, _dead, _live, _tombstones, _compaction
+    async with _write_lock:
+        rows = sorted({row for row in map(_rows_by_id.get, req.ids) if row is not None and not _dead[row]})
+        if rows:
+            # Fresh arrays rather than in-place writes: masks already handed to a search stay as they were
+            _dead = _dead.copy()
+            _dead[rows] = True
+            _live, _tombstones = ~_dead, _tombstones + len(rows)
+            _generation += 1
+            if _tombstones >= TOMBSTONE_COMPACT_RATIO * len(_meta) and (_compaction is None or _compaction.done()):
+                _compaction = asyncio.create_task(_compact())
+    return {"deleted": len(rows), "tombstones": _tombstones, "total": len(_meta) - _tombstones,
+            "generation": _generation}
 
 
 @app.post("/search")
@@ -253,23 +771,75 @@ async def search(req: SearchRequest):
     q = np.array(vecs, dtype=np.float32)
     faiss.normalize_L2(q)
 
-    k = min(req.top_k, _index.ntotal)
-    scores, indices = _index.search(q, k)
+    allowed, mask = _filter_params(req.filter_type, req.filter_province, near=req.near, bbox=req.bbox)
+    if allowed == 0:
+        return {"hits": [], "strategy": "semantic"}
+
+    scores, indices = _search(q, _fetch_k(req, allowed), mask, req.ef_search, req.nprobe)
+    return {"hits": _search_hits(req, scores[0], indices[0]), "strategy": "semantic"}
 
+
+def _search_hits(req: SearchRequest, scores: np.ndarray, indices: np.ndarray) -> List[Dict[str, Any]]:
+    scores, indices, dist = _geo_rank(req, scores, indices)
+    start = time.perf_counter()
     hits = []
-    for score, idx in zip(scores[0], indices[0]):
+    for i, (score, idx) in enumerate(zip(scores, indices)):
         if idx < 0:
             continue
         if req.min_score and score < req.min_score:
             continue
         meta = _meta[idx]
-        if req.filter_type and meta.get("type") != req.filter_type:
-            continue
-        if req.filter_province and meta.get("payload", {}).get("province") != req.filter_province:
-            continue
-        hits.append({"id": meta["id"], "score": float(score), "payload": meta.get("payload", {})})
+        hit = {"id": meta["id"], "score": float(score), "payload": meta.get("payload", {})}
+        if dist is not None:
+            hit["distance_m"] = None if np.isnan(dist[i]) else round(float(dist[i]), 1)
+        hits.append(hit)
+    STAGE_SECONDS.observe_since(start, stage="format")
+    return hits
+
+
+def _grouped_search(q: np.ndarray, reqs: List[Any], ks: List[int], avoid: bool = False):
+    """
+    One _search per distinct filter / knob combination over the stacked
+    query rows. Returns (scores, indices) rows in request order, None for
+    queries whose filter leaves nothing.
+    """
+    groups: Dict[tuple, List[int]] = {}
+    for i, (req, k) in enumerate(zip(reqs, ks)):
+        if k > 0:
+            near = (req.near.lat, req.near.lng, req.near.radius_m) if req.near and req.near.radius_m else None
+            key = (req.filter_type or None, req.filter_province or None,
+                   tuple(req.avoid or []) if avoid else (), near,
+                   tuple(req.bbox) if req.bbox else None, req.ef_search, req.nprobe)
+            groups.setdefault(key, []).append(i)
+
+    results: List[Optional[tuple]] = [None] * len(reqs)
+    for (filter_type, filter_province, avoid_terms, _, _, ef_search, nprobe), members in groups.items():
+        first = reqs[members[0]]
+        # Candidates were counted when the batch computed ks
+        with STAGE_SECONDS.time(stage="filter"):
+            _, mask = _combine_filters(filter_type, filter_province, list(avoid_terms), first.near, first.bbox)
+        scores, indices = _search(q[members], max(ks[i] for i in members), mask, ef_search, nprobe)
+        for row, i in enumerate(members):
+            results[i] = (scores[row, :ks[i]], indices[row, :ks[i]])
+    return results
+
+
+@app.post("/search/batch")
+async def search_batch(req: BatchSearchRequest):
+    if _index is None or _index.ntotal == 0:
+        return {"results": [{"hits": [], "strategy": "semantic"} for _ in req.queries]}
+
+    BATCH_SIZE.observe(len(req.queries), kind="search_batch")
+    q = np.array(await _get_embeddings([r.query for r in req.queries]), dtype=np.float32)
+    faiss.normalize_L2(q)
 
-    return {"hits": hits, "strategy": "semantic"}
+    ks = [_fetch_k(r, _filter_params(r.filter_type, r.filter_province, near=r.near, bbox=r.bbox)[0])
+          for r in req.queries]
+    found = _grouped_search(q, req.queries, ks)
+    return {"results": [
+        {"hits": _search_hits(r, *f) if f else [], "strategy": "semantic"}
+        for r, f in zip(req.queries, found)
+    ]}
 
 
 @app.post("/hybrid-search")
@@ -286,56 +856,80 @@ async def hybrid_search(req: HybridSearchRequest):
 
     all_vecs = np.array(vectors, dtype=np.float32)
     faiss.normalize_L2(all_vecs)
+    q = _hybrid_vector(req, all_vecs)
+
+    # Type/province filters and the avoid list are applied inside the search
+    allowed, mask = _filter_params(req.filter_type, req.filter_province, req.avoid, req.near, req.bbox)
+    if allowed == 0:
+        return {"hits": [], "strategy": "hybrid"}
+
+    scores, indices = _search(q, _fetch_k(req, allowed), mask, req.ef_search, req.nprobe)
+    return {"hits": _hybrid_hits(req, scores[0], indices[0]), "strategy": "hybrid"}
+
 
-    # Weighted combination: free_text vector + boost * mean(vibe vectors)
-    if req.vibes and len(vectors) > 1:
+def _hybrid_vector(req: HybridSearchRequest, all_vecs: np.ndarray) -> np.ndarray:
+    """Weighted combination: free_text vector + boost * mean(vibe vectors)"""
+    if req.vibes and len(all_vecs) > 1:
         text_vec = all_vecs[0]
         vibe_avg = np.mean(all_vecs[1:], axis=0)
         combined = text_vec + req.boost_vibes * vibe_avg
         norm = np.linalg.norm(combined)
         if norm > 0:
             combined = combined / norm
-        q = combined.reshape(1, -1).astype(np.float32)
-    else:
-        q = all_vecs[[0]]
+        return combined.reshape(1, -1).astype(np.float32)
+    return all_vecs[[0]]
 
-    # Fetch extra candidates for post-filtering
-    k = min(req.top_k * 3, _index.ntotal)
-    scores, indices = _index.search(q, k)
-
-    avoid_set = {a.lower() for a in (req.avoid or [])}
 
+def _hybrid_hits(req: HybridSearchRequest, scores: np.ndarray, indices: np.ndarray) -> List[Dict[str, Any]]:
+    scores, indices, dist = _geo_rank(req, scores, indices)
+    start = time.perf_counter()
     hits = []
-    for score, idx in zip(scores[0], indices[0]):
+    for i, (score, idx) in enumerate(zip(scores, indices)):
         if idx < 0:
             continue
         meta = _meta[idx]
         payload = meta.get("payload", {})
 
-        if req.filter_type and meta.get("type") != req.filter_type:
-            continue
-        if req.filter_province and payload.get("province") != req.filter_province:
-            continue
-
-        # Skip zones whose vibes overlap with avoid list
-        if avoid_set:
-            item_vibes = {v.lower() for v in payload.get("vibes", [])}
-            if item_vibes & avoid_set:
-                continue
-
         vibe_matches = []
         if req.vibes:
             item_vibes = {v.lower() for v in payload.get("vibes", [])}
             vibe_matches = [v for v in req.vibes if v.lower() in item_vibes]
 
-        hits.append({
+        hit = {
             "id": meta["id"],
             "score": float(score),
             "payload": payload,
             "vibe_matches": vibe_matches,
-        })
+        }
+        if dist is not None:
+            hit["distance_m"] = None if np.isnan(dist[i]) else round(float(dist[i]), 1)
+        hits.append(hit)
+    STAGE_SECONDS.observe_since(start, stage="format")
+    return hits
 
-        if len(hits) >= req.top_k:
-            break
 
-    return {"hits": hits, "strategy": "hybrid"}
+@app.post("/hybrid-search/batch")
+async def hybrid_search_batch(req: BatchHybridSearchRequest):
+    if _index is None or _index.ntotal == 0:
+        return {"results": [{"hits": [], "strategy": "hybrid"} for _ in req.queries]}
+
+    BATCH_SIZE.observe(len(req.queries), kind="hybrid_batch")
+    # Every query's free_text + vibes go to HF in a single call
+    active = [i for i, r in enumerate(req.queries) if r.free_text or r.vibes]
+    reqs = [req.queries[i] for i in active]
+    inputs = [[r.free_text or ""] + (r.vibes or []) for r in reqs]
+    results = [{"hits": [], "strategy": "hybrid"} for _ in req.queries]
+    if not active:
+        return {"results": results}
+
+    all_vecs = np.array(await _get_embeddings([t for group in inputs for t in group]), dtype=np.float32)
+    faiss.normalize_L2(all_vecs)
+    ends = np.cumsum([len(group) for group in inputs])
+    q = np.concatenate([_hybrid_vector(r, all_vecs[end - len(group):end])
+                        for r, group, end in zip(reqs, inputs, ends)])
+
+    ks = [_fetch_k(r, _filter_params(r.filter_type, r.filter_province, r.avoid, r.near, r.bbox)[0]) for r in reqs]
+    for i, r, f in zip(active, reqs, _grouped_search(q, reqs, ks, avoid=True)):
+        if f is not None:
+            results[i]["hits"] = _hybrid_hits(r, *f)
+    return {"results": results}
@@ -0,0 +1,186 @@
+"""
+Geo Index
+Uniform lat/lng grid over item geometry for radius / bounding-box
+candidate pruning and distance scoring.
+
+Every located item is a circle: the payload `center` (else `lat`/`lng`,
+else the polygon centroid) and an extent covering `radiusM` and every
+`poly` ([lat, lng]) / GeoJSON `geometry` ([lng, lat]) vertex. Items are
+bucketed by the grid cell of their center; a query visits only the cells
+its circle or box (grown by the largest extent) touches, then checks the
+distances of those candidates exactly.
+
+Like MetadataStore, an index is immutable once built: with_changes()
+returns a new one.
+"""
+
+import math
+import os
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+GEO_FILE = "geo.npz"
+
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEG_LAT = math.pi * EARTH_RADIUS_M / 180.0
+
+# (label, payload) as seen by the index
+Located = Tuple[int, Dict[str, Any]]
+
+
+def haversine_m(lat1, lng1, lat2, lng2) -> np.ndarray:
+    """Great-circle distance in meters (broadcasts over arrays)"""
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(v, dtype=np.float64)) for v in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def _vertices(payload: Dict[str, Any]) -> List[Tuple[float, float]]:
+    points = [(float(p[0]), float(p[1])) for p in payload.get("poly") or [] if len(p) >= 2]
+    geometry = payload.get("geometry")
+    if isinstance(geometry, dict):
+        rings = {
+            "Polygon": geometry.get("coordinates") or [],
+            "MultiPolygon": [r for poly in geometry.get("coordinates") or [] for r in poly],
+        }.get(geometry.get("type"), [])
+        points += [(float(p[1]), float(p[0])) for ring in rings for p in ring if len(p) >= 2]
+    return points
+
+
+def geometry_of(payload: Optional[Dict[str, Any]]) -> Optional[Tuple[float, float, float]]:
+    """(lat, lng, extent_m) of a payload, None when it carries no usable location"""
+    payload = payload or {}
+    try:
+        points = _vertices(payload)
+        center = payload.get("center")
+        if isinstance(center, dict) and center.get("lat") is not None and center.get("lng") is not None:
+            lat, lng = float(center["lat"]), float(center["lng"])
+        elif payload.get("lat") is not None and payload.get("lng") is not None:
+            lat, lng = float(payload["lat"]), float(payload["lng"])
+        elif points:
+            lat, lng = (float(v) for v in np.mean(points, axis=0))
+        else:
+            return None
+        extent = float(payload.get("radiusM") or 0.0)
+    except (TypeError, ValueError, KeyError, IndexError):
+        return None
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lng <= 180.0):
+        return None
+    if points:
+        pts = np.array(points)
+        extent = max(extent, float(haversine_m(lat, lng, pts[:, 0], pts[:, 1]).max()))
+    return lat, lng, extent
+
+
+class GeoIndex:
+    """Immutable once built; with_changes() returns a new index"""
+
+    def __init__(self, labels: Optional[np.ndarray] = None, lat: Optional[np.ndarray] = None,
+                 lng: Optional[np.ndarray] = None, extent: Optional[np.ndarray] = None,
+                 cell_deg: float = 0.05):
+        # Rows sorted by label
+        self.labels = labels if labels is not None else np.zeros(0, dtype=np.int64)
+        self.lat = lat if lat is not None else np.zeros(0, dtype=np.float64)
+        self.lng = lng if lng is not None else np.zeros(0, dtype=np.float64)
+        self.extent = extent if extent is not None else np.zeros(0, dtype=np.float32)
+        self.cell_deg = cell_deg
+        self.max_extent = float(self.extent.max()) if len(self.extent) else 0.0
+        # Grid: rows ordered by cell code, code = lat_cell * n_cols + lng_cell
+        self._n_cols = int(math.ceil(360.0 / cell_deg)) + 1
+        codes = self._cell(self.lat, 90.0) * self._n_cols + self._cell(self.lng, 180.0)
+        self._order = np.argsort(codes, kind="stable")
+        self._codes = codes[self._order]
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def _cell(self, deg, offset: float) -> np.ndarray:
+        return np.floor((np.asarray(deg, dtype=np.float64) + offset) / self.cell_deg).astype(np.int64)
+
+    # ---------- writes (copy-on-write) ----------
+
+    def with_changes(self, removed: np.ndarray, added: Iterable[Located]) -> "GeoIndex":
+        """New index without `removed` labels and with the located `added` items"""
+        added = list(added)
+        drop = np.concatenate([np.asarray(removed, dtype=np.int64),
+                               np.array([l for l, _ in added], dtype=np.int64)])
+        keep = ~np.isin(self.labels, drop) if len(drop) else np.ones(len(self), dtype=bool)
+        located = [(int(l), g) for l, g in ((l, geometry_of(p)) for l, p in added) if g is not None]
+        labels = np.concatenate([self.labels[keep], np.array([l for l, _ in located], dtype=np.int64)])
+        order = np.argsort(labels, kind="stable")
+        return GeoIndex(
+            labels[order],
+            np.concatenate([self.lat[keep], np.array([g[0] for _, g in located])])[order],
+            np.concatenate([self.lng[keep], np.array([g[1] for _, g in located])])[order],
+            np.concatenate([self.extent[keep], np.array([g[2] for _, g in located], dtype=np.float32)])[order],
+            self.cell_deg,
+        )
+
+    # ---------- reads ----------
+
+    def _candidates(self, min_lat: float, min_lng: float, max_lat: float, max_lng: float) -> np.ndarray:
+        """Rows whose center cell overlaps the box"""
+        lat0, lat1 = self._cell(max(min_lat, -90.0), 90.0), self._cell(min(max_lat, 90.0), 90.0)
+        lng0, lng1 = self._cell(max(min_lng, -180.0), 180.0), self._cell(min(max_lng, 180.0), 180.0)
+        lat_cells = np.arange(lat0, lat1 + 1)
+        starts = np.searchsorted(self._codes, lat_cells * self._n_cols + lng0, side="left")
+        ends = np.searchsorted(self._codes, lat_cells * self._n_cols + lng1, side="right")
+        if not len(starts) or not (ends > starts).any():
+            return np.zeros(0, dtype=np.int64)
+        return np.sort(np.concatenate([self._order[s:e] for s, e in zip(starts, ends) if e > s]))
+
+    @staticmethod
+    def _lng_span(lat: float, meters: float) -> float:
+        cos = math.cos(math.radians(min(abs(lat), 89.9)))
+        return meters / (METERS_PER_DEG_LAT * cos)
+
+    def within_radius(self, lat: float, lng: float, radius_m: float) -> Tuple[np.ndarray, np.ndarray]:
+        """(labels, distance_m) of items whose area reaches within radius_m of the point"""
+        reach = radius_m + self.max_extent
+        dlat = reach / METERS_PER_DEG_LAT
+        dlng = self._lng_span(max(abs(lat - dlat), abs(lat + dlat)), reach)
+        rows = self._candidates(lat - dlat, lng - dlng, lat + dlat, lng + dlng)
+        dist = np.maximum(haversine_m(lat, lng, self.lat[rows], self.lng[rows]) - self.extent[rows], 0.0)
+        hit = dist <= radius_m
+        return self.labels[rows[hit]], dist[hit]
+
+    def within_bbox(self, min_lat: float, min_lng: float, max_lat: float, max_lng: float) -> np.ndarray:
+        """Labels of items whose circle (approximated by its box) intersects the bbox"""
+        grow = self.max_extent / METERS_PER_DEG_LAT
+        grow_lng = self._lng_span(max(abs(min_lat), abs(max_lat)) + grow, self.max_extent)
+        rows = self._candidates(min_lat - grow, min_lng - grow_lng, max_lat + grow, max_lng + grow_lng)
+        ext_lat = self.extent[rows] / METERS_PER_DEG_LAT
+        ext_lng = self.extent[rows] / (METERS_PER_DEG_LAT * np.cos(np.radians(np.minimum(np.abs(self.lat[rows]), 89.9))))
+        hit = ((self.lat[rows] + ext_lat >= min_lat) & (self.lat[rows] - ext_lat <= max_lat)
+               & (self.lng[rows] + ext_lng >= min_lng) & (self.lng[rows] - ext_lng <= max_lng))
+        return self.labels[rows[hit]]
+
+    def distances(self, labels: np.ndarray, lat: float, lng: float) -> np.ndarray:
+        """Distance (m) from the point to each item's area; NaN for unlocated labels"""
+        labels = np.asarray(labels, dtype=np.int64)
+        out = np.full(len(labels), np.nan)
+        if not len(self.labels):
+            return out
+        pos = np.minimum(np.searchsorted(self.labels, labels), len(self.labels) - 1)
+        found = self.labels[pos] == labels
+        rows = pos[found]
+        out[found] = np.maximum(haversine_m(lat, lng, self.lat[rows], self.lng[rows]) - self.extent[rows], 0.0)
+        return out
+
+    # ---------- persistence ----------
+
+    def save(self, directory: Path):
+        tmp = Path(directory) / (GEO_FILE + ".tmp")
+        with open(tmp, "wb") as f:
+            np.savez(f, labels=self.labels, lat=self.lat, lng=self.lng, extent=self.extent)
+        os.replace(tmp, Path(directory) / GEO_FILE)
+
+    @classmethod
+    def load(cls, directory: Path, cell_deg: float = 0.05) -> Optional["GeoIndex"]:
+        path = Path(directory) / GEO_FILE
+        if not path.exists():
+            return None
+        with np.load(path) as data:
+            return cls(data["labels"], data["lat"], data["lng"], data["extent"], cell_deg)
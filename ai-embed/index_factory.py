@@ -0,0 +1,239 @@
+"""
+Index Factory
+Builds the FAISS index family selected by configuration. Every index is
+addressed by the stable int64 labels: FLAT and HNSW are wrapped in
+IndexIDMap2, IVF stores the ids in its inverted lists natively.
+
+  - FLAT   exact inner product
+  - HNSW   graph ANN (M, efConstruction, efSearch)
+  - IVF    inverted lists, flat codes (nlist, nprobe)
+  - IVFPQ  inverted lists, product-quantized codes (nlist, nprobe, PQ m x nbits)
+
+Vector codes inside FLAT / HNSW / IVF are chosen by `storage`:
+
+  - fp32   full precision (4 bytes / dim)
+  - fp16   half precision (2x smaller)
+  - sq8    8-bit scalar quantization (4x smaller)
+  - pq     product quantization, pq_m codes of pq_nbits (d*32/(m*nbits)x smaller)
+
+Compressed codes are meant for the first-pass scan; the shortlist can be
+re-scored against full-precision vectors (see exact_vectors.py).
+
+Below `exact_threshold` vectors (or when there is too little data to
+train IVF) the factory falls back to FLAT: exact search is fast enough at
+that size and needs no training. Search-time knobs (efSearch / nprobe)
+are stored in the index as defaults and can be overridden per request.
+"""
+
+import math
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+import faiss
+import numpy as np
+
+KINDS = ("FLAT", "HNSW", "IVF", "IVFPQ")
+STORAGES = ("fp32", "fp16", "sq8", "pq")
+
+# IVF k-means wants ~39 training points per centroid; PQ needs 2^nbits
+MIN_POINTS_PER_CENTROID = 39
+
+
+@dataclass
+class IndexSpec:
+    kind: str = "FLAT"
+    exact_threshold: int = 5000
+    hnsw_m: int = 32
+    ef_construction: int = 200
+    ef_search: int = 64
+    nlist: int = 0          # 0 = ~4*sqrt(n)
+    nprobe: int = 16
+    pq_m: int = 16
+    pq_nbits: int = 8
+    storage: str = "fp32"
+    rerank: int = 4         # shortlist = k * rerank when re-scoring exactly
+
+    @classmethod
+    def from_env(cls) -> "IndexSpec":
+        kind = os.getenv("INDEX_TYPE", "FLAT").upper().replace("-", "").replace("_", "")
+        if kind not in KINDS:
+            raise ValueError(f"Unknown INDEX_TYPE '{kind}', expected one of {KINDS}")
+        storage = os.getenv("VECTOR_STORAGE", "fp32").lower()
+        if storage not in STORAGES:
+            raise ValueError(f"Unknown VECTOR_STORAGE '{storage}', expected one of {STORAGES}")
+        return cls(
+            kind=kind,
+            exact_threshold=int(os.getenv("EXACT_SEARCH_THRESHOLD", "5000")),
+            hnsw_m=int(os.getenv("HNSW_M", "32")),
+            ef_construction=int(os.getenv("HNSW_EF_CONSTRUCTION", "200")),
+            ef_search=int(os.getenv("HNSW_EF_SEARCH", "64")),
+            nlist=int(os.getenv("IVF_NLIST", "0")),
+            nprobe=int(os.getenv("IVF_NPROBE", "16")),
+            pq_m=int(os.getenv("PQ_M", "16")),
+            pq_nbits=int(os.getenv("PQ_NBITS", "8")),
+            storage=storage,
+            rerank=int(os.getenv("RERANK_FACTOR", "4")),
+        )
+
+    def nlist_for(self, n: int) -> int:
+        return self.nlist or max(1, int(4 * math.sqrt(n)))
+
+    def kind_for(self, n: int) -> str:
+        """Index family to use for a corpus of n vectors"""
+        if self.kind == "FLAT" or n < self.exact_threshold:
+            return "FLAT"
+        if self.kind in ("IVF", "IVFPQ"):
+            if n < self.nlist_for(n) * MIN_POINTS_PER_CENTROID:
+                return "FLAT"
+            if self.kind == "IVFPQ" and n < (1 << self.pq_nbits) * MIN_POINTS_PER_CENTROID:
+                return "IVF"
+        return self.kind
+
+    def storage_for(self, n: int) -> str:
+        """Vector codes for a corpus of n vectors (trained codes need data)"""
+        if self.storage in ("sq8", "pq") and n == 0:
+            return "fp32"
+        if self.storage == "pq" and n < (1 << self.pq_nbits) * MIN_POINTS_PER_CENTROID:
+            return "sq8"
+        return self.storage
+
+    def codes(self, dim: int, n: int) -> str:
+        """index_factory suffix for the vector codes"""
+        return {
+            "fp32": "Flat",
+            "fp16": "SQfp16",
+            "sq8": "SQ8",
+            "pq": f"PQ{self.pq_m_for(dim)}x{self.pq_nbits}",
+        }[self.storage_for(n)]
+
+    def pq_m_for(self, dim: int) -> int:
+        """Largest sub-quantizer count <= pq_m that divides dim"""
+        return next(m for m in range(min(self.pq_m, dim), 0, -1) if dim % m == 0)
+
+
+def inner(index):
+    """The index inside the IndexIDMap2 wrapper"""
+    return faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+
+
+def index_kind(index) -> str:
+    base = inner(index)
+    if isinstance(base, faiss.IndexHNSW):
+        return "HNSW"
+    if isinstance(base, faiss.IndexIVF) and base.nlist == 1:
+        return "FLAT"  # single-list PQ scan, see build_index
+    if isinstance(base, faiss.IndexIVFPQ):
+        return "IVFPQ"
+    if isinstance(base, faiss.IndexIVF):
+        return "IVF"
+    return "FLAT"
+
+
+def index_storage(index) -> str:
+    """Vector codes of an index (IVFPQ counts as pq)"""
+    base = inner(index)
+    if isinstance(base, faiss.IndexHNSW):
+        base = faiss.downcast_index(base.storage)
+    if isinstance(base, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+        return "pq"
+    if isinstance(base, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return "fp16" if base.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+    return "fp32"
+
+
+def vector_bytes(index) -> int:
+    """Memory taken by the vector codes (graph links / ids not included)"""
+    base = inner(index)
+    if isinstance(base, faiss.IndexHNSW):
+        base = faiss.downcast_index(base.storage)
+    try:
+        return int(base.sa_code_size()) * index.ntotal
+    except RuntimeError:
+        return index.d * 4 * index.ntotal
+
+
+def is_lossless(index) -> bool:
+    """Whether reconstruct() returns the original vectors"""
+    return index_storage(index) == "fp32"
+
+
+def needs_rebuild(index, spec: IndexSpec, n: int) -> bool:
+    """Current index family (or IVF nlist) no longer fits a corpus of n vectors"""
+    kind = spec.kind_for(n)
+    if index_kind(index) != kind:
+        return True
+    if kind != "IVFPQ" and index_storage(index) != spec.storage_for(n):
+        return True
+    if kind in ("IVF", "IVFPQ"):
+        nlist, target = inner(index).nlist, spec.nlist_for(n)
+        return not (target / 2 <= nlist <= target * 2)
+    return False
+
+
+def build_index(dim: int, spec: IndexSpec, vectors: Optional[np.ndarray] = None,
+                labels: Optional[np.ndarray] = None):
+    """New index of the family fitting len(vectors), trained and filled"""
+    n = 0 if vectors is None else len(vectors)
+    kind, codes = spec.kind_for(n), spec.codes(dim, n)
+    if kind == "HNSW":
+        description = f"IDMap2,HNSW{spec.hnsw_m},{codes}"
+    elif kind == "IVF":
+        description = f"IVF{spec.nlist_for(n)},{codes}"
+    elif kind == "IVFPQ":
+        description = f"IVF{spec.nlist_for(n)},PQ{spec.pq_m_for(dim)}x{spec.pq_nbits}"
+    elif codes.startswith("PQ"):
+        # IndexPQ takes no search parameters (so no filter selector): scan
+        # the PQ codes as a single inverted list instead
+        description = f"IVF1,{codes}"
+    else:
+        description = f"IDMap2,{codes}"
+    index = faiss.index_factory(dim, description, faiss.METRIC_INNER_PRODUCT)
+
+    base = inner(index)
+    if kind == "HNSW":
+        base.hnsw.efConstruction = spec.ef_construction
+        base.hnsw.efSearch = spec.ef_search
+    elif isinstance(base, faiss.IndexIVF):
+        base.nprobe = min(spec.nprobe, base.nlist)
+        # Hashtable direct map: reconstruct() by label works, remove_ids()
+        # then needs an IDSelectorArray (see remove_selector)
+        base.set_direct_map_type(faiss.DirectMap.Hashtable)
+    if not index.is_trained:
+        index.train(np.ascontiguousarray(vectors, dtype=np.float32))
+
+    if n:
+        index.add_with_ids(np.ascontiguousarray(vectors, dtype=np.float32), labels)
+    return index
+
+
+def remove_selector(index, labels: np.ndarray):
+    """Selector accepted by index.remove_ids() for this family"""
+    if isinstance(inner(index), faiss.IndexIVF):
+        return faiss.IDSelectorArray(np.ascontiguousarray(labels, dtype=np.int64))
+    return faiss.IDSelectorBatch(labels)
+
+
+def stores_labels(index) -> bool:
+    """Index addresses vectors by label (IDMap2 wrapper or IVF ids)"""
+    return isinstance(index, (faiss.IndexIDMap2, faiss.IndexIVF))
+
+
+def search_params(index, sel=None, ef_search: Optional[int] = None, nprobe: Optional[int] = None):
+    """
+    Fresh SearchParameters for one search (IndexIDMap temporarily swaps
+    params.sel while searching, so they must not be shared across threads).
+    None when neither a selector nor a knob applies.
+    """
+    base = inner(index)
+    if isinstance(base, faiss.IndexHNSW) and ef_search:
+        return faiss.SearchParametersHNSW(sel=sel, efSearch=ef_search) if sel is not None \
+            else faiss.SearchParametersHNSW(efSearch=ef_search)
+    if isinstance(base, faiss.IndexIVF) and (nprobe or sel is not None):
+        # IndexIVF rejects plain SearchParameters; keep the index's nprobe by default
+        nprobe = nprobe or base.nprobe
+        return faiss.SearchParametersIVF(sel=sel, nprobe=nprobe) if sel is not None \
+            else faiss.SearchParametersIVF(nprobe=nprobe)
+    if sel is not None:
+        return faiss.SearchParameters(sel=sel)
+    return None
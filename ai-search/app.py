@@ -12,6 +12,9 @@ logger = logging.getLogger("uvicorn.error")
 AI_EMBED_URL = os.getenv("AI_EMBED_URL")
 FAISS_INDEX_PATH = os.getenv("FAISS_INDEX_PATH")
 INDEX_METADATA_PATH = os.getenv("INDEX_METADATA_PATH")
+# Map the index file read-only instead of copying it into the heap, so
+# replicas on the same host share its pages through the OS page cache
+FAISS_INDEX_MMAP = os.getenv("FAISS_INDEX_MMAP", "0") == "1"
 VECTOR_DIM = int(os.getenv("VECTOR_DIM", "0") or 0)
 PORT = int(os.getenv("PORT", 8089))
 
@@ -21,6 +24,7 @@ app = FastAPI(title="ai-search")
 _index = None
 _index_loaded = False
 _index_ntotal = 0
+_index_mmapped = False  # FAISS_INDEX_MMAP took effect
 _metadata: Optional[Dict[str, Any]] = None
 
 class SearchRequest(BaseModel):
@@ -37,13 +41,25 @@ class SearchResponse(BaseModel):
 
 @app.on_event("startup")
 async def startup_event():
-    global _index, _index_loaded, _index_ntotal, _metadata
+    global _index, _index_loaded, _index_ntotal, _index_mmapped, _metadata
     logger.info(f"Starting ai-search. AI_EMBED_URL={AI_EMBED_URL}, FAISS_INDEX_PATH={FAISS_INDEX_PATH}")
     try:
         import faiss
         # load index if path provided
         if FAISS_INDEX_PATH and os.path.exists(FAISS_INDEX_PATH):
-            _index = faiss.read_index(FAISS_INDEX_PATH)
+            if FAISS_INDEX_MMAP:
+                # IO_FLAG_MMAP_IFC maps the vector codes in place. Older builds only
+                # have IO_FLAG_MMAP, which maps IVF lists but still copies Flat / HNSW
+                # codes onto the heap, so fall back loudly instead of pretending.
+                if hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+                    _index = faiss.read_index(FAISS_INDEX_PATH, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+                    _index_mmapped = True
+                else:
+                    logger.warning("FAISS_INDEX_MMAP=1 but faiss %s has no IO_FLAG_MMAP_IFC: loading the index "
+                                   "into memory (install the pinned faiss-cpu)", faiss.__version__)
+                    _index = faiss.read_index(FAISS_INDEX_PATH)
+            else:
+                _index = faiss.read_index(FAISS_INDEX_PATH)
             _index_loaded = True
             try:
                 _index_ntotal = _index.ntotal
@@ -74,6 +90,7 @@ async def healthz():
         "ready": _index_loaded,
         "index_loaded": _index_loaded,
         "index_path": FAISS_INDEX_PATH,
+        "index_mmap": _index_mmapped,
         "index_size": _index_ntotal,
         "vector_dim": VECTOR_DIM,
     }
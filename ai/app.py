@@ -6,19 +6,41 @@ import json
 import math
 import time
 import hashlib
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from typing import List, Optional, Dict, Any
 
 import numpy as np
 import faiss  # Thư viện tìm kiếm vector của Facebook
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field # Thư viện để định nghĩa API models
-from sentence_transformers import SentenceTransformer # Thư viện model AI
 from dotenv import load_dotenv # Thư viện để tải file .env
 from pathlib import Path
 
 # (Giả sử bạn có file logger này)
 from embedding_logger import logger 
+from embedding_cache import EmbeddingCache, QueryCache
+from encode_batcher import EncodeBatcher
+from encode_pipeline import EncodePipeline, token_lengths
+from upsert_jobs import UpsertJobQueue
+from index_generation import IndexDelta, IndexGeneration
+from index_factory import (IndexSpec, build_index, index_kind, index_storage, is_lossless, needs_rebuild,
+                           remove_selector, stores_labels, vector_bytes)
+from exact_vectors import ExactVectors
+from metadata_store import MetadataStore, content_hash
+from bm25_index import BM25Index
+from geo_index import GeoIndex
+from keyword_index import KeywordIndex, normalize_term, record_of, record_matches
+from metrics import Registry, SIZE_BUCKETS
+from encoders import load_encoder
+from embedding_format import negotiate, render
+from bulk_embed import NDJSONStream, stream_embeddings
+from write_ahead_log import WriteAheadLog, commit_staged, read_marker, seal_staged
 
 # Tải các biến môi trường (ví dụ: PORT) từ file .env
 load_dotenv()
@@ -29,25 +51,134 @@ load_dotenv()
 
 # Tên model AI dùng để tạo embedding
 MODEL_NAME = os.getenv("EMBEDDING_MODEL", "AITeamVN/Vietnamese_Embedding_v2")
+# Backend chạy model: torch (mặc định) | onnx | onnx-int8
+# (ONNX cần export trước: python encoders.py export --out ./onnx_model)
+ENCODER_BACKEND = os.getenv("ENCODER_BACKEND", "torch").lower()
+ENCODER_ONNX_DIR = Path(os.getenv("ENCODER_ONNX_DIR", "./onnx_model"))
+ENCODER_QUANT = os.getenv("ENCODER_QUANT", "avx2")
 # Cổng (port) mà service sẽ chạy
 PORT = int(os.getenv("PORT", "8088"))
-# Loại index FAISS (FLAT = đơn giản nhất, HNSW = nhanh hơn cho
-# dữ liệu lớn)
-INDEX_TYPE = os.getenv("INDEX_TYPE", "FLAT").upper()
+# Loại index FAISS: FLAT (chính xác), HNSW, IVF, IVFPQ (ANN cho dữ liệu lớn);
+# tham số: HNSW_M / HNSW_EF_CONSTRUCTION / HNSW_EF_SEARCH, IVF_NLIST / IVF_NPROBE,
+# PQ_M / PQ_NBITS. Dưới EXACT_SEARCH_THRESHOLD vector thì luôn dùng FLAT
+INDEX_SPEC = IndexSpec.from_env()
+INDEX_TYPE = INDEX_SPEC.kind
+# Nén vector trong index: VECTOR_STORAGE=fp32 | fp16 | sq8 | pq (2x / 4x / PQ_M..).
+# Khi nén, EXACT_RERANK=1 giữ bản float32 trên đĩa (vectors.npy, mmap) để chấm
+# lại chính xác k * RERANK_FACTOR ứng viên đầu
+EXACT_RERANK = INDEX_SPEC.storage != "fp32" and os.getenv("EXACT_RERANK", "1") == "1"
 # Thư mục để lưu trữ các file index
 INDEX_DIR = Path(os.getenv("INDEX_DIR", "./index"))
 # Tạo thư mục index nếu nó chưa tồn tại
 INDEX_DIR.mkdir(exist_ok=True)
+# INDEX_MMAP=1: mmap file index ở chế độ chỉ đọc thay vì copy vào heap,
+# các worker/replica trên cùng máy dùng chung trang nhớ qua page cache
+INDEX_MMAP = os.getenv("INDEX_MMAP", "0") == "1"
+# IO_FLAG_MMAP (faiss cũ) chỉ map inverted list IVF: Flat/HNSW vẫn bị copy
+# hết vào heap, tức INDEX_MMAP không có tác dụng => không khởi động
+if INDEX_MMAP and not hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+    raise RuntimeError(f"INDEX_MMAP=1 needs faiss with IO_FLAG_MMAP_IFC (installed: {faiss.__version__}); "
+                       "install the faiss-cpu version pinned in requirements.txt")
+# File cache embedding (SQLite) và số entry tối đa (LRU); 0 = tắt cache
+EMBED_CACHE_PATH = Path(os.getenv("EMBED_CACHE_PATH", str(INDEX_DIR / "embed_cache.sqlite")))
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "200000"))
+# Cache vector của query (trong RAM): số entry tối đa và TTL (giây)
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "2048"))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "3600"))
+# Gom các lệnh encode đồng thời thành 1 batch: kích thước tối đa và thời gian chờ (ms,
+# chỉ khi có lệnh khác đang chờ; 1 lệnh lẻ được encode ngay); ENCODE_BATCHING=0 để gọi model trực tiếp
+ENCODE_BATCHING = os.getenv("ENCODE_BATCHING", "1") == "1"
+ENCODE_BATCH_SIZE = int(os.getenv("ENCODE_BATCH_SIZE", "32"))
+ENCODE_MAX_WAIT_MS = float(os.getenv("ENCODE_MAX_WAIT_MS", "5"))
+# Encode khối lớn (upsert lớn, dựng lại index): văn bản sắp theo số token rồi
+# chia batch REBUILD_BATCH_SIZE; ENCODE_WORKERS > 0 thì chia cho N tiến trình
+# (mỗi tiến trình tải 1 bản model riêng) khi có từ ENCODE_POOL_MIN văn bản
+REBUILD_BATCH_SIZE = int(os.getenv("REBUILD_BATCH_SIZE", "64"))
+ENCODE_WORKERS = int(os.getenv("ENCODE_WORKERS", "0"))
+ENCODE_POOL_MIN = int(os.getenv("ENCODE_POOL_MIN", "0"))
+# Từ khóa (vibe/avoid, phân tách bằng dấu phẩy) luôn có posting, ngoài các
+# vibe trong payload; từ khóa khác chỉ so khớp chuỗi lúc tìm kiếm
+KEYWORD_TERMS = [t for t in os.getenv("KEYWORD_TERMS", "").split(",") if t.strip()]
+# BM25 (tìm theo từ, bỏ dấu) cho /hybrid-search: tham số k1/b, hằng số k của
+# Reciprocal Rank Fusion và số luồng chạy BM25 song song với encode + FAISS
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", "60"))
+LEXICAL_WORKERS = int(os.getenv("LEXICAL_WORKERS", "4"))
+# Số query tối đa trong 1 request /search/batch, /hybrid-search/batch
+SEARCH_BATCH_MAX = int(os.getenv("SEARCH_BATCH_MAX", "64"))
+# Lưới không gian (độ) cho lọc near/bbox; khi giảm điểm theo khoảng cách
+# thì lấy top_k * GEO_DECAY_FETCH ứng viên rồi xếp hạng lại
+GEO_CELL_DEG = float(os.getenv("GEO_CELL_DEG", "0.05"))
+GEO_DECAY_FETCH = int(os.getenv("GEO_DECAY_FETCH", "4"))
+# /embed/stream: số bản ghi đọc vào rồi sắp theo độ dài trước khi encode
+# (bộ nhớ tối đa ~ 1 cửa sổ), độ dài tối đa của 1 dòng NDJSON
+EMBED_STREAM_WINDOW = int(os.getenv("EMBED_STREAM_WINDOW", "512"))
+EMBED_STREAM_MAX_LINE = int(os.getenv("EMBED_STREAM_MAX_LINE", str(1 << 20)))
+# /delete chỉ đánh dấu (tombstone); khi tỉ lệ tombstone / số vector vượt
+# ngưỡng này thì luồng nền gỡ hẳn chúng khỏi index (compaction)
+TOMBSTONE_COMPACT_RATIO = float(os.getenv("TOMBSTONE_COMPACT_RATIO", "0.2"))
+# Mỗi lần ghi chỉ nối 1 bản ghi vào WAL (index/wal, fsync nếu WAL_FSYNC=1);
+# checkpoint đầy đủ chạy nền khi WAL vượt CHECKPOINT_WAL_BYTES hoặc sau
+# CHECKPOINT_INTERVAL_SEC giây kể từ lần trước (nếu có ghi mới)
+WAL_FSYNC = os.getenv("WAL_FSYNC", "1") == "1"
+CHECKPOINT_WAL_BYTES = int(os.getenv("CHECKPOINT_WAL_BYTES", str(64 << 20)))
+CHECKPOINT_INTERVAL_SEC = float(os.getenv("CHECKPOINT_INTERVAL_SEC", "300"))
+# Upsert không sửa index FAISS mà ghi vào delta (vector float32, chấm điểm
+# vét cạn); checkpoint gộp delta vào index, chạy sớm khi delta đạt ngưỡng này
+INDEX_DELTA_MAX = int(os.getenv("INDEX_DELTA_MAX", "20000"))
+
+# =================== Metrics ===================
+# Histogram độ trễ theo từng bước + bộ đếm, xuất dạng Prometheus ở /metrics
+# ===============================================
+metrics = Registry("travyy_ai")
+REQUEST_SECONDS = metrics.histogram("request_seconds", "HTTP request latency", ("path", "status"))
+STAGE_SECONDS = metrics.histogram(
+    "stage_seconds",
+    "Latency per stage (encode_query, encode_docs, filter, ann incl. exact re-score, rerank, bm25, format, serialize, "
+    "index_update, save, load)",
+    ("stage",),
+)
+BATCH_SIZE = metrics.histogram("batch_size", "Items per batch (model forward pass, batch endpoints, upsert)",
+                               ("kind",), SIZE_BUCKETS)
+CANDIDATES = metrics.histogram("search_candidates", "Vectors left after type/province/geo filters, per query",
+                               buckets=SIZE_BUCKETS)
+FILTERED_OUT = metrics.counter("search_filtered_out_total", "Vectors excluded by filters, summed over queries")
+FETCHED = metrics.counter("search_fetched_total", "Candidates fetched from FAISS (k per query)")
+
+class TimedJSONResponse(JSONResponse):
+    """JSONResponse ghi lại thời gian serialize vào stage_seconds"""
+    def render(self, content: Any) -> bytes:
+        with STAGE_SECONDS.time(stage="serialize"):
+            return super().render(content)
 
 # =================== FastAPI App ===================
 # Khởi tạo ứng dụng web API
 # ===============================================
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Tải model + index khi server khởi động (không phải lúc import module)."""
+    startup()
+    yield
+
 app = FastAPI(
     title="Touring Embedding Service",
     description="Vietnamese semantic search for travel zones & POIs",
-    version="2.0"
+    version="2.0",
+    default_response_class=TimedJSONResponse,
+    lifespan=lifespan
 )
 
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    """Thời gian toàn request (kể cả serialize), theo route (không theo URL cụ thể)"""
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    REQUEST_SECONDS.observe(time.perf_counter() - start,
+                            path=route.path if route is not None else "unmatched", status=response.status_code)
+    return response
+
 # Cấu hình CORS (Cross-Origin Resource Sharing)
 # Cho phép các trang web khác (ví dụ: React app) gọi API này
 app.add_middleware(
@@ -63,63 +194,327 @@ app.add_middleware(
 )
 
 # =================== Load Model ===================
-# Tải model AI khi service khởi động
+# Tải model AI khi service khởi động (load_model(), gọi từ startup())
 # ===============================================
-print(f"📦 Loading model: {MODEL_NAME}")
-t0 = time.time()
-# Đây là lúc model AI được tải vào bộ nhớ (RAM/VRAM)
-model = SentenceTransformer(MODEL_NAME)
-# Tự động phát hiện số chiều vector từ model (không hardcode)
-DIM = model.get_sentence_embedding_dimension()
-print(f"✅ Model loaded in {time.time() - t0:.2f}s | dim={DIM}")
+model = None
+DIM: int = None
+embed_cache: Optional[EmbeddingCache] = None
+batcher: Optional[EncodeBatcher] = None
+encode_fn = None
+encode_pipeline: EncodePipeline = None
+
+# Cache embedding trên đĩa: cùng model + cùng văn bản => không encode lại
+# (vector ONNX/int8 hơi khác torch, và int8 khác nhau theo ENCODER_QUANT,
+# nên backend / kiểu lượng tử hóa là một phần của khóa)
+if ENCODER_BACKEND == "torch":
+    CACHE_MODEL_KEY = MODEL_NAME
+elif ENCODER_BACKEND == "onnx-int8":
+    CACHE_MODEL_KEY = f"{MODEL_NAME}#{ENCODER_BACKEND}#{ENCODER_QUANT}"
+else:
+    CACHE_MODEL_KEY = f"{MODEL_NAME}#{ENCODER_BACKEND}"
+
+def model_encode(texts: List[str]) -> np.ndarray:
+    """Gọi model AI trực tiếp (vector đã chuẩn hóa)."""
+    BATCH_SIZE.observe(len(texts), kind="encode")
+    return model.encode(
+        texts,
+        normalize_embeddings=True, # Rất quan trọng cho IndexFlatIP
+        show_progress_bar=False,
+        convert_to_numpy=True
+    )
+
+def load_model():
+    """Tải model, mở cache embedding và dựng batcher / pipeline encode."""
+    global model, DIM, embed_cache, batcher, encode_fn, encode_pipeline
+    print(f"📦 Loading model: {MODEL_NAME} ({ENCODER_BACKEND})")
+    t0 = time.time()
+    # Đây là lúc model AI được tải vào bộ nhớ (RAM/VRAM)
+    model = load_encoder(MODEL_NAME, ENCODER_BACKEND, ENCODER_ONNX_DIR, ENCODER_QUANT)
+    # Tự động phát hiện số chiều vector từ model (không hardcode)
+    DIM = model.get_sentence_embedding_dimension()
+    print(f"✅ Model loaded in {time.time() - t0:.2f}s | dim={DIM}")
+
+    embed_cache = EmbeddingCache(EMBED_CACHE_PATH, CACHE_MODEL_KEY, EMBED_CACHE_SIZE) if EMBED_CACHE_SIZE > 0 else None
+
+    # Mọi request đều encode qua 1 luồng duy nhất, gom thành batch
+    # (tránh N lần forward pass + tranh chấp thread pool của torch)
+    batcher = EncodeBatcher(model_encode, ENCODE_BATCH_SIZE, ENCODE_MAX_WAIT_MS) if ENCODE_BATCHING else None
+    encode_fn = batcher.encode if batcher else model_encode
+
+    # Encode khối lớn: batch theo độ dài token, tùy chọn nhiều tiến trình
+    encode_pipeline = EncodePipeline(
+        encode_fn, REBUILD_BATCH_SIZE, ENCODE_WORKERS,
+        model_args=(MODEL_NAME, ENCODER_BACKEND, ENCODER_ONNX_DIR, ENCODER_QUANT),
+        length_fn=token_lengths(model), min_parallel=ENCODE_POOL_MIN,
+    )
+
+# Cache query dùng chung cho /search và /hybrid-search
+query_cache = QueryCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+
+def encode_query(text: str) -> np.ndarray:
+    """Embed 1 query (shape 1 x DIM), dùng lại vector nếu query đã gặp."""
+    with STAGE_SECONDS.time(stage="encode_query"):
+        return query_cache.encode(text, encode_fn).reshape(1, -1)
+
+def encode_queries(texts: List[str]) -> np.ndarray:
+    """Embed nhiều query (shape N x DIM); các query chưa có trong cache encode chung 1 lần."""
+    with STAGE_SECONDS.time(stage="encode_query"):
+        return query_cache.encode_many(texts, encode_fn)
+
+def encode_texts(texts: List[str], encoder=None) -> np.ndarray:
+    """Embed văn bản, tra cache trước khi gọi model."""
+    encoder = encoder or encode_fn
+    with STAGE_SECONDS.time(stage="encode_docs"):
+        if embed_cache is None:
+            return encoder(texts)
+        return embed_cache.encode(texts, encoder)
 
 # =================== FAISS Index ===================
 # Khởi tạo "database" vector (FAISS) và metadata
 # ===============================================
 
-# 'index' sẽ lưu các vector
-index = None 
-# 'metadata' sẽ lưu thông tin đi kèm (id, text, payload)
-metadata = [] 
+# 'generation' là snapshot bất biến gồm index (vector, gắn label ổn định
+# qua IndexIDMap2) + metadata (id, text, payload theo label) + bảng lọc.
+# Request đọc lấy 'generation' MỘT lần rồi chỉ dùng object đó; luồng ghi
+# dựng generation mới ở bên cạnh rồi gán lại tham chiếu (atomic), nên
+# không bao giờ ghép index mới với metadata cũ và không cần khóa khi đọc.
+generation: IndexGeneration = None
+
+def label_for(item_id: str) -> int:
+    """Label FAISS (int64 dương) ổn định, suy ra từ id dạng chuỗi."""
+    digest = hashlib.blake2b(item_id.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") & 0x7FFFFFFFFFFFFFFF
+
+def new_index(vectors: Optional[np.ndarray] = None, labels: Optional[np.ndarray] = None):
+    """
+    Tạo index theo INDEX_SPEC (họ index chọn theo số vector: ít hơn
+    EXACT_SEARCH_THRESHOLD thì FLAT), huấn luyện nếu cần và thêm vector.
+    """
+    return build_index(DIM, INDEX_SPEC, vectors, labels)
+
+def new_lexical() -> BM25Index:
+    """Tạo index BM25 rỗng với tham số k1/b từ cấu hình."""
+    return BM25Index(k1=BM25_K1, b=BM25_B)
+
+def new_geo() -> GeoIndex:
+    """Tạo lưới không gian rỗng với kích thước ô từ cấu hình."""
+    return GeoIndex(cell_deg=GEO_CELL_DEG)
+
+def publish(gen: IndexGeneration):
+    """Công bố generation mới cho các request đọc (1 phép gán tham chiếu)."""
+    global generation
+    generation = gen
+
+# /delete công bố generation (chỉ thêm tombstone) mà không chờ khóa ghi;
+# mọi lần công bố khác cũng giữ khóa này để gộp tombstone đã có
+tombstone_lock = threading.Lock()
+# Label bị /delete khi item của nó nằm trong batch upsert đang dựng (chưa
+# có trong index để tombstone): batch đó tombstone chúng lúc công bố
+late_deletes: set = set()
+
+def merged_tombstones(base: IndexGeneration, metadata: MetadataStore, written: np.ndarray) -> np.ndarray:
+    """
+    Tombstone cho generation dựng từ `base` (gọi khi giữ tombstone_lock):
+    tombstone của base trừ các label vừa ghi lại / gỡ hẳn, cộng tombstone
+    được /delete thêm trong lúc dựng, chỉ giữ label còn trong metadata.
+    """
+    kept = np.setdiff1d(base.tombstones, written)
+    extra = np.setdiff1d(generation.tombstones, base.tombstones)
+    tombstones = np.union1d(kept, extra).astype(np.int64)
+    return tombstones[metadata.contains(tombstones)]
+
+# WAL: bản ghi được nối (và fsync) khi giữ tombstone_lock, ngay trước khi
+# công bố generation tương ứng, nên thứ tự trong log = thứ tự công bố
+# (mở trong startup())
+wal: WriteAheadLog = None
+checkpoint_wake = threading.Event()
+CHECKPOINT_STAGING = "checkpoint.tmp"
+CHECKPOINT_MARKER = "checkpoint.json"
+
+def log_write(record: Dict[str, Any]):
+    """Nối 1 thao tác ghi vào WAL; WAL quá lớn thì đánh thức luồng checkpoint."""
+    with STAGE_SECONDS.time(stage="wal_append"):
+        wal.append(record)
+    if wal.pending_bytes >= CHECKPOINT_WAL_BYTES:
+        checkpoint_wake.set()
+
+def read_index_file(path: Path):
+    """Đọc file index; với INDEX_MMAP thì map vào bộ nhớ (chỉ đọc, không copy)."""
+    if not INDEX_MMAP:
+        return faiss.read_index(str(path))
+    # IO_FLAG_MMAP_IFC: map trực tiếp mã vector (Flat, HNSW storage, IVF list)
+    flags = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+    return faiss.read_index(str(path), flags)
+
+def writable_copy(index):
+    """Bản sao riêng (sở hữu bộ nhớ) của index để gộp delta khi checkpoint."""
+    if INDEX_MMAP:
+        # clone_index của index mmap chỉ là "view" lên file, không sửa được
+        return faiss.deserialize_index(faiss.serialize_index(index))
+    return faiss.clone_index(index)
+
+def remap_generation(gen: IndexGeneration):
+    """
+    Sau checkpoint: thay metadata (segment trong heap của các upsert từ lần
+    trước, gồm cả bản ghi đã bị thay thế) và vector float32 bằng bản mmap từ
+    file vừa ghi; với INDEX_MMAP cả index, để tiến trình quay lại dùng chung
+    trang nhớ với các worker khác. Giữ số generation / tombstone đang công
+    bố (/delete có thể vừa chen vào); bỏ qua nếu đã có lần ghi mới hơn checkpoint.
+    """
+    index = read_index_file(INDEX_DIR / "faiss.index") if INDEX_MMAP else gen.index
+    metadata = MetadataStore.load(INDEX_DIR)
+    exact = ExactVectors.load(INDEX_DIR) if gen.exact is not None else None
+    with tombstone_lock:
+        current = generation
+        if current.index is not gen.index or current.metadata is not gen.metadata:
+            return
+        remapped = IndexGeneration(current.number, index, metadata, gen.keywords, gen.lexical, exact,
+                                   gen.geo, current.tombstones)
+        remapped.created_at = current.created_at
+        publish(remapped)
 
 def load_index():
-    """Hàm tải index và metadata từ file."""
-    global index, metadata
+    """
+    Tải checkpoint mới nhất (hoàn tất checkpoint dở dang nếu đã niêm phong)
+    rồi chạy lại các bản ghi WAL sau nó. Số generation tiếp tục từ trước
+    khi tắt (mỗi lần công bố = 1 bản ghi WAL), để base_generation của
+    manifest cũ không trùng nhầm với trạng thái khác của index.
+    """
+    global last_checkpoint
+    with STAGE_SECONDS.time(stage="load"):
+        commit_staged(INDEX_DIR / CHECKPOINT_STAGING, INDEX_DIR, CHECKPOINT_MARKER)
+        info = read_marker(INDEX_DIR, CHECKPOINT_MARKER)
+        _load_index(info.get("generation", 0))
+    last_checkpoint = {**info, "seq": info.get("seq", 0), "at": time.time()}
+    # WAL mất / đã cắt hết: số thứ tự tiếp tục sau checkpoint
+    wal.advance(last_checkpoint["seq"])
+    with STAGE_SECONDS.time(stage="replay"):
+        replayed = replay_wal(last_checkpoint["seq"])
+    if replayed:
+        # Chạy lại đã gộp các bản ghi: đặt lại số như lúc từng bản ghi được công bố
+        gen = generation
+        publish(IndexGeneration(info.get("generation", 0) + replayed, gen.index, gen.metadata, gen.keywords,
+                                gen.lexical, gen.exact, gen.geo, gen.tombstones, gen.delta))
+        print(f"♻️ Replayed {replayed} WAL records (seq > {last_checkpoint['seq']}): {generation.ntotal} vectors, "
+              f"generation {generation.number}")
+
+def _load_index(number: int = 0):
     idx_path = INDEX_DIR / "faiss.index" # Đường dẫn file vector
-    meta_path = INDEX_DIR / "meta.json"   # Đường dẫn file metadata
+    meta_path = INDEX_DIR / "meta.json"   # Metadata định dạng cũ (JSON)
+    
+    # Tải metadata dạng cột (meta.npz + meta.blob, blob được mmap)
+    items = []
+    metadata = MetadataStore.load(INDEX_DIR)
+    if metadata is None:
+        # Chưa có: đọc meta.json cũ (nếu có) và chuyển sang dạng cột
+        if meta_path.exists():
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                items = json.load(f)
+            print(f"🔁 Converting {len(items)} items from {meta_path}")
+        for m in items:
+            m.setdefault("label", label_for(m["id"]))
+        metadata = MetadataStore.from_items(items)
     
     # Tải file index (vector)
     if idx_path.exists():
-        print(f"📂 Loading index from {idx_path}")
-        index = faiss.read_index(str(idx_path))
+        print(f"📂 Loading index from {idx_path}{' (mmap)' if INDEX_MMAP else ''}")
+        index = read_index_file(idx_path)
+        if not stores_labels(index):
+            # Định dạng cũ: vector theo vị trí trong meta.json,
+            # chuyển sang index theo label mà không cần embed lại
+            vecs = index.reconstruct_n(0, index.ntotal)
+            labels = np.array([m["label"] for m in items[:len(vecs)]], dtype=np.int64)
+            index = new_index(vecs, labels)
+            print(f"🔁 Migrated {index.ntotal} vectors to {index_kind(index)} (by label)")
     else:
         # Nếu không có file, tạo index mới
-        print(f"🆕 Creating new {INDEX_TYPE} index")
-        if INDEX_TYPE == "HNSW":
-            index = faiss.IndexHNSWFlat(DIM, 32)
-        else:
-            # IndexFlatIP = So khớp (Inner Product),
-            # dùng cho vector đã chuẩn hóa (normalized)
-            index = faiss.IndexFlatIP(DIM)
+        index = new_index()
+        print(f"🆕 Creating new {index_kind(index)} index (INDEX_TYPE={INDEX_TYPE})")
     
-    # Tải file metadata (json)
-    if meta_path.exists():
-        with open(meta_path, 'r', encoding='utf-8') as f:
-            metadata.extend(json.load(f))
+    # Posting từ khóa (keywords.npz); chưa có thì dựng 1 lần từ metadata
+    keywords = KeywordIndex.load(INDEX_DIR, KEYWORD_TERMS)
+    if keywords is None:
+        keywords = KeywordIndex(terms=KEYWORD_TERMS).with_changes(
+            np.zeros(0, dtype=np.int64), map(record_of, metadata.items()))
+        print(f"🔁 Built keyword index: {len(keywords)} terms")
+    elif not keywords.terms <= set(keywords.postings):
+        # KEYWORD_TERMS có từ mới: quét metadata 1 lần cho các từ đó
+        keywords = keywords.with_changes(np.zeros(0, dtype=np.int64), [], map(record_of, metadata.items()))
+    # Index BM25 (bm25.npz); chưa có thì dựng 1 lần từ metadata
+    lexical = BM25Index.load(INDEX_DIR, BM25_K1, BM25_B)
+    if lexical is None:
+        lexical = new_lexical().with_changes([], ((m["label"], m["text"]) for m in metadata.items()))
+        print(f"🔁 Built BM25 index: {len(lexical)} docs, {len(lexical.postings)} terms")
+    # Lưới không gian (geo.npz) từ center/radiusM/poly/geometry trong payload
+    geo = GeoIndex.load(INDEX_DIR, GEO_CELL_DEG)
+    if geo is None:
+        geo = new_geo().with_changes(np.zeros(0, dtype=np.int64), ((m["label"], m["payload"]) for m in metadata.items()))
+        print(f"🔁 Built geo index: {len(geo)} located items")
     
-    print(f"✅ Index ready: {index.ntotal} vectors, {len(metadata)} metadata")
+    # Vector float32 (vectors.npy, mmap, ghi cùng checkpoint) để chấm lại khi
+    # index nén; chỉ khi thiếu / lệch metadata (index cũ, vừa bật
+    # EXACT_RERANK) mới dựng từ index (có thể đã mất mát nếu đã nén)
+    exact = None
+    if EXACT_RERANK:
+        exact = ExactVectors.load(INDEX_DIR)
+        if exact is None or not np.array_equal(exact.labels, metadata.labels):
+            ExactVectors.empty(DIM).save(INDEX_DIR, metadata.labels, fallback=index.reconstruct_batch)
+            exact = ExactVectors.load(INDEX_DIR)
+            print(f"🔁 Wrote {len(exact)} exact vectors{'' if is_lossless(index) else ' (from compressed codes)'}")
+    
+    # Tombstone chưa compaction (tombstones.npy), bỏ label không còn trong metadata
+    tombstones = None
+    if (INDEX_DIR / "tombstones.npy").exists():
+        tombstones = np.load(INDEX_DIR / "tombstones.npy").astype(np.int64)
+        tombstones = tombstones[metadata.contains(tombstones)]
+    
+    publish(IndexGeneration(number, index, metadata, keywords, lexical, exact, geo, tombstones))
+    print(f"✅ Index ready: {index.ntotal} vectors, {len(metadata)} metadata, {len(keywords)} keywords, "
+          f"{len(generation.tombstones)} tombstones")
 
-def save_index():
-    """Hàm lưu index và metadata hiện tại ra file."""
-    # Lưu index vector
-    faiss.write_index(index, str(INDEX_DIR / "faiss.index"))
-    # Lưu metadata (dạng JSON)
-    with open(INDEX_DIR / "meta.json", 'w', encoding='utf-8') as f:
-        json.dump(metadata, f, ensure_ascii=False, indent=2)
-    print(f"💾 Saved: {index.ntotal} vectors")
+def save_index(gen: IndexGeneration, seq: int):
+    """
+    Checkpoint: ghi toàn bộ generation (đã gồm WAL tới `seq`, delta đã gộp
+    vào index) vào thư mục tạm, fsync, niêm phong bằng checkpoint.json rồi
+    mới đổi tên từng file vào INDEX_DIR. Crash trước khi niêm phong: checkpoint cũ còn nguyên;
+    sau đó: load_index hoàn tất việc đổi tên. Tiến trình đang mmap file cũ
+    vẫn đọc được bản cũ (cùng inode) cho tới khi map lại.
+    """
+    if len(gen.delta) or len(gen.delta.shadowed):
+        # faiss.index chỉ chứa gen.index: vector trong delta sẽ mất khi WAL bị cắt
+        raise ValueError(f"Generation {gen.number} has {len(gen.delta)} unfolded delta vectors; "
+                         "fold_delta() before saving")
+    with STAGE_SECONDS.time(stage="save"):
+        staging = INDEX_DIR / CHECKPOINT_STAGING
+        commit_staged(staging, INDEX_DIR, CHECKPOINT_MARKER)  # bỏ checkpoint dở dang
+        staging.mkdir()
+        faiss.write_index(gen.index, str(staging / "faiss.index"))
+        # Metadata dạng cột (xuất JSON: python metadata_store.py ./index)
+        gen.metadata.save(staging)
+        gen.keywords.save(staging)
+        gen.lexical.save(staging)
+        gen.geo.save(staging)
+        if gen.exact is not None:
+            gen.exact.save(staging, gen.metadata.labels, fallback=gen.index.reconstruct_batch)
+        with open(staging / "tombstones.npy", "wb") as f:
+            np.save(f, gen.tombstones)
+        seal_staged(staging, CHECKPOINT_MARKER, {"seq": seq, "generation": gen.number, "vectors": gen.ntotal,
+                                                 "tombstones": len(gen.tombstones), "saved_at": time.time()})
+        commit_staged(staging, INDEX_DIR, CHECKPOINT_MARKER)
+    print(f"💾 Checkpoint: {gen.ntotal} vectors (generation {gen.number}, WAL seq {seq})")
 
-# Chạy hàm load_index() ngay khi service khởi động
-load_index()
+def remove_labels(index, labels: np.ndarray):
+    """Xóa các vector theo label khỏi index (bản sao riêng của luồng ghi)."""
+    if len(labels) == 0:
+        return index
+    try:
+        index.remove_ids(remove_selector(index, labels))
+        return index
+    except RuntimeError:
+        # HNSW không hỗ trợ remove_ids: dựng lại index từ các vector
+        # còn lại (reconstruct), KHÔNG gọi lại model
+        keep = np.setdiff1d(faiss.vector_to_array(index.id_map), labels)
+        return new_index(index.reconstruct_batch(keep) if len(keep) else None, keep)
 
 # =================== Models ===================
 # Định nghĩa cấu trúc dữ liệu cho các request API
@@ -135,11 +530,28 @@ class UpsertItem(BaseModel):
     type: str
     text: str # Văn bản dùng để tạo vector
     payload: Optional[Dict[str, Any]] = None # Dữ liệu đi kèm
+    hash: Optional[str] = None # Hash nội dung do client tính (so với /sync/manifest)
 
 class UpsertRequest(BaseModel):
     """Input cho /upsert"""
     items: List[UpsertItem]
 
+class DeleteRequest(BaseModel):
+    """Input cho /delete: id cần xóa (id không có trong index thì bỏ qua)"""
+    ids: List[str] = Field(..., min_length=1)
+
+class SyncApplyRequest(BaseModel):
+    """Input cho /sync/apply: chỉ phần thay đổi so với generation base_generation"""
+    base_generation: int
+    upsert: List[UpsertItem] = []
+    delete: List[str] = []
+
+class GeoNear(BaseModel):
+    """Điểm tham chiếu vị trí; radius_m = None thì chỉ dùng để tính khoảng cách"""
+    lat: float = Field(..., ge=-90, le=90)
+    lng: float = Field(..., ge=-180, le=180)
+    radius_m: Optional[float] = Field(None, gt=0)
+
 class SearchRequest(BaseModel):
     """Input cho /search (tìm kiếm đơn giản)"""
     query: str
@@ -147,6 +559,15 @@ class SearchRequest(BaseModel):
     filter_type: Optional[str] = None
     filter_province: Optional[str] = None
     min_score: Optional[float] = 0.0
+    # Núm recall/độ trễ cho index ANN (mặc định: HNSW_EF_SEARCH / IVF_NPROBE)
+    ef_search: Optional[int] = Field(None, ge=1, le=4096)
+    nprobe: Optional[int] = Field(None, ge=1, le=65536)
+    # Lọc theo vị trí (trước khi chấm điểm vector): vòng tròn near hoặc
+    # bbox [min_lat, min_lng, max_lat, max_lng]; distance_decay_m (cần near)
+    # nhân điểm với exp(-khoảng cách / distance_decay_m)
+    near: Optional[GeoNear] = None
+    bbox: Optional[List[float]] = Field(None, min_length=4, max_length=4)
+    distance_decay_m: Optional[float] = Field(None, gt=0)
 
 class HybridSearchRequest(BaseModel):
     """Input cho /hybrid-search (tìm kiếm nâng cao)"""
@@ -157,6 +578,20 @@ class HybridSearchRequest(BaseModel):
     filter_type: Optional[str] = None
     filter_province: Optional[str] = None
     boost_vibes: float = Field(1.2, ge=1.0, le=2.0)
+    lexical: bool = False # True = kết hợp thêm BM25 (RRF), "score" là điểm RRF
+    ef_search: Optional[int] = Field(None, ge=1, le=4096)
+    nprobe: Optional[int] = Field(None, ge=1, le=65536)
+    near: Optional[GeoNear] = None
+    bbox: Optional[List[float]] = Field(None, min_length=4, max_length=4)
+    distance_decay_m: Optional[float] = Field(None, gt=0)
+
+class BatchSearchRequest(BaseModel):
+    """Input cho /search/batch: mỗi query có bộ lọc riêng"""
+    queries: List[SearchRequest] = Field(..., min_length=1, max_length=SEARCH_BATCH_MAX)
+
+class BatchHybridSearchRequest(BaseModel):
+    """Input cho /hybrid-search/batch"""
+    queries: List[HybridSearchRequest] = Field(..., min_length=1, max_length=SEARCH_BATCH_MAX)
 
 # =================== Endpoints ===================
 # Các API (route) của service
@@ -169,301 +604,970 @@ def root():
         "service": "Touring Embedding API",
         "version": "2.0",
         "model": MODEL_NAME,
-        "endpoints": ["/healthz", "/embed", "/search", "/hybrid-search", "/upsert"]
+        "endpoints": ["/healthz", "/embed", "/search", "/hybrid-search",
+                      "/search/batch", "/hybrid-search/batch", "/upsert", "/delete", "/jobs/{job_id}", "/checkpoint", "/metrics"]
     }
 
 @app.get("/healthz")
 def health():
     """Endpoint kiểm tra "sức khỏe" của service."""
+    gen = generation
     return {
         "status": "ok",
         "model": MODEL_NAME,
-        "index_type": INDEX_TYPE,
-        "vectors": index.ntotal, # Số vector đang có
-        "metadata": len(metadata) # Số metadata đang có
+        "encoder_backend": ENCODER_BACKEND,
+        "index_type": index_kind(gen.index),
+        "index_mmap": INDEX_MMAP,
+        "vectors": gen.ntotal, # Số vector đang có
+        "metadata": len(gen.metadata), # Số metadata đang có
+        "tombstones": len(gen.tombstones), # Đã xóa, chờ compaction
+        "generation": gen.number
     }
 
 @app.get("/stats")
 def stats():
     """Endpoint xem thống kê chi tiết của index."""
+    gen = generation
     return {
-        "vectors": index.ntotal,
-        "metadata": len(metadata),
+        "vectors": gen.ntotal,
+        "metadata": len(gen.metadata),
+        "tombstones": len(gen.tombstones),
+        "tombstone_ratio": round(len(gen.tombstones) / gen.ntotal, 4) if gen.ntotal else 0.0,
+        "compactions": compactions,
+        "generation": gen.number,
+        "generation_age_sec": round(time.time() - gen.created_at, 1),
+        "metadata_counts": gen.metadata.counts(),
         "dimension": DIM,
-        "index_type": INDEX_TYPE
+        "index_type": index_kind(gen.index),
+        "index_config": {**vars(INDEX_SPEC), "kind": INDEX_TYPE},
+        "vector_storage": index_storage(gen.index),
+        "vector_bytes": vector_bytes(gen.index),
+        "delta_vectors": len(gen.delta),
+        "exact_rerank": gen.exact is not None,
+        "geo_items": len(gen.geo),
+        "embed_cache": embed_cache.stats() if embed_cache else None,
+        "query_cache": query_cache.stats(),
+        "encode_batcher": batcher.stats() if batcher else None,
+        "encode_pipeline": encode_pipeline.stats(),
+        "upsert_jobs_pending": upsert_jobs.pending(),
+        "wal": wal.stats(),
+        "checkpoint": {k: v for k, v in last_checkpoint.items() if k != "at"},
+        "logger": logger.stats()
     }
 
+def service_samples():
+    """Giá trị đã có sẵn ở nơi khác (cache, generation, hàng đợi), đọc lúc scrape"""
+    gen = generation
+    samples = [
+        ("index_generation", "gauge", "Number of the published index generation", [({}, gen.number)]),
+        ("index_generation_age_seconds", "gauge", "Age of the published generation", [({}, time.time() - gen.created_at)]),
+        ("index_vectors", "gauge", "Vectors in the published generation", [({}, gen.ntotal)]),
+        ("index_tombstones", "gauge", "Deleted vectors awaiting compaction", [({}, len(gen.tombstones))]),
+        ("index_compactions_total", "counter", "Tombstone compactions run", [({}, compactions)]),
+        ("query_cache_hits_total", "counter", "Query vector cache hits", [({}, query_cache.hits)]),
+        ("query_cache_misses_total", "counter", "Query vector cache misses", [({}, query_cache.misses)]),
+        ("upsert_jobs_pending", "gauge", "Upsert jobs waiting for the writer", [({}, upsert_jobs.pending())]),
+        ("wal_pending_bytes", "gauge", "WAL bytes not yet covered by a checkpoint", [({}, wal.pending_bytes)]),
+        ("wal_appends_total", "counter", "Records appended to the WAL", [({}, wal.appends)]),
+        ("checkpoint_seq", "gauge", "Last WAL sequence number in the on-disk checkpoint",
+         [({}, last_checkpoint["seq"])]),
+        ("log_dropped_total", "counter", "Log entries dropped from the full logger buffer", [({}, logger.dropped)]),
+    ]
+    if embed_cache is not None:
+        samples += [
+            ("embed_cache_hits_total", "counter", "Document embedding cache hits", [({}, embed_cache.hits)]),
+            ("embed_cache_misses_total", "counter", "Document embedding cache misses", [({}, embed_cache.misses)]),
+        ]
+    if batcher is not None:
+        samples.append(("encode_queue_depth", "gauge", "Texts waiting for the encode batcher",
+                        [({}, batcher.stats()["queued"])]))
+    return samples
+
+metrics.collector(service_samples)
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """Metrics dạng Prometheus text (histogram độ trễ theo bước, bộ đếm)."""
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.post("/embed")
-def embed(req: EmbedRequest):
-    """Endpoint để biến văn bản (text) thành vector (embedding)."""
+def embed(req: EmbedRequest, request: Request, format: Optional[str] = None, dtype: Optional[str] = None):
+    """
+    Endpoint để biến văn bản (text) thành vector (embedding).
+    Định dạng trả về: JSON (mặc định), binary float32/float16 hoặc base64
+    (?format= / ?dtype= hoặc header Accept, xem embedding_format.py).
+    """
+    fmt, dt = negotiate(request.headers.get("accept"), format, dtype)
     try:
-        # Dùng model AI để mã hóa văn bản
-        embeddings = model.encode(
-            req.texts,
-            normalize_embeddings=True, # Rất quan trọng cho IndexFlatIP
-            show_progress_bar=False,
-            convert_to_numpy=True
-        )
-        return {
-            "embeddings": embeddings.tolist(),
+        # Dùng model AI để mã hóa văn bản (qua cache)
+        embeddings = encode_texts(req.texts)
+        return render(embeddings, fmt, dt, "embeddings", {
             "dimension": embeddings.shape[1],
             "count": len(req.texts)
-        }
+        })
     except Exception as e:
         raise HTTPException(500, f"Embedding failed: {str(e)}")
 
-@app.post("/upsert")
-def upsert(req: UpsertRequest):
+@app.post("/embed/stream")
+async def embed_stream(request: Request):
     """
-    Endpoint thêm/cập nhật dữ liệu vào index.
-    Chiến lược: Xây dựng lại toàn bộ (Rebuild).
+    Embed hàng loạt không giới hạn số văn bản: body NDJSON {id, text} mỗi dòng
+    (có thể gửi chunked), trả về NDJSON từng dòng {id, embedding} ngay khi
+    mỗi batch encode xong (xem bulk_embed.py). Encode chạy trong thread pool
+    nên không chặn event loop.
+    """
+    async def encode(texts: List[str]) -> np.ndarray:
+        BATCH_SIZE.observe(len(texts), kind="stream")
+        return await run_in_threadpool(encode_texts, texts)
+
+    return NDJSONStream(
+        stream_embeddings(request.stream(), encode, EMBED_STREAM_WINDOW, ENCODE_BATCH_SIZE, EMBED_STREAM_MAX_LINE))
+
+def encode_chunked(texts: List[str]) -> np.ndarray:
+    """
+    Encode khối lớn qua encode_pipeline: batch gồm các văn bản dài gần bằng
+    nhau (ít padding), trả về đúng thứ tự đầu vào. Chạy trong tiến trình thì
+    từng batch đi qua encoder chung để các query đang chờ được phục vụ xen
+    kẽ khi đang đồng bộ lớn.
+    """
+    return encode_pipeline.encode(texts)
+
+def apply_upsert(items: List[UpsertItem], progress=lambda stage: None, deleted: List[str] = (),
+                 log_wal: bool = True) -> Dict[str, Any]:
+    """
+    Thêm/cập nhật item vào index (chạy trên luồng ghi duy nhất).
+    Chiến lược: Cập nhật tăng dần (Incremental) - chỉ embed các item gửi lên,
+    thay thế vector theo label ổn định, không đụng tới phần còn lại.
+    `deleted`: id cần xóa khỏi index (từ /sync/apply, compaction tombstone).
+    Bền vững nhờ 1 bản ghi WAL (log_wal=False khi đang chạy lại WAL);
+    file index chỉ được ghi lại khi checkpoint.
     """
     try:
-        global metadata, index
-        
         logger.start_operation("Upsert")
-        logger.log_upsert_start(os.getenv("AI_EMBED_URL", "https://ai-embed.travvytouring.page") + "/upsert", len(req.items))
-        
-        # --- Step 1: Cập nhật metadata ---
-        # Tạo 1 set chứa các ID mới (để tìm kiếm nhanh)
-        ids_set = {item.id for item in req.items}
-        
-        # Lọc danh sách metadata cũ, giữ lại những item
-        # KHÔNG CÓ ID trùng với ID mới
-        old_count = len(metadata)
-        metadata = [m for m in metadata if m["id"] not in ids_set]
-        removed = old_count - len(metadata)
+        logger.log_upsert_start(os.getenv("AI_EMBED_URL", "https://ai-embed.travvytouring.page") + "/upsert", len(items))
         
-        logger.log_metadata_update(removed, len(req.items), old_count, len(metadata))
+        # Generation hiện tại; chỉ luồng ghi này tạo generation kế tiếp
+        base = generation
+        BATCH_SIZE.observe(len(items), kind="upsert")
         
-        # --- Step 2: Thêm item mới vào metadata ---
-        new_items = []
-        for item in req.items:
-            new_items.append({
-                "id": item.id,
-                "type": item.type,
-                "text": item.text,
-                "payload": item.payload or {}
-            })
+        # --- Step 1: Gom item theo id (item sau ghi đè item trước) ---
+        items = {item.id: item for item in items}
+        labels = np.array([label_for(item_id) for item_id in items], dtype=np.int64)
         
-        metadata.extend(new_items) # Thêm list item mới vào list metadata
+        # Các label đã có trong index -> sẽ bị thay thế
+        old_count = len(base.metadata)
+        replaced = labels[base.metadata.contains(labels)]
+        # Id bị xóa (bỏ qua id không có trong index hoặc cũng được upsert lại)
+        gone = np.array([label_for(i) for i in set(deleted) - set(items)], dtype=np.int64)
+        gone = gone[base.metadata.contains(gone)]
+        removed = np.concatenate([replaced, gone])
         
-        # --- Step 3: Xây dựng lại (Rebuild) toàn bộ index FAISS ---
-        if len(metadata) == 0:
-            # Nếu không có metadata, tạo index rỗng
-            index = faiss.IndexFlatIP(DIM)
-            logger.log(" [Upsert] Created empty index")
-        else:
-            # Nếu có metadata
-            # Lấy TOÀN BỘ văn bản từ metadata
-            all_texts = [m.get("text", "") for m in metadata]
-            
-            # Dùng model AI tạo lại embedding cho TOÀN BỘ văn bản
-            logger.log_embedding_start(len(all_texts))
+        # --- Step 2: Chỉ embed văn bản của các item được gửi lên ---
+        progress("embedding")
+        texts = [item.text for item in items.values()]
+        if texts:
+            logger.log_embedding_start(len(texts))
             embed_start = time.time()
-            all_embeddings = model.encode(
-                all_texts,
-                normalize_embeddings=True,
-                show_progress_bar=False,
-                convert_to_numpy=True
-            )
+            embeddings = encode_texts(texts, encode_chunked)
             embed_duration = time.time() - embed_start
-            logger.log_embedding_complete(len(all_texts), embed_duration)
-            
-            # Tạo một index FAISS MỚI và thêm TẤT CẢ embedding vào
-            index = faiss.IndexFlatIP(DIM)
-            index.add(all_embeddings)
-            logger.log_index_rebuild(index.ntotal)
+            logger.log_embedding_complete(len(texts), embed_duration)
+        
+        # --- Step 3: Dựng generation mới trên BẢN SAO của index ---
+        progress("indexing")
+        index_start = time.perf_counter()
+        n_after = old_count - len(removed) + len(items)
+        if needs_rebuild(base.index, INDEX_SPEC, n_after):
+            # Số vector vượt ngưỡng / đổi họ index (FLAT -> HNSW/IVF, nlist
+            # lệch xa, đổi kiểu nén): dựng lại toàn bộ, vector cũ lấy từ bản
+            # float32 / index (reconstruct); nếu chỉ còn mã nén (mất mát) thì
+            # encode lại từ văn bản (phần lớn trúng cache)
+            keep = base.metadata.labels[~np.isin(base.metadata.labels, np.concatenate([labels, gone]))]
+            if not len(keep):
+                kept_vecs = np.zeros((0, DIM), dtype=np.float32)
+            elif base.exact is not None or is_lossless(base.index):
+                kept_vecs = base.vectors(keep)
+            else:
+                kept_vecs = encode_texts([base.metadata.get(l)["text"] for l in keep], encode_chunked)
+            vecs = np.vstack([kept_vecs, embeddings]) if texts else kept_vecs
+            index = new_index(np.ascontiguousarray(vecs, dtype=np.float32), np.concatenate([keep, labels]))
+            print(f"🔁 Rebuilt index as {index_kind(index)} for {index.ntotal} vectors")
+            delta = IndexDelta.empty(DIM)
+        else:
+            # Không sao chép index: vector mới vào delta, label bị thay thế /
+            # xóa bị che khỏi index (chi phí theo cỡ batch + delta)
+            index = base.index
+            delta = base.delta.with_changes(removed, labels, embeddings if texts else None)
+        ntotal = index.ntotal - len(delta.shadowed) + len(delta)
         
-        # Lưu index và metadata mới ra file
-        save_index()
+        added = [{
+            "id": item.id,
+            "label": label,
+            "type": item.type,
+            "text": item.text,
+            "payload": item.payload or {},
+            "hash": item.hash or content_hash(item.type, item.text, item.payload),
+        } for label, item in zip(labels.tolist(), items.values())]
+        metadata = base.metadata.with_changes(removed, added)
+        # Posting từ khóa: cập nhật tăng dần theo item thay đổi; vibe lần
+        # đầu xuất hiện thì quét toàn bộ metadata 1 lần cho từ đó
+        keywords = base.keywords.with_changes(removed, map(record_of, added), map(record_of, metadata.items()))
+        # BM25: gỡ văn bản CŨ của item bị thay thế / bị xóa, thêm văn bản mới
+        old_docs = [(int(base.metadata.labels[r]), base.metadata.record(r)["text"])
+                    for r in base.metadata.rows(removed)]
+        lexical = base.lexical.with_changes(old_docs, [(a["label"], a["text"]) for a in added])
+        geo = base.geo.with_changes(removed, [(a["label"], a["payload"]) for a in added])
+        # Bản float32 cho chấm lại chính xác: chỉ đổi phần trong RAM, file
+        # vectors.npy được ghi lại khi checkpoint
+        exact = None
+        if EXACT_RERANK:
+            exact = base.exact.with_changes(removed, labels, embeddings if texts else None)
+        STAGE_SECONDS.observe(time.perf_counter() - index_start, stage="index_update")
+        
+        logger.log_metadata_update(len(replaced), len(items), old_count, len(metadata))
+        logger.log_index_update(len(items) - len(replaced), len(replaced), ntotal)
+        logger.log_consistency_check(ntotal, len(metadata), ntotal == len(metadata))
+        
+        # Ghi WAL rồi công bố cho request đọc (item upsert lại thì hết là tombstone)
+        progress("saving")
+        with tombstone_lock:
+            tombstones = merged_tombstones(base, metadata, np.concatenate([labels, removed]))
+            if late_deletes:
+                tombstones = np.union1d(tombstones, labels[np.isin(labels, list(late_deletes))])
+                late_deletes.clear()
+            if log_wal:
+                # Item của batch bị /delete trong lúc dựng: /delete đã được
+                # chấp nhận TRƯỚC bản ghi này, nên ghi kèm để chạy lại đúng thứ tự
+                late = np.isin(labels, tombstones)
+                log_write({"op": "upsert", "items": [item.model_dump() for item in items.values()],
+                           "deleted": sorted(set(deleted) - set(items)),
+                           "tombstoned": sorted(i for i, t in zip(items, late) if t)})
+            gen = generation.derive(index, metadata, keywords, lexical, exact, geo, tombstones, delta)
+            publish(gen)
+        if len(delta) >= INDEX_DELTA_MAX:
+            checkpoint_wake.set()
         
-        logger.log_consistency_check(index.ntotal, len(metadata), index.ntotal == len(metadata))
         logger.end_operation()
         logger.save()
         
         return {
             "ok": True,
-            "added": len(req.items), # Số item mới
-            "removed": removed,      # Số item cũ bị ghi đè
-            "total": index.ntotal  # Tổng số item trong index
+            "added": len(items),     # Số item mới
+            "removed": len(replaced), # Số item cũ bị ghi đè
+            "deleted": len(gone),     # Số item bị xóa
+            "total": ntotal,  # Tổng số item trong index
+            "generation": gen.number
         }
     except Exception as e:
+        with tombstone_lock:
+            late_deletes.clear()
         logger.log(f"❌ [Upsert] Error: {str(e)}")
         import traceback
         traceback.print_exc()
         logger.save()
-        raise HTTPException(500, f"Upsert failed: {str(e)}")
+        raise
+
+# Hàng đợi upsert chạy nền: 1 luồng ghi duy nhất, gộp các batch đang chờ
+# (tạo trong startup())
+upsert_jobs: UpsertJobQueue = None
+
+@app.post("/upsert")
+def upsert(req: UpsertRequest, wait: bool = False):
+    """
+    Endpoint thêm/cập nhật dữ liệu vào index.
+    Không chặn request: đưa vào hàng đợi và trả về job_id ngay
+    (xem tiến độ ở /jobs/{job_id}); wait=true để chờ kết quả như trước.
+    """
+    job = upsert_jobs.submit(req.items)
+    if not wait:
+        return {"ok": True, **job.to_dict()}
+    job.done.wait()
+    if job.status == "failed":
+        raise HTTPException(500, f"Upsert failed: {job.error}")
+    return {**job.result, "job_id": job.id}
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    """Endpoint xem trạng thái/tiến độ của một job upsert."""
+    job = upsert_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(404, f"Job {job_id} not found")
+    return job.to_dict()
+
+@app.get("/sync/manifest")
+def sync_manifest():
+    """
+    Trạng thái index để đồng bộ delta: {id: hash nội dung}, model và số
+    generation. Client so với dữ liệu của mình rồi chỉ gửi phần thay đổi
+    lên /sync/apply kèm base_generation = generation nhận được.
+    """
+    gen = generation
+    return {"model": CACHE_MODEL_KEY, "generation": gen.number, "count": len(gen.metadata), "items": gen.hashes()}
+
+@app.post("/sync/apply")
+def sync_apply(req: SyncApplyRequest):
+    """
+    Áp dụng thay đổi (upsert + delete) tính từ base_generation. Index đã
+    sang generation khác (có ghi khác xen vào) => 409, client lấy lại
+    manifest và tính lại delta. Chạy đồng bộ dưới khóa ghi để việc kiểm tra
+    generation và ghi là một bước.
+    """
+    with upsert_jobs.writer_lock:
+        current = generation.number
+        if req.base_generation != current:
+            raise HTTPException(409, f"Stale base generation {req.base_generation}, index is at {current}")
+        if not req.upsert and not req.delete:
+            return {"ok": True, "added": 0, "removed": 0, "deleted": 0,
+                    "total": generation.ntotal, "generation": current}
+        try:
+            return apply_upsert(req.upsert, deleted=req.delete)
+        except Exception as e:
+            raise HTTPException(500, f"Sync apply failed: {str(e)}")
+
+# Số lần compaction đã chạy; luồng compaction đang chạy (tối đa 1)
+compactions = 0
+compaction_thread: Optional[threading.Thread] = None
+
+def compact_tombstones():
+    """
+    Gỡ hẳn các item đã tombstone khỏi index/metadata/BM25/geo (một lần
+    apply_upsert chỉ có delete, dưới khóa ghi như mọi lần ghi khác), rồi
+    gộp delta để vector của chúng rời khỏi index FAISS ngay, không phải
+    chờ tới checkpoint kế tiếp (apply_upsert chỉ che chúng trong delta).
+    """
+    global compactions
+    with upsert_jobs.writer_lock:
+        gen = generation
+        if not len(gen.tombstones):
+            return
+        ids = [gen.metadata.get(int(l))["id"] for l in gen.tombstones]
+        start = time.perf_counter()
+        apply_upsert([], deleted=ids)
+        fold_delta()
+        compactions += 1
+        print(f"🧹 Compacted {len(ids)} tombstones in {time.perf_counter() - start:.2f}s")
+
+def maybe_compact(gen: IndexGeneration):
+    """Chạy compaction nền khi tỉ lệ tombstone vượt TOMBSTONE_COMPACT_RATIO."""
+    global compaction_thread
+    if not gen.ntotal or len(gen.tombstones) / gen.ntotal < TOMBSTONE_COMPACT_RATIO:
+        return
+    with tombstone_lock:
+        if compaction_thread is not None and compaction_thread.is_alive():
+            return
+        compaction_thread = threading.Thread(target=compact_tombstones, name="tombstone-compaction", daemon=True)
+        compaction_thread.start()
+
+def tombstone_ids(ids: List[str], log_wal: bool = True):
+    """
+    Đánh dấu tombstone cho các id có trong index; trả về (generation, số id
+    mới bị xóa). /delete đến sau /upsert luôn thắng: item còn chờ trong hàng
+    đợi bị bỏ khỏi job, item thuộc batch đang dựng vào late_deletes.
+    """
+    ids = sorted(set(ids))
+    labels = np.array([label_for(i) for i in ids], dtype=np.int64)
+    with tombstone_lock:
+        current = generation
+        cancelled, running = upsert_jobs.cancel(ids)
+        late_deletes.update(label_for(i) for i in running)
+        known = current.metadata.contains(labels) & ~np.isin(labels, current.tombstones)
+        removed = cancelled | running | {i for i, k in zip(ids, known) if k}
+        labels = labels[known]
+        if not len(labels):
+            return current, len(removed)
+        if log_wal:
+            log_write({"op": "delete", "ids": ids})
+        gen = current.with_tombstones(labels)
+        publish(gen)
+    return gen, len(removed)
+
+@app.post("/delete")
+def delete(req: DeleteRequest):
+    """
+    Xóa item theo id: đánh dấu tombstone và công bố generation mới ngay
+    (không chờ job ghi đang chạy; item upsert trước đó mà chưa ghi xong
+    cũng bị xóa). Tìm kiếm loại tombstone qua bộ lọc
+    IDSelector dựng sẵn mỗi generation, không tốn thêm chi phí mỗi hit;
+    compaction nền gỡ hẳn khi tỉ lệ tombstone vượt ngưỡng.
+    """
+    gen, deleted = tombstone_ids(req.ids)
+    if deleted:
+        maybe_compact(gen)
+    return {"ok": True, "deleted": deleted, "tombstones": len(gen.tombstones),
+            "total": gen.live, "generation": gen.number}
+
+def geo_filter(gen: IndexGeneration, req) -> Optional[np.ndarray]:
+    """Label (đã sắp xếp) nằm trong vòng near / bbox của request; None nếu không lọc vị trí."""
+    labels = None
+    if req.near is not None and req.near.radius_m is not None:
+        labels = gen.geo.within_radius(req.near.lat, req.near.lng, req.near.radius_m)[0]
+    if req.bbox is not None:
+        box = gen.geo.within_bbox(*req.bbox)
+        labels = box if labels is None else np.intersect1d(labels, box, assume_unique=True)
+    return labels
+
+def geo_key(req) -> tuple:
+    """Khóa nhóm cho vùng near/bbox (query cùng vùng dùng chung 1 lần tìm)"""
+    near = (req.near.lat, req.near.lng, req.near.radius_m) if req.near is not None and req.near.radius_m else None
+    return near, tuple(req.bbox) if req.bbox is not None else None
+
+def distance_factor(gen: IndexGeneration, req, labels: np.ndarray):
+    """
+    (khoảng cách tới near (m), hệ số exp(-d / distance_decay_m)) cho mảng
+    label; không có near => (None, None). Item không có tọa độ: hệ số 1.
+    """
+    if req.near is None:
+        return None, None
+    dist = gen.geo.distances(labels, req.near.lat, req.near.lng)
+    if not req.distance_decay_m:
+        return dist, None
+    return dist, np.where(np.isnan(dist), 1.0, np.exp(-np.nan_to_num(dist) / req.distance_decay_m))
+
+def note_candidates(gen: IndexGeneration, n_allowed: int):
+    """Ghi số ứng viên còn lại / bị loại sau bộ lọc của 1 query"""
+    CANDIDATES.observe(n_allowed)
+    FILTERED_OUT.inc(gen.ntotal - n_allowed)
+
+def search_fetch(req: SearchRequest, n_allowed: int) -> int:
+    """Số ứng viên cần lấy từ FAISS (nhiều hơn top_k khi còn xếp hạng lại theo khoảng cách)"""
+    k = min(req.top_k, n_allowed)
+    if req.near is not None and req.distance_decay_m:
+        return min(k * GEO_DECAY_FETCH, n_allowed)
+    return k
+
+def search_hits(gen: IndexGeneration, req: SearchRequest, scores: np.ndarray, labels: np.ndarray):
+    """Áp dụng giảm điểm theo khoảng cách (nếu có), lấy top_k và định dạng hit."""
+    with STAGE_SECONDS.time(stage="rerank"):
+        dist, factor = distance_factor(gen, req, labels)
+        if factor is not None:
+            scores = np.where(labels >= 0, scores * factor, -np.inf)
+            order = np.argsort(-scores, kind="stable")
+            scores, labels, dist = scores[order], labels[order], dist[order]
+    n = req.top_k
+    return format_hits(gen, scores[:n], labels[:n], req.min_score, None if dist is None else dist[:n])
 
 @app.post("/search")
 def search(req: SearchRequest):
     """Endpoint tìm kiếm ngữ nghĩa đơn giản (1 bước)."""
     try:
-        if index.ntotal == 0:
+        # Snapshot cố định cho cả request (index + metadata luôn khớp nhau)
+        gen = generation
+        if gen.ntotal == 0:
             return {"hits": []} # Trả về rỗng nếu index rỗng
         
         search_start = time.time()
         
         # 1. Dùng model AI biến query thành vector
-        query_emb = model.encode(
-            [req.query],
-            normalize_embeddings=True,
-            show_progress_bar=False,
-            convert_to_numpy=True
-        )
+        query_emb = encode_query(req.query)
         
-        # 2. Tìm kiếm trong FAISS
-        k = min(req.top_k, index.ntotal)
-        scores, indices = index.search(query_emb, k)
+        # 2. Tìm kiếm trong FAISS, chỉ trên các label khớp bộ lọc
+        # (type/province, vùng near/bbox) => luôn đủ top_k nếu có đủ item hợp lệ
+        with STAGE_SECONDS.time(stage="filter"):
+            geo = geo_filter(gen, req)
+            n_allowed, _ = gen.filter_selector(req.filter_type, req.filter_province, geo)
+        note_candidates(gen, n_allowed)
+        if n_allowed == 0:
+            return {"hits": []}
+        k = search_fetch(req, n_allowed)
+        with STAGE_SECONDS.time(stage="ann"):
+            scores, indices = gen.search(query_emb, k, req.filter_type, req.filter_province,
+                                         req.ef_search, req.nprobe, INDEX_SPEC.exact_threshold, INDEX_SPEC.rerank, geo)
+        FETCHED.inc(k)
         
-        # 3. Lọc và định dạng kết quả
-        hits = []
-        for score, idx in zip(scores[0], indices[0]):
-            if idx < 0 or idx >= len(metadata):
-                continue
-            
-            meta = metadata[idx] # Lấy metadata dựa trên chỉ số (idx)
-            
-            # --- Lọc (Post-filtering) ---
-            # Lọc sau khi tìm kiếm
-            if req.filter_type and meta["type"] != req.filter_type:
+        # 3. Định dạng kết quả
+        hits = search_hits(gen, req, scores[0], indices[0])
+        
+        search_duration = time.time() - search_start
+        logger.log_search(req.query, len(hits), search_duration)
+        
+        return {"hits": hits}
+    except Exception as e:
+        raise HTTPException(500, f"Search failed: {str(e)}")
+
+def format_hits(gen: IndexGeneration, scores: np.ndarray, labels: np.ndarray,
+                min_score: Optional[float], distances: Optional[np.ndarray] = None) -> List[Dict[str, Any]]:
+    """Kết quả FAISS (1 query) -> danh sách hit, bỏ các hit dưới min_score."""
+    hits = []
+    with STAGE_SECONDS.time(stage="format"):
+        rows = gen.metadata.rows(labels) # label FAISS -> dòng metadata
+        for i, (score, row) in enumerate(zip(scores, rows)):
+            if row < 0:
                 continue
-            if req.filter_province:
-                prov = meta.get("payload", {}).get("province", "")
-                if prov != req.filter_province:
-                    continue
-            if req.min_score and score < req.min_score:
+            if min_score and score < min_score:
                 continue
-            
-            hits.append({
+            meta = gen.metadata.record(row) # Chỉ giải mã các dòng được trả về
+            hit = {
                 "id": meta["id"],
                 "score": float(score),
                 "type": meta["type"],
                 "text": meta["text"],
                 "payload": meta["payload"]
-            })
+            }
+            if distances is not None:
+                hit["distance_m"] = None if np.isnan(distances[i]) else round(float(distances[i]), 1)
+            hits.append(hit)
+    return hits
+
+def grouped_search(gen: IndexGeneration, query_embs: np.ndarray, reqs: List[Any], ks: List[int],
+                   geos: List[Optional[np.ndarray]]):
+    """
+    Tìm nhiều query cùng lúc: các query cùng bộ lọc (kể cả vùng near/bbox,
+    label trong `geos`) + ef_search/nprobe chung 1 lần index.search trên
+    ma trận (N x DIM). Trả về (scores, labels) dạng (1 x k) theo đúng thứ
+    tự query; None nếu query không có ứng viên.
+    """
+    groups = defaultdict(list)
+    for i, (req, k) in enumerate(zip(reqs, ks)):
+        if k > 0:
+            groups[(req.filter_type or None, req.filter_province or None, geo_key(req),
+                    req.ef_search, req.nprobe)].append(i)
+    
+    results = [None] * len(reqs)
+    for (filter_type, filter_province, _, ef_search, nprobe), members in groups.items():
+        k = max(ks[i] for i in members)
+        with STAGE_SECONDS.time(stage="ann"):
+            scores, indices = gen.search(query_embs[members], k, filter_type, filter_province, ef_search, nprobe,
+                                         INDEX_SPEC.exact_threshold, INDEX_SPEC.rerank, geos[members[0]])
+        FETCHED.inc(k * len(members))
+        for row, i in enumerate(members):
+            results[i] = (scores[row:row + 1, :ks[i]], indices[row:row + 1, :ks[i]])
+    return results
+
+@app.post("/search/batch")
+def search_batch(req: BatchSearchRequest):
+    """Nhiều query /search trong 1 request: encode 1 lần, FAISS 1 lần cho mỗi nhóm bộ lọc."""
+    try:
+        gen = generation
+        if gen.ntotal == 0:
+            return {"results": [{"hits": []} for _ in req.queries]}
+        
+        search_start = time.time()
+        BATCH_SIZE.observe(len(req.queries), kind="search_batch")
+        query_embs = encode_queries([q.query for q in req.queries])
+        with STAGE_SECONDS.time(stage="filter"):
+            geos = [geo_filter(gen, q) for q in req.queries]
+            allowed = [gen.filter_selector(q.filter_type, q.filter_province, geo)[0] for q, geo in zip(req.queries, geos)]
+        for n_allowed in allowed:
+            note_candidates(gen, n_allowed)
+        ks = [search_fetch(q, n_allowed) for q, n_allowed in zip(req.queries, allowed)]
+        found = grouped_search(gen, query_embs, req.queries, ks, geos)
+        
+        results = []
+        for q, f in zip(req.queries, found):
+            results.append({"hits": search_hits(gen, q, f[0][0], f[1][0]) if f else []})
         
         search_duration = time.time() - search_start
-        logger.log_search(req.query, len(hits), search_duration)
+        for q, r in zip(req.queries, results):
+            logger.log_search(q.query, len(r["hits"]), search_duration)
         
-        return {"hits": hits}
+        return {"results": results}
     except Exception as e:
-        raise HTTPException(500, f"Search failed: {str(e)}")
+        raise HTTPException(500, f"Batch search failed: {str(e)}")
+
+def keyword_signals(gen: IndexGeneration, labels: np.ndarray, rows: np.ndarray,
+                    vibes_lower: List[str], avoid_lower: List[str],
+                    avoid_labels: np.ndarray, unindexed: set):
+    """
+    (keep, vibe_matches) cho mảng label ứng viên: lọc AVOID và đếm VIBE khớp
+    bằng NumPy trên posting; từ khóa chưa có posting thì so khớp chuỗi.
+    """
+    keep = rows >= 0
+    if len(avoid_labels):
+        keep &= ~np.isin(labels, avoid_labels)
+    vibe_matches = gen.keywords.match_counts(labels, vibes_lower)
+    
+    if unindexed:
+        for i in np.flatnonzero(keep):
+            meta = gen.metadata.record(rows[i])
+            if any(record_matches(av, meta) for av in avoid_lower if av in unindexed):
+                keep[i] = False
+            else:
+                vibe_matches[i] += sum(record_matches(v, meta) for v in vibes_lower if v in unindexed)
+    return keep, vibe_matches
+
+# Luồng chạy BM25 song song với encode query + FAISS trong cùng request
+lexical_pool = ThreadPoolExecutor(max_workers=LEXICAL_WORKERS, thread_name_prefix="bm25")
+
+def hybrid_query_text(req: HybridSearchRequest) -> str:
+    """Kết hợp free_text và vibes thành 1 câu query ngữ nghĩa ("" nếu không có gì)."""
+    query_parts = []
+    if req.free_text:
+        query_parts.append(req.free_text)
+    if req.vibes:
+        query_parts.extend(req.vibes)
+    return " ".join(query_parts)
+
+def submit_lexical(gen: IndexGeneration, req: HybridSearchRequest, query_text: str):
+    """
+    BM25 chạy trên luồng khác trong lúc encode query + tìm FAISS,
+    nên gần như không cộng thêm độ trễ
+    """
+    if req.lexical and len(gen.lexical):
+        return lexical_pool.submit(lexical_search, gen.lexical, query_text)
+    return None
+
+def lexical_search(lexical: BM25Index, query_text: str):
+    with STAGE_SECONDS.time(stage="bm25"):
+        return lexical.search(query_text)
+
+def hybrid_rank(gen: IndexGeneration, req: HybridSearchRequest, query_text: str,
+                query_emb: np.ndarray, lexical_future=None, first=None,
+                geo: Optional[np.ndarray] = None) -> Dict[str, Any]:
+    """
+    Bước 2-3 của hybrid search cho 1 query đã encode. `first` là kết quả
+    FAISS vòng đầu (k = top_k * 3) nếu đã tìm sẵn theo batch; `geo` là
+    label trong vùng near/bbox (geo_filter).
+    """
+    # Lọc cứng (type/province, vùng near/bbox) NGAY TRONG FAISS bằng selector
+    with STAGE_SECONDS.time(stage="filter"):
+        n_allowed, _ = gen.filter_selector(req.filter_type, req.filter_province, geo)
+    if first is None:
+        note_candidates(gen, n_allowed)
+    if n_allowed == 0:
+        return {"hits": [], "strategy": "hybrid", "query_text": query_text, "total_candidates": 0}
+    
+    # === BƯỚC 2: SÀNG LỌC VÀ CHẤM ĐIỂM LẠI (RE-RANKING) ===
+    # (stage "rerank" = bước 2 trừ thời gian FAISS và chờ BM25)
+    rank_start = time.perf_counter()
+    excluded = 0.0
+    
+    # Chuẩn bị danh sách từ khóa (viết thường) để so sánh
+    vibes_lower = [t for t in map(normalize_term, req.vibes or []) if t]
+    avoid_lower = [t for t in map(normalize_term, req.avoid or []) if t]
+    
+    # Từ khóa đã có posting (vibe trong payload, KEYWORD_TERMS) được xử lý
+    # bằng NumPy trên mảng label ứng viên; từ khóa lạ thì so khớp chuỗi như cũ
+    unindexed = {t for t in vibes_lower + avoid_lower if t not in gen.keywords}
+    avoid_labels = gen.keywords.union(avoid_lower)
+    signals = (vibes_lower, avoid_lower, avoid_labels, unindexed)
+    
+    # Lấy một số lượng ứng viên lớn hơn mức cần thiết (ví dụ: top_k=10 thì lấy 30);
+    # nếu AVOID loại bớt làm thiếu top_k thì mở rộng k và tìm lại
+    n_candidates = req.top_k * 3
+    k = min(n_candidates, n_allowed)
+    found = first
+    while True:
+        if found is None:
+            ann_start = time.perf_counter()
+            found = gen.search(query_emb, k, req.filter_type, req.filter_province, req.ef_search,
+                               req.nprobe, INDEX_SPEC.exact_threshold, INDEX_SPEC.rerank, geo)
+            excluded += STAGE_SECONDS.observe_since(ann_start, stage="ann")
+            FETCHED.inc(k)
+        scores, indices = found
+        rows = gen.metadata.rows(indices[0])
+        keep, vibe_matches = keyword_signals(gen, indices[0], rows, *signals)
+        
+        if keep.sum() >= req.top_k or k >= n_allowed:
+            break
+        k = min(k * 2, n_allowed)
+        found = None
+    
+    # Ứng viên ngữ nghĩa (theo thứ hạng FAISS)
+    labels = indices[0][keep]
+    rows = rows[keep]
+    dense = scores[0][keep].astype(np.float32)
+    vibe_matches = vibe_matches[keep]
+    bm25 = np.full(len(labels), np.nan, dtype=np.float32)
+    
+    # Ứng viên từ khóa (BM25) qua cùng bộ lọc cứng + AVOID
+    n_lexical = 0
+    if lexical_future is not None:
+        wait_start = time.perf_counter()
+        lex_labels, lex_scores = lexical_future.result()
+        excluded += time.perf_counter() - wait_start
+        lex_rows = gen.metadata.rows(lex_labels)
+        ok = lex_rows >= 0
+        if req.filter_type or req.filter_province:
+            ok &= gen.metadata.mask(req.filter_type, req.filter_province)[lex_rows]
+        if geo is not None:
+            ok &= np.isin(lex_labels, geo)
+        if len(gen.tombstones):
+            ok &= gen.alive(lex_labels)
+        lex_labels, lex_rows, lex_scores = lex_labels[ok][:n_candidates], lex_rows[ok][:n_candidates], lex_scores[ok][:n_candidates]
+        lex_keep, lex_vibes = keyword_signals(gen, lex_labels, lex_rows, *signals)
+        lex_labels, lex_rows, lex_scores, lex_vibes = lex_labels[lex_keep], lex_rows[lex_keep], lex_scores[lex_keep], lex_vibes[lex_keep]
+        n_lexical = len(lex_labels)
+    
+    if n_lexical:
+        # --- Reciprocal Rank Fusion: sum 1 / (k + rank) trên 2 danh sách ---
+        rrf = np.zeros(len(labels))
+        rrf += 1.0 / (HYBRID_RRF_K + np.arange(1, len(labels) + 1))
+        pos = {int(l): i for i, l in enumerate(labels)}
+        new = np.array([int(l) not in pos for l in lex_labels], dtype=bool)
+        
+        # Ứng viên chỉ có từ BM25: tính điểm cosine từ vector đã lưu trong index
+        extra = lex_labels[new]
+        extra_dense = np.zeros(len(extra), dtype=np.float32)
+        if len(extra):
+            extra_dense = gen.vectors(extra) @ query_emb[0]
+        labels = np.concatenate([labels, extra])
+        rows = np.concatenate([rows, lex_rows[new]])
+        dense = np.concatenate([dense, extra_dense])
+        vibe_matches = np.concatenate([vibe_matches, lex_vibes[new]])
+        bm25 = np.concatenate([bm25, np.full(len(extra), np.nan, dtype=np.float32)])
+        rrf = np.concatenate([rrf, np.zeros(len(extra))])
+        
+        at = np.array([pos.get(int(l), -1) for l in lex_labels])
+        at[new] = len(pos) + np.arange(len(extra))
+        rrf[at] += 1.0 / (HYBRID_RRF_K + np.arange(1, n_lexical + 1))
+        bm25[at] = lex_scores
+    
+    # --- TĂNG ĐIỂM (BOOST VIBES): score * boost^matches ---
+    boost = req.boost_vibes ** vibe_matches
+    adjusted = dense * boost
+    
+    # --- GIẢM ĐIỂM THEO KHOẢNG CÁCH tới near (nếu có distance_decay_m) ---
+    dist, factor = distance_factor(gen, req, labels)
+    if factor is not None:
+        boost = boost * factor
+        adjusted = adjusted * factor
+    
+    # === BƯỚC 3: SẮP XẾP VÀ TRẢ VỀ ===
+    
+    # Sắp xếp theo điểm RRF (đã boost vibe) nếu có BM25, ngược lại theo
+    # điểm ngữ nghĩa MỚI; lấy top_k và chỉ giải mã các dòng này
+    rank_by = rrf * boost if n_lexical else adjusted
+    top = np.argsort(-rank_by, kind="stable")[:req.top_k]
+    STAGE_SECONDS.observe(time.perf_counter() - rank_start - excluded, stage="rerank")
+    format_start = time.perf_counter()
+    hits = []
+    for i in top:
+        meta = gen.metadata.record(rows[i])
+        # "score" luôn là điểm dùng để sắp xếp (RRF đã boost nếu có BM25)
+        hit = {
+            "id": meta["id"],
+            "score": float(rank_by[i]),
+            "original_score": float(dense[i]),
+            "vibe_matches": int(vibe_matches[i]),
+            "type": meta["type"],
+            "text": meta["text"],
+            "payload": meta["payload"]
+        }
+        if n_lexical:
+            hit["semantic_score"] = float(adjusted[i])
+            hit["bm25_score"] = None if np.isnan(bm25[i]) else float(bm25[i])
+        if dist is not None:
+            hit["distance_m"] = None if np.isnan(dist[i]) else round(float(dist[i]), 1)
+        hits.append(hit)
+    STAGE_SECONDS.observe(time.perf_counter() - format_start, stage="format")
+    
+    return {
+        "hits": hits,
+        "strategy": "hybrid",
+        "query_text": query_text,
+        "total_candidates": len(hits),
+        "lexical_candidates": n_lexical
+    }
 
 @app.post("/hybrid-search")
 def hybrid_search(req: HybridSearchRequest):
     """
-    Tìm kiếm hybrid: kết hợp ngữ nghĩa (AI) + tăng điểm từ khóa (keyword boosting)
-    (Đây là logic bạn đã hỏi)
+    Tìm kiếm hybrid: kết hợp ngữ nghĩa (AI) + từ khóa BM25 (hợp nhất bằng
+    Reciprocal Rank Fusion) + tăng điểm vibe (keyword boosting)
     """
     try:
-        if index.ntotal == 0:
+        gen = generation
+        if gen.ntotal == 0:
             return {"hits": [], "strategy": "empty_index"}
         
         # === BƯỚC 1: TẠO QUERY VÀ LẤY ỨNG VIÊN ===
-        
-        # Kết hợp free_text và vibes để tạo thành 1 câu query ngữ nghĩa
-        query_parts = []
-        if req.free_text:
-            query_parts.append(req.free_text)
-        if req.vibes:
-            query_parts.extend(req.vibes)
-        
-        if not query_parts:
+        query_text = hybrid_query_text(req)
+        if not query_text:
             return {"hits": [], "strategy": "no_query"}
         
-        query_text = " ".join(query_parts)
+        lexical_future = submit_lexical(gen, req, query_text)
         
         # Dùng model AI để biến câu query kết hợp thành vector
-        query_emb = model.encode(
-            [query_text],
-            normalize_embeddings=True,
-            show_progress_bar=False,
-            convert_to_numpy=True
-        )
-        
-        # Lấy một số lượng ứng viên lớn hơn mức cần thiết (ví dụ: top_k=10 thì lấy 30)
-        k = min(req.top_k * 3, index.ntotal)
-        scores, indices = index.search(query_emb, k)
-        
-        # === BƯỚC 2: SÀNG LỌC VÀ CHẤM ĐIỂM LẠI (RE-RANKING) ===
-        
-        hits = [] # Danh sách kết quả cuối cùng
-        
-        # Chuẩn bị danh sách từ khóa (viết thường) để so sánh
-        vibes_lower = [v.lower() for v in (req.vibes or [])]
-        avoid_lower = [a.lower() for a in (req.avoid or [])]
-        
-        # Bắt đầu duyệt qua từng ứng viên
-        for score, idx in zip(scores[0], indices[0]):
-            if idx < 0 or idx >= len(metadata):
-                continue
-            
-            meta = metadata[idx]
-            text_lower = meta["text"].lower()
-            
-            # --- LỌC BỎ (AVOID) ---
-            if avoid_lower and any(av in text_lower for av in avoid_lower):
-                continue 
-            
-            # --- LỌC CỨNG (FILTER) ---
-            if req.filter_type and meta["type"] != req.filter_type:
-                continue
-            if req.filter_province:
-                prov = meta.get("payload", {}).get("province", "")
-                if prov != req.filter_province:
-                    continue
-            
-            # --- TĂNG ĐIỂM (BOOST VIBES) ---
-            adjusted_score = float(score)
-            vibe_matches = sum(1 for v in vibes_lower if v in text_lower)
-            
-            if vibe_matches > 0:
-                adjusted_score *= (req.boost_vibes ** vibe_matches)
-            
-            # Thêm vào danh sách kết quả với điểm MỚI
-            hits.append({
-                "id": meta["id"],
-                "score": adjusted_score,
-                "original_score": float(score),
-                "vibe_matches": vibe_matches,
-                "type": meta["type"],
-                "text": meta["text"],
-                "payload": meta["payload"]
-            })
-        
-        # === BƯỚC 3: SẮP XẾP VÀ TRẢ VỀ ===
+        query_emb = encode_query(query_text)
+        with STAGE_SECONDS.time(stage="filter"):
+            geo = geo_filter(gen, req)
+        return hybrid_rank(gen, req, query_text, query_emb, lexical_future, geo=geo)
+    except Exception as e:
+        raise HTTPException(500, f"Hybrid search failed: {str(e)}")
+
+@app.post("/hybrid-search/batch")
+def hybrid_search_batch(req: BatchHybridSearchRequest):
+    """
+    Nhiều query /hybrid-search trong 1 request: encode chung 1 lần, vòng
+    FAISS đầu tiên chạy 1 lần cho mỗi nhóm bộ lọc; kết quả theo đúng thứ tự.
+    """
+    try:
+        gen = generation
+        if gen.ntotal == 0:
+            return {"results": [{"hits": [], "strategy": "empty_index"} for _ in req.queries]}
         
-        # Sắp xếp lại 'hits' dựa trên điểm MỚI (score) từ cao đến thấp
-        hits.sort(key=lambda x: x["score"], reverse=True)
+        BATCH_SIZE.observe(len(req.queries), kind="hybrid_batch")
+        texts = [hybrid_query_text(q) for q in req.queries]
+        active = [i for i, t in enumerate(texts) if t]
+        reqs = [req.queries[i] for i in active]
+        futures = [submit_lexical(gen, q, texts[i]) for i, q in zip(active, reqs)]
         
-        # Cắt lấy top_k (ví dụ: 10) kết quả tốt nhất
-        hits = hits[:req.top_k]
+        query_embs = encode_queries([texts[i] for i in active]) if active else None
+        with STAGE_SECONDS.time(stage="filter"):
+            geos = [geo_filter(gen, q) for q in reqs]
+            allowed = [gen.filter_selector(q.filter_type, q.filter_province, geo)[0] for q, geo in zip(reqs, geos)]
+        for n_allowed in allowed:
+            note_candidates(gen, n_allowed)
+        ks = [min(q.top_k * 3, n_allowed) for q, n_allowed in zip(reqs, allowed)]
+        found = grouped_search(gen, query_embs, reqs, ks, geos) if active else []
         
-        return {
-            "hits": hits,
-            "strategy": "hybrid",
-            "query_text": query_text,
-            "total_candidates": len(hits)
-        }
+        results = [{"hits": [], "strategy": "no_query"} for _ in req.queries]
+        for j, i in enumerate(active):
+            results[i] = hybrid_rank(gen, reqs[j], texts[i], query_embs[j:j + 1], futures[j], found[j], geos[j])
+        return {"results": results}
     except Exception as e:
-        raise HTTPException(500, f"Hybrid search failed: {str(e)}")
+        raise HTTPException(500, f"Hybrid batch search failed: {str(e)}")
+
+def reset_index(log_wal: bool = True):
+    """Công bố generation với index và metadata rỗng (gọi khi giữ khóa ghi)."""
+    index = new_index()
+    exact = ExactVectors.empty(DIM) if EXACT_RERANK else None
+    with tombstone_lock:
+        if log_wal:
+            log_write({"op": "reset"})
+        publish(generation.derive(index, MetadataStore.empty(),
+                                  generation.keywords.with_changes(generation.metadata.labels, []),
+                                  new_lexical(), exact, new_geo()))
 
 @app.post("/reset")
 def reset():
     """Endpoint xóa sạch index (hữu ích khi test)."""
-    global index, metadata
+    # Giữ khóa ghi để không chen ngang một job upsert đang chạy
+    with upsert_jobs.writer_lock:
+        reset_index()
+    return {"ok": True, "message": "Index reset"}
+
+# =================== WAL / Checkpoint ===================
+# Mỗi lần ghi = 1 bản ghi WAL; checkpoint đầy đủ chạy nền theo kích thước /
+# thời gian; khởi động = checkpoint mới nhất + chạy lại WAL sau nó
+# ===============================================
+
+checkpoint_lock = threading.Lock()
+last_checkpoint: Dict[str, Any] = {"seq": 0, "at": time.time()}
+
+def replay_wal(after: int) -> int:
+    """
+    Chạy lại các bản ghi WAL có seq > after. Các upsert/delete liên tiếp
+    được gộp thành 1 lần apply_upsert (bản ghi sau thắng; delete được gỡ
+    hẳn thay vì tombstone; "tombstoned" của upsert = delete xen vào lúc
+    dựng, áp dụng sau item của nó); reset bỏ phần đang gộp. Trả về số bản ghi.
+    """
+    items: Dict[str, UpsertItem] = {}
+    deleted: set = set()
     
-    # Tạo lại index và metadata rỗng
-    if INDEX_TYPE == "HNSW":
-        index = faiss.IndexHNSWFlat(DIM, 32)
-    else:
-        index = faiss.IndexFlatIP(DIM)
-    metadata = []
+    def flush():
+        if items or deleted:
+            apply_upsert(list(items.values()), deleted=sorted(deleted), log_wal=False)
+        items.clear()
+        deleted.clear()
     
-    # Lưu trạng thái rỗng ra file
-    save_index()
-    return {"ok": True, "message": "Index reset"}
+    count = 0
+    for record in wal.records(after):
+        count += 1
+        if record["op"] == "reset":
+            items.clear()
+            deleted.clear()
+            reset_index(log_wal=False)
+            continue
+        for item_id in record.get("deleted", []) + record.get("ids", []):
+            items.pop(item_id, None)
+            deleted.add(item_id)
+        for item in record.get("items", []):
+            items[item["id"]] = UpsertItem(**item)
+            deleted.discard(item["id"])
+        for item_id in record.get("tombstoned", []):
+            items.pop(item_id, None)
+            deleted.add(item_id)
+    flush()
+    return count
+
+def checkpoint_due() -> bool:
+    return wal.pending_bytes >= CHECKPOINT_WAL_BYTES or len(generation.delta) >= INDEX_DELTA_MAX or (
+        wal.pending_bytes > 0 and time.time() - last_checkpoint["at"] >= CHECKPOINT_INTERVAL_SEC)
+
+def fold_delta():
+    """
+    Gộp delta vào 1 index mới (bản sao của index, gỡ label bị che, thêm
+    vector delta) và công bố cùng số generation. Gọi khi giữ khóa ghi (để
+    không upsert nào chen vào delta trước khi checkpoint chụp generation);
+    /delete vẫn chen được (tombstone lấy theo generation hiện tại).
+    """
+    gen = generation
+    if not len(gen.delta) and not len(gen.delta.shadowed):
+        return
+    with STAGE_SECONDS.time(stage="fold_delta"):
+        index = remove_labels(writable_copy(gen.index), gen.delta.shadowed)
+        if len(gen.delta):
+            index.add_with_ids(np.ascontiguousarray(gen.delta.vectors), gen.delta.labels)
+    with tombstone_lock:
+        current = generation
+        folded = IndexGeneration(current.number, index, current.metadata, current.keywords, current.lexical,
+                                 current.exact, current.geo, current.tombstones)
+        folded.created_at = current.created_at
+        publish(folded)
+
+def checkpoint() -> Optional[Dict[str, Any]]:
+    """
+    Ghi checkpoint của generation đang công bố rồi cắt WAL tới đó. Gộp
+    delta, lấy generation và xoay WAL đều giữ khóa ghi: upsert nào đã ghi
+    WAL tới `seq` thì vector đã nằm trong index được ghi (delta rỗng).
+    Cặp (generation, seq) lấy khi giữ tombstone_lock nên khớp cả với
+    /delete; ghi file checkpoint chạy sau khi thả khóa, song song với các
+    lần ghi mới (vào segment WAL mới).
+    """
+    global last_checkpoint
+    with checkpoint_lock:
+        with upsert_jobs.writer_lock:
+            fold_delta()
+            with tombstone_lock:
+                gen = generation
+                seq = wal.rotate()
+        if seq == last_checkpoint["seq"] and last_checkpoint.get("generation") == gen.number:
+            return None
+        start = time.perf_counter()
+        save_index(gen, seq)
+        wal.truncate(seq)
+        last_checkpoint = {"seq": seq, "generation": gen.number, "vectors": gen.ntotal,
+                           "tombstones": len(gen.tombstones), "at": time.time(),
+                           "duration_sec": round(time.perf_counter() - start, 3)}
+        remap_generation(gen)
+        return last_checkpoint
+
+def checkpoint_loop():
+    """Luồng nền: checkpoint khi WAL đủ lớn / đủ lâu (kiểm tra định kỳ hoặc khi được đánh thức)."""
+    while True:
+        checkpoint_wake.wait(timeout=min(CHECKPOINT_INTERVAL_SEC, 60))
+        checkpoint_wake.clear()
+        if not checkpoint_due():
+            continue
+        try:
+            checkpoint()
+        except Exception as e:
+            logger.log(f"❌ [Checkpoint] Error: {str(e)}")
+            import traceback
+            traceback.print_exc()
+
+@app.post("/checkpoint")
+def checkpoint_now():
+    """Ghi checkpoint ngay (vd. trước khi sao lưu thư mục index)."""
+    done = checkpoint()
+    return {"ok": True, "written": done is not None, "checkpoint": last_checkpoint, "wal": wal.stats()}
+
+# =================== Startup ===================
+# Import module không có tác dụng phụ: tiến trình encode của encode_pipeline
+# (spawn) import lại module __main__ của tiến trình cha, nên khi chạy
+# `python app.py` mỗi worker chỉ chạy phần định nghĩa ở trên
+# ===============================================
+def startup():
+    """
+    Tải model, mở WAL, tải checkpoint + chạy lại WAL rồi mới nhận request
+    (gọi từ lifespan của FastAPI; test / benchmark gọi trực tiếp).
+    """
+    global wal, upsert_jobs
+    load_model()
+    wal = WriteAheadLog(INDEX_DIR / "wal", fsync=WAL_FSYNC)
+    upsert_jobs = UpsertJobQueue(apply_upsert)
+    load_index()
+    threading.Thread(target=checkpoint_loop, name="checkpoint", daemon=True).start()
 
 # =================== Run App ===================
 # Đoạn này chỉ chạy khi bạn chạy file Python trực tiếp
@@ -471,4 +1575,4 @@ def reset():
 if __name__ == "__main__":
     import uvicorn
     # Chạy service API bằng uvicorn trên cổng (PORT) đã định nghĩa
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=PORT)
@@ -0,0 +1,410 @@
+"""
+Benchmark
+Offline, reproducible latency / throughput benchmark for the search
+services (ai/app.py and ai-embed/app.py).
+
+The corpus is synthetic: travelApp.zones.json expanded to the requested
+sizes (names, vibes, tags and centers jittered with a fixed seed). Texts
+are encoded by a hashed bag-of-words stub instead of the model / HF API,
+so only the service code is measured and nothing is downloaded.
+
+Per size (each in a fresh process):
+
+  - bulk load time, index memory (vector codes, RSS growth per vector)
+  - save / load time and bytes on disk (ai only; ai-embed is in-memory)
+  - p50 / p95 / p99 latency and QPS of /search, /hybrid-search and
+    /upsert at every concurrency level (in-process ASGI, no network)
+
+  python benchmark.py run --service ai --sizes 1000,10000 --out bench.json
+  python benchmark.py run --service ai-embed --sizes 100000 --concurrency 1,8
+  python benchmark.py compare base.json head.json
+
+The service's own environment (INDEX_TYPE, VECTOR_STORAGE, ...) is used
+as-is; INDEX_DIR points at a temporary directory.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+ZONES_FILE = ROOT / "travelApp.zones.json"
+SERVICES = {"ai": ROOT / "ai" / "app.py", "ai-embed": ROOT / "ai-embed" / "app.py"}
+# Embedding size of each service's model
+DEFAULT_DIM = {"ai": 1024, "ai-embed": 384}
+
+# Items per /upsert request in the upsert benchmark
+UPSERT_BATCH = 8
+# Requests sent before measuring each endpoint
+WARMUP_REQUESTS = 20
+
+
+class HashEncoder:
+    """
+    Stand-in for SentenceTransformer: every token gets a fixed random
+    unit vector (seeded by its hash), a text is the normalized sum of its
+    tokens. Texts sharing words stay similar, so ANN recall and hybrid
+    re-ranking behave like with real embeddings.
+    """
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self._ids: Dict[str, int] = {}
+        self._table = np.zeros((0, dim), dtype=np.float32)
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+    def _token_ids(self, tokens: List[str]) -> List[int]:
+        new = [t for t in dict.fromkeys(tokens) if t not in self._ids]
+        if new:
+            rows = np.stack([
+                np.random.default_rng(int.from_bytes(hashlib.blake2b(t.encode("utf-8"), digest_size=8).digest(),
+                                                     "little")).standard_normal(self.dim)
+                for t in new
+            ]).astype(np.float32)
+            for t in new:
+                self._ids[t] = len(self._ids)
+            self._table = np.vstack([self._table, rows])
+        return [self._ids[t] for t in tokens]
+
+    def encode(self, texts: List[str], **_) -> np.ndarray:
+        tokens = [(t.lower().split() or [""]) for t in texts]
+        ids = np.array(self._token_ids([tok for toks in tokens for tok in toks]), dtype=np.int64)
+        starts = np.cumsum([0] + [len(toks) for toks in tokens[:-1]])
+        vecs = np.add.reduceat(self._table[ids], starts, axis=0) if len(texts) else np.zeros((0, self.dim))
+        vecs /= np.maximum(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12)
+        return vecs.astype(np.float32)
+
+
+# ---------- corpus ----------
+
+def load_zones() -> List[Dict[str, Any]]:
+    with open(ZONES_FILE, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def make_corpus(zones: List[Dict[str, Any]], size: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """`size` upsert items derived from the real zones (1 zone : 2 POIs)"""
+    rng = np.random.default_rng(seed)
+    vibes = sorted({v for z in zones for v in z.get("vibeKeywords", [])})
+    tags = sorted({t for z in zones for t in z.get("tags", [])})
+    words = sorted({w for z in zones for w in (z.get("desc") or "").lower().split()})
+    items = []
+    for i in range(size):
+        zone = zones[i % len(zones)]
+        item_vibes = list(rng.choice(vibes, size=3, replace=False))
+        item_tags = list(rng.choice(tags, size=2, replace=False))
+        extra = " ".join(rng.choice(words, size=8))
+        name = f"{zone['name']} {i}"
+        center = zone.get("center") or {"lat": 16.0, "lng": 108.0}
+        items.append({
+            "id": f"{zone['id']}-{i}",
+            "type": "zone" if i % 3 == 0 else "poi",
+            "text": f"{name}. {zone.get('desc', '')} {' '.join(item_vibes)} {' '.join(item_tags)} {extra}",
+            "payload": {
+                "name": name,
+                "province": zone.get("province"),
+                "tags": item_tags,
+                "vibes": item_vibes,
+                "rating": round(float(rng.uniform(3, 5)), 1),
+                "center": {"lat": center["lat"] + float(rng.normal(0, 0.2)),
+                           "lng": center["lng"] + float(rng.normal(0, 0.2))},
+                "radiusM": int(rng.integers(300, 3000)),
+            },
+        })
+    return items
+
+
+def make_queries(zones: List[Dict[str, Any]], count: int, seed: int = 1) -> Dict[str, List[Dict[str, Any]]]:
+    """Distinct /search and /hybrid-search bodies (distinct so the query cache does not hide encoding)"""
+    rng = np.random.default_rng(seed)
+    vibes = sorted({v for z in zones for v in z.get("vibeKeywords", [])})
+    provinces = sorted({z.get("province") for z in zones if z.get("province")})
+    search, hybrid = [], []
+    for i in range(count):
+        words = " ".join(rng.choice(vibes, size=3))
+        body = {"query": f"{words} {i}", "top_k": 10}
+        if i % 3 == 1:
+            body["filter_type"] = "zone"
+        if i % 3 == 2:
+            body["filter_province"] = str(rng.choice(provinces))
+        search.append(body)
+        hybrid.append({
+            "free_text": f"{words} {i}",
+            "vibes": list(rng.choice(vibes, size=2, replace=False)),
+            "avoid": [str(rng.choice(vibes))] if i % 2 else [],
+            "top_k": 10,
+        })
+    return {"search": search, "hybrid": hybrid}
+
+
+# ---------- measurement ----------
+
+def rss_bytes() -> int:
+    """Resident set size of this process (Linux /proc, else peak RSS)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def summarize(latencies: List[float], wall: float) -> Dict[str, float]:
+    ms = np.array(latencies) * 1000.0
+    return {
+        "requests": len(ms),
+        "qps": round(len(ms) / wall, 2) if wall else None,
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "mean_ms": round(float(ms.mean()), 3),
+    }
+
+
+async def run_load(client, path: str, bodies: List[Dict[str, Any]], concurrency: int) -> Dict[str, float]:
+    """Send every body with `concurrency` requests in flight"""
+    latencies: List[float] = []
+    pending = iter(bodies)
+
+    async def worker():
+        for body in pending:
+            t0 = time.perf_counter()
+            r = await client.post(path, json=body)
+            latencies.append(time.perf_counter() - t0)
+            r.raise_for_status()
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, time.perf_counter() - t0)
+
+
+def dir_bytes(directory: Path) -> int:
+    return sum(p.stat().st_size for p in Path(directory).iterdir() if p.is_file())
+
+
+# ---------- services ----------
+
+def import_service(service: str, dim: int, index_dir: Path):
+    """Import the service module with the stub encoder in place of the model / HF API"""
+    encoder = HashEncoder(dim)
+    os.environ["INDEX_DIR"] = str(index_dir)
+    os.environ.setdefault("EMBED_CACHE_SIZE", "0")
+    os.environ.setdefault("EXACT_VECTORS_PATH", str(index_dir / "vectors.npy"))
+    if service == "ai":
+        # app.py loads the model in startup() through encoders.load_encoder
+        stub = types.ModuleType("encoders")
+        stub.load_encoder = lambda *args, **kwargs: encoder
+        sys.modules["encoders"] = stub
+        sys.path.insert(0, str(SERVICES["ai"].parent))
+    spec = importlib.util.spec_from_file_location(f"bench_{service.replace('-', '_')}", SERVICES[service])
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    if service == "ai":
+        module.startup()
+    if service == "ai-embed":
+        async def embed(texts: List[str]) -> List[List[float]]:
+            return encoder.encode(texts).tolist()
+        module._get_embeddings = embed
+    return module, encoder
+
+
+def bulk_load(service: str, module, items: List[Dict[str, Any]], encoder: HashEncoder) -> Dict[str, Any]:
+    """Load the corpus outside HTTP (one writer pass); returns timing + memory"""
+    rss0 = rss_bytes()
+    t0 = time.perf_counter()
+    if service == "ai":
+        module.apply_upsert([module.UpsertItem(**item) for item in items])
+        n, vector_bytes = module.generation.ntotal, module.vector_bytes(module.generation.index)
+    else:
+        vectors = encoder.encode([item["text"] for item in items])
+        upsert = module.UpsertRequest(items=[module.UpsertItem(**item, vector=v) for item, v in zip(items, vectors.tolist())])
+        asyncio.run(module.upsert(upsert))
+        n = module._index.ntotal
+        try:
+            vector_bytes = int(module._index.sa_code_size()) * n
+        except RuntimeError:
+            vector_bytes = None
+    seconds = time.perf_counter() - t0
+    grown = rss_bytes() - rss0
+    return {
+        "load": {"seconds": round(seconds, 3), "items_per_s": round(len(items) / seconds, 1)},
+        "memory": {
+            "vectors": n,
+            "vector_bytes": vector_bytes,
+            "vector_bytes_per_vector": round(vector_bytes / n, 1) if vector_bytes and n else None,
+            "rss_growth_bytes": grown,
+            "rss_growth_per_vector": round(grown / n, 1) if n else None,
+        },
+    }
+
+
+def persistence(service: str, module, index_dir: Path) -> Optional[Dict[str, Any]]:
+    """Full checkpoint / load_index round trip (ai only)"""
+    if service != "ai":
+        return None
+    t0 = time.perf_counter()
+    module.checkpoint()
+    saved = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    module.load_index()
+    loaded = time.perf_counter() - t0
+    return {"save_s": round(saved, 3), "load_s": round(loaded, 3), "disk_bytes": dir_bytes(index_dir)}
+
+
+async def endpoints(service: str, module, zones, corpus, requests: int, levels: List[int]) -> Dict[str, Any]:
+    import httpx
+
+    queries = make_queries(zones, (requests + WARMUP_REQUESTS) * len(levels))
+    # /upsert: small batches re-writing existing items (ai-embed replaces the
+    # whole corpus per request, so only one request at a time is measured)
+    rng = np.random.default_rng(2)
+    if service == "ai":
+        upsert_path = "/upsert?wait=true"
+        upserts = [{"items": [corpus[j] for j in rng.integers(0, len(corpus), UPSERT_BATCH)]}
+                   for _ in range((requests + WARMUP_REQUESTS) * len(levels))]
+    else:
+        upsert_path = "/upsert"
+        upserts = [{"items": corpus}]
+
+    results: Dict[str, List[Dict[str, Any]]] = {"/search": [], "/hybrid-search": [], "/upsert": []}
+    transport = httpx.ASGITransport(app=module.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        cursor = 0
+        for level in levels:
+            batch = slice(cursor, cursor + requests + WARMUP_REQUESTS)
+            cursor = batch.stop
+            for path, bodies in (("/search", queries["search"][batch]), ("/hybrid-search", queries["hybrid"][batch])):
+                await run_load(client, path, bodies[:WARMUP_REQUESTS], level)
+                results[path].append({"concurrency": level, **await run_load(client, path, bodies[WARMUP_REQUESTS:], level)})
+            if service == "ai":
+                results["/upsert"].append({"concurrency": level, **await run_load(client, upsert_path, upserts[batch][WARMUP_REQUESTS:], level)})
+        if service != "ai":
+            results["/upsert"].append({"concurrency": 1, **await run_load(client, upsert_path, upserts * 3, 1)})
+    return results
+
+
+def run_size(service: str, size: int, dim: int, requests: int, levels: List[int], seed: int) -> Dict[str, Any]:
+    """One size in this process: load, persist, hit the endpoints"""
+    zones = load_zones()
+    corpus = make_corpus(zones, size, seed)
+    with tempfile.TemporaryDirectory(prefix="bench-") as tmp:
+        module, encoder = import_service(service, dim, Path(tmp))
+        result = {"size": size, "dim": dim}
+        result.update(bulk_load(service, module, corpus, encoder))
+        result["persistence"] = persistence(service, module, Path(tmp))
+        result["endpoints"] = asyncio.run(endpoints(service, module, zones, corpus, requests, levels))
+    return result
+
+
+# ---------- report ----------
+
+def environment(service: str) -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    import faiss
+    keys = ("INDEX_TYPE", "EXACT_SEARCH_THRESHOLD", "VECTOR_STORAGE", "EXACT_RERANK", "HNSW_M", "HNSW_EF_SEARCH",
+            "IVF_NLIST", "IVF_NPROBE", "PQ_M", "PQ_NBITS", "ENCODE_BATCHING", "QUERY_CACHE_SIZE")
+    return {
+        "service": service,
+        "commit": commit,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "faiss": faiss.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "config": {k: os.environ[k] for k in keys if k in os.environ},
+    }
+
+
+def run(service: str, sizes: List[int], dim: int, requests: int, levels: List[int], seed: int) -> Dict[str, Any]:
+    """Every size in its own child process (clean RSS baseline and module state)"""
+    report = {**environment(service), "stub_dim": dim, "requests_per_level": requests, "seed": seed, "results": []}
+    for size in sizes:
+        print(f"⏱️  {service}: {size} items", file=sys.stderr)
+        child = subprocess.run(
+            [sys.executable, __file__, "child", "--service", service, "--size", str(size), "--dim", str(dim),
+             "--requests", str(requests), "--concurrency", ",".join(map(str, levels)), "--seed", str(seed)],
+            stdout=subprocess.PIPE, check=True, text=True,
+        )
+        report["results"].append(json.loads(child.stdout.strip().splitlines()[-1]))
+    return report
+
+
+def compare(base: Dict[str, Any], head: Dict[str, Any]) -> List[str]:
+    """Per size / endpoint / concurrency: p50, p99 and QPS of head relative to base"""
+    lines = [f"{base.get('commit', '?')[:10]} -> {head.get('commit', '?')[:10]}"]
+    base_sizes = {r["size"]: r for r in base["results"]}
+    for result in head["results"]:
+        old = base_sizes.get(result["size"])
+        if old is None:
+            continue
+        lines.append(f"size {result['size']}: load {old['load']['seconds']}s -> {result['load']['seconds']}s")
+        for path, runs in result["endpoints"].items():
+            old_runs = {r["concurrency"]: r for r in old["endpoints"].get(path, [])}
+            for r in runs:
+                o = old_runs.get(r["concurrency"])
+                if o is None:
+                    continue
+                lines.append(
+                    f"  {path:<15} c={r['concurrency']:<3} "
+                    f"p50 {o['p50_ms']:.2f}->{r['p50_ms']:.2f}ms ({r['p50_ms'] / o['p50_ms'] - 1:+.0%})  "
+                    f"p99 {o['p99_ms']:.2f}->{r['p99_ms']:.2f}ms ({r['p99_ms'] / o['p99_ms'] - 1:+.0%})  "
+                    f"qps {o['qps']}->{r['qps']} ({r['qps'] / o['qps'] - 1:+.0%})"
+                )
+    return lines
+
+
+def _ints(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline search / upsert benchmark")
+    parser.add_argument("command", choices=["run", "compare", "child"])
+    parser.add_argument("files", nargs="*", help="compare: base.json head.json")
+    parser.add_argument("--service", choices=sorted(SERVICES), default="ai")
+    parser.add_argument("--sizes", type=_ints, default=[1000, 10000], help="e.g. 1000,10000,100000,1000000")
+    parser.add_argument("--size", type=int, default=1000)
+    parser.add_argument("--dim", type=int, default=None, help="stub embedding size (default: the service model's)")
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per endpoint and level")
+    parser.add_argument("--concurrency", type=_ints, default=[1, 4, 16])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="write the JSON report here (default: stdout)")
+    args = parser.parse_args()
+    dim = args.dim or DEFAULT_DIM[args.service]
+
+    if args.command == "child":
+        # The services log to stdout; keep it for the result line
+        with contextlib.redirect_stdout(sys.stderr):
+            result = run_size(args.service, args.size, dim, args.requests, args.concurrency, args.seed)
+        print(json.dumps(result))
+    elif args.command == "compare":
+        with open(args.files[0]) as f_base, open(args.files[1]) as f_head:
+            print("\n".join(compare(json.load(f_base), json.load(f_head))))
+    else:
+        report = run(args.service, args.sizes, dim, args.requests, args.concurrency, args.seed)
+        text = json.dumps(report, indent=2)
+        if args.out:
+            Path(args.out).write_text(text, encoding="utf-8")
+            print(f"✅ Wrote {args.out}", file=sys.stderr)
+        else:
+            print(text)
@@ -0,0 +1,160 @@
+"""
+BM25 Index
+In-process inverted index with Okapi BM25 scoring over zone/POI text.
+
+Tokenization is Vietnamese-aware: text is lowercased and diacritic-folded
+("Hội An" -> "hoi an", "Đà Nẵng" -> "da nang") so queries typed with or
+without accents match, and adjacent syllable bigrams ("hoi_an") are
+indexed next to single syllables so multi-syllable names score above
+documents that merely contain the same syllables apart.
+
+Like MetadataStore, an index is immutable once built: with_changes()
+returns a new one sharing untouched postings.
+"""
+
+import json
+import math
+import os
+import re
+import unicodedata
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+BM25_FILE = "bm25.npz"
+
+_COMBINING = re.compile(r"[\u0300-\u036f]")
+_WORD = re.compile(r"\w+")
+
+# (label, text) as seen by the index
+Doc = Tuple[int, str]
+
+
+def fold(text: str) -> str:
+    """Lowercase + strip Vietnamese diacritics (đ -> d)"""
+    text = unicodedata.normalize("NFD", (text or "").lower().replace("đ", "d"))
+    return _COMBINING.sub("", text)
+
+
+def tokenize(text: str) -> List[str]:
+    """Folded syllables followed by adjacent-syllable bigrams"""
+    syllables = _WORD.findall(fold(text))
+    return syllables + [f"{a}_{b}" for a, b in zip(syllables, syllables[1:])]
+
+
+class BM25Index:
+    """Immutable once built; with_changes() returns a new index"""
+
+    def __init__(self, doc_labels: Optional[np.ndarray] = None, doc_lens: Optional[np.ndarray] = None,
+                 postings: Optional[Dict[str, Tuple[np.ndarray, np.ndarray]]] = None,
+                 k1: float = 1.2, b: float = 0.75):
+        self.doc_labels = doc_labels if doc_labels is not None else np.zeros(0, dtype=np.int64)
+        self.doc_lens = doc_lens if doc_lens is not None else np.zeros(0, dtype=np.int32)
+        # term -> (sorted labels, term frequencies)
+        self.postings: Dict[str, Tuple[np.ndarray, np.ndarray]] = postings or {}
+        self.k1 = k1
+        self.b = b
+        self.avgdl = float(self.doc_lens.mean()) if len(self.doc_lens) else 0.0
+
+    def __len__(self) -> int:
+        return len(self.doc_labels)
+
+    # ---------- writes (copy-on-write) ----------
+
+    def with_changes(self, removed: Iterable[Doc], added: Iterable[Doc]) -> "BM25Index":
+        """
+        New index without the `removed` docs (their old text is needed to
+        find the postings they appear in) and with the `added` docs.
+        """
+        removed = list(removed)
+        added = [(int(l), Counter(tokenize(t))) for l, t in added]
+        drop = np.unique(np.array([l for l, _ in removed] + [l for l, _ in added], dtype=np.int64))
+
+        postings = dict(self.postings)
+        if len(drop):
+            for term in {t for _, text in removed for t in tokenize(text)}:
+                if term not in postings:
+                    continue
+                labels, tfs = postings[term]
+                keep = ~np.isin(labels, drop, assume_unique=True)
+                if keep.all():
+                    continue
+                if keep.any():
+                    postings[term] = (labels[keep], tfs[keep])
+                else:
+                    del postings[term]
+
+        grouped = defaultdict(lambda: ([], []))
+        for label, counts in added:
+            for term, tf in counts.items():
+                grouped[term][0].append(label)
+                grouped[term][1].append(tf)
+        for term, (labels, tfs) in grouped.items():
+            labels = np.array(labels, dtype=np.int64)
+            tfs = np.array(tfs, dtype=np.float32)
+            if term in postings:
+                labels = np.concatenate([postings[term][0], labels])
+                tfs = np.concatenate([postings[term][1], tfs])
+            order = np.argsort(labels, kind="stable")
+            postings[term] = (labels[order], tfs[order])
+
+        keep = ~np.isin(self.doc_labels, drop) if len(drop) else np.ones(len(self), dtype=bool)
+        doc_labels = np.concatenate([self.doc_labels[keep], np.array([l for l, _ in added], dtype=np.int64)])
+        doc_lens = np.concatenate([self.doc_lens[keep], np.array(
+            [sum(c.values()) for _, c in added], dtype=np.int32)])
+        order = np.argsort(doc_labels, kind="stable")
+        return BM25Index(doc_labels[order], doc_lens[order], postings, self.k1, self.b)
+
+    # ---------- reads ----------
+
+    def search(self, query: str) -> Tuple[np.ndarray, np.ndarray]:
+        """(labels, scores) of every doc matching a query term, best first"""
+        n_docs = len(self)
+        parts_l, parts_s = [], []
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            labels, tfs = posting
+            idf = math.log(1.0 + (n_docs - len(labels) + 0.5) / (len(labels) + 0.5))
+            dl = self.doc_lens[np.searchsorted(self.doc_labels, labels)]
+            norm = self.k1 * (1.0 - self.b + self.b * dl / self.avgdl)
+            parts_l.append(labels)
+            parts_s.append(idf * tfs * (self.k1 + 1.0) / (tfs + norm))
+        if not parts_l:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        labels, inverse = np.unique(np.concatenate(parts_l), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(parts_s)).astype(np.float32)
+        order = np.argsort(-scores, kind="stable")
+        return labels[order], scores[order]
+
+    # ---------- persistence ----------
+
+    def save(self, directory: Path):
+        directory = Path(directory)
+        terms = list(self.postings)
+        lengths = np.array([len(self.postings[t][0]) for t in terms], dtype=np.int64)
+        labels = np.concatenate([self.postings[t][0] for t in terms]) if terms else np.zeros(0, dtype=np.int64)
+        tfs = np.concatenate([self.postings[t][1] for t in terms]) if terms else np.zeros(0, dtype=np.float32)
+        tmp = directory / (BM25_FILE + ".tmp")
+        with open(tmp, "wb") as f:
+            np.savez(f, doc_labels=self.doc_labels, doc_lens=self.doc_lens,
+                     terms=np.array(json.dumps(terms, ensure_ascii=False)),
+                     lengths=lengths, labels=labels, tfs=tfs)
+        os.replace(tmp, directory / BM25_FILE)
+
+    @classmethod
+    def load(cls, directory: Path, k1: float = 1.2, b: float = 0.75) -> Optional["BM25Index"]:
+        path = Path(directory) / BM25_FILE
+        if not path.exists():
+            return None
+        with np.load(path) as data:
+            terms = json.loads(str(data["terms"]))
+            lengths, labels, tfs = data["lengths"], data["labels"], data["tfs"]
+            doc_labels, doc_lens = data["doc_labels"], data["doc_lens"]
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        postings = {t: (labels[s:e], tfs[s:e]) for t, s, e in zip(terms, starts, ends)}
+        return cls(doc_labels, doc_lens, postings, k1, b)
@@ -0,0 +1,133 @@
+"""
+Bulk Embed
+Streaming NDJSON embedding for /embed/stream.
+
+The request body is NDJSON (one `{"id": ..., "text": ...}` per line, sent
+chunked or not); the response is NDJSON too, one line per record as soon
+as its batch is encoded:
+
+  {"id": "poi:1", "embedding": [...]}
+  {"line": 7, "error": "missing 'text'"}           # bad record, skipped
+  {"id": "poi:9", "error": "..."}                  # its batch failed to encode
+  {"done": true, "count": 9998, "errors": 2}       # last line
+
+Records are read `window` at a time, sorted by length inside the window
+and encoded `batch_size` at a time, so batches carry little padding and
+results come back in that order (match them by id). The body is pulled
+only as fast as results are written out, which keeps memory at one window
+whatever the input size: a slow reader slows the upload down instead of
+growing buffers.
+"""
+
+import json
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Tuple
+
+import numpy as np
+from starlette.requests import ClientDisconnect
+from starlette.responses import StreamingResponse
+
+# (line number, record) of a parsed line; record is an error string when invalid
+Parsed = Tuple[int, Any]
+
+
+class LineTooLong(ValueError):
+    pass
+
+
+class NDJSONStream(StreamingResponse):
+    """
+    StreamingResponse whose body reads the request as it goes. Starlette's
+    version also listens for a disconnect on `receive`, which would race the
+    body for request chunks; here a client going away shows up as
+    ClientDisconnect in request.stream() (or a failed send) instead.
+    """
+    media_type = "application/x-ndjson"
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await self.stream_response(send)
+        except (ClientDisconnect, OSError):
+            return
+        if self.background is not None:
+            await self.background()
+
+
+async def read_lines(chunks: AsyncIterator[bytes], max_line_bytes: int) -> AsyncIterator[bytes]:
+    """Split a byte stream into non-empty lines, refusing lines over max_line_bytes"""
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines + [buffer]:
+            if len(line) > max_line_bytes:
+                raise LineTooLong(f"line longer than {max_line_bytes} bytes")
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
+
+
+def parse_record(line: bytes) -> Any:
+    """Record dict, or an error message for a bad line"""
+    try:
+        record = json.loads(line)
+    except ValueError as e:
+        return f"invalid JSON: {e}"
+    if not isinstance(record, dict):
+        return "expected an object"
+    if not isinstance(record.get("text"), str) or not record["text"].strip():
+        return "missing 'text'"
+    return record
+
+
+def _dump(obj: Dict[str, Any]) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+async def stream_embeddings(chunks: AsyncIterator[bytes],
+                            encode: Callable[[List[str]], Awaitable[np.ndarray]],
+                            window: int = 512, batch_size: int = 32,
+                            max_line_bytes: int = 1 << 20) -> AsyncIterator[bytes]:
+    """NDJSON result lines for the NDJSON records in `chunks`"""
+    count = errors = 0
+    pending: List[Parsed] = []
+
+    async def flush():
+        nonlocal count, errors
+        # Longest first: the first batch shows the worst-case latency early
+        pending.sort(key=lambda p: len(p[1]["text"]), reverse=True)
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            try:
+                vectors = await encode([record["text"] for _, record in batch])
+            except Exception as e:
+                errors += len(batch)
+                yield b"".join(_dump({"id": record.get("id", n), "error": f"encode failed: {e}"})
+                               for n, record in batch)
+                continue
+            count += len(batch)
+            yield b"".join(_dump({"id": record.get("id", n), "embedding": vector.tolist()})
+                           for (n, record), vector in zip(batch, vectors))
+        pending.clear()
+
+    try:
+        n = 0
+        async for line in read_lines(chunks, max_line_bytes):
+            n += 1
+            record = parse_record(line)
+            if isinstance(record, str):
+                errors += 1
+                yield _dump({"line": n, "error": record})
+                continue
+            pending.append((n, record))
+            if len(pending) >= window:
+                async for out in flush():
+                    yield out
+        async for out in flush():
+            yield out
+    except LineTooLong as e:
+        # Headers are gone already: report in-band and stop reading
+        errors += 1
+        yield _dump({"error": str(e)})
+    yield _dump({"done": True, "count": count, "errors": errors})
@@ -0,0 +1,229 @@
+"""
+Embedding Cache
+Persistent content-addressed store of text embeddings (SQLite-backed, LRU-bounded)
+and an in-process LRU/TTL cache of query vectors
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+
+def normalize_text(text: str) -> str:
+    """Collapse whitespace so trivially different texts share one entry"""
+    return " ".join(str(text or "").split())
+
+
+class EmbeddingCache:
+    """Maps (model name, normalized text) -> float32 vector stored as a raw blob"""
+
+    def __init__(self, path: Path, model_name: str, max_entries: int = 200_000,
+                 flush_every: int = 1024):
+        self.path = Path(path)
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.flush_every = flush_every
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # key -> last_used of hits not yet written; reads stay read-only and
+        # the recency updates go out in one batch
+        self._touched: Dict[bytes, int] = {}
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key BLOB PRIMARY KEY,"
+            " dim INTEGER NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " last_used INTEGER NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)"
+        )
+        row = self._conn.execute("SELECT COALESCE(MAX(last_used), 0) FROM embeddings").fetchone()
+        self._clock = row[0]
+
+    def key(self, text: str) -> bytes:
+        """Content address of a text for the current model"""
+        h = hashlib.sha256()
+        h.update(self.model_name.encode("utf-8"))
+        h.update(b"\0")
+        h.update(normalize_text(text).encode("utf-8"))
+        return h.digest()
+
+    def _tick(self) -> int:
+        self._clock += 1
+        return self._clock
+
+    def _write_touched(self):
+        # Caller holds the lock and commits
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                [(t, k) for k, t in self._touched.items()],
+            )
+            self._touched.clear()
+
+    def flush(self):
+        """Write pending last_used updates"""
+        with self._lock:
+            if self._touched:
+                self._write_touched()
+                self._conn.commit()
+
+    def get_many(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Look up vectors; returns None for texts that are not cached"""
+        keys = [self.key(t) for t in texts]
+        found: Dict[bytes, np.ndarray] = {}
+        with self._lock:
+            unique = list(dict.fromkeys(keys))
+            # SQLite caps the number of bound parameters per statement
+            for start in range(0, len(unique), 500):
+                chunk = unique[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    chunk,
+                ).fetchall()
+                for k, blob in rows:
+                    found[k] = np.frombuffer(blob, dtype=np.float32)
+            if found:
+                now = self._tick()
+                self._touched.update(dict.fromkeys(found, now))
+                if len(self._touched) >= self.flush_every:
+                    self._write_touched()
+                    self._conn.commit()
+            hits = sum(1 for k in keys if k in found)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return [found.get(k) for k in keys]
+
+    def put_many(self, texts: List[str], vectors: np.ndarray):
+        """Store vectors and evict least-recently-used entries above the bound"""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self._lock:
+            # Recency must be on disk before eviction picks the oldest rows
+            self._write_touched()
+            now = self._tick()
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, dim, vector, last_used) VALUES (?, ?, ?, ?)",
+                [(self.key(t), v.shape[0], v.tobytes(), now) for t, v in zip(texts, vectors)],
+            )
+            count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            overflow = count - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (overflow,),
+                )
+                self.evictions += overflow
+            self._conn.commit()
+
+    def encode(self, texts: List[str], encode_fn: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        """Return vectors for texts, calling encode_fn only for cache misses"""
+        cached = self.get_many(texts)
+        missing = list(dict.fromkeys(
+            normalize_text(t) for t, v in zip(texts, cached) if v is None
+        ))
+        if missing:
+            fresh = np.asarray(encode_fn(missing), dtype=np.float32)
+            self.put_many(missing, fresh)
+            by_text = dict(zip(missing, fresh))
+            cached = [v if v is not None else by_text[normalize_text(t)]
+                      for t, v in zip(texts, cached)]
+        return np.vstack(cached).astype(np.float32, copy=False)
+
+    def stats(self) -> Dict[str, int]:
+        """Cache counters for /stats"""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class QueryCache:
+    """Bounded in-memory LRU of normalized query text -> query vector, with TTL"""
+
+    def __init__(self, max_entries: int = 2048, ttl_sec: float = 3600.0):
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        key = normalize_text(text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (self.ttl_sec <= 0 or time.monotonic() - entry[1] < self.ttl_sec):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                # Expired
+                del self._entries[key]
+                self.evictions += 1
+            self.misses += 1
+            return None
+
+    def put(self, text: str, vector: np.ndarray):
+        vector = np.array(vector, dtype=np.float32)
+        vector.flags.writeable = False
+        key = normalize_text(text)
+        with self._lock:
+            self._entries[key] = (vector, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def encode(self, text: str, encode_fn: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        """Return the vector for one query, calling encode_fn on a miss"""
+        vector = self.get(text)
+        if vector is None:
+            vector = np.asarray(encode_fn([normalize_text(text)]), dtype=np.float32)[0]
+            self.put(text, vector)
+        return vector
+
+    def encode_many(self, texts: List[str], encode_fn: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        """Vectors for several queries (n x dim); all misses go to encode_fn in one call"""
+        vectors = [self.get(t) for t in texts]
+        missing = list(dict.fromkeys(normalize_text(t) for t, v in zip(texts, vectors) if v is None))
+        if missing:
+            encoded = dict(zip(missing, np.asarray(encode_fn(missing), dtype=np.float32)))
+            for i, t in enumerate(texts):
+                if vectors[i] is None:
+                    vectors[i] = encoded[normalize_text(t)]
+                    self.put(t, vectors[i])
+        return np.stack(vectors)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = len(self._entries)
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "ttl_sec": self.ttl_sec,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
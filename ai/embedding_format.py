@@ -0,0 +1,73 @@
+"""
+Embedding Formats
+Content negotiation for /embed responses:
+
+  - json    {"embeddings": [[...], ...]} float lists (default)
+  - binary  application/octet-stream: the raw little-endian rows, with
+            X-Embedding-Shape: "<n>,<dim>" and X-Embedding-Dtype
+  - base64  JSON carrying the same bytes base64-packed
+            ({"embeddings_b64": "...", "dtype": ..., "shape": [n, dim]})
+
+binary / base64 rows are float32 (default) or float16 (half the bytes,
+~3 significant digits: plenty for normalized vectors). The format comes
+from ?format= or the Accept header, the dtype from ?dtype= or an Accept
+parameter, e.g. `Accept: application/octet-stream; dtype=float16`.
+"""
+
+import base64
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+from fastapi import HTTPException
+from fastapi.responses import Response
+
+FORMATS = ("json", "binary", "base64")
+DTYPES = {"float32": "<f4", "float16": "<f2"}
+
+BINARY_TYPE = "application/octet-stream"
+BASE64_TYPE = "application/vnd.embeddings+json"
+
+
+def negotiate(accept: Optional[str], fmt: Optional[str] = None, dtype: Optional[str] = None) -> Tuple[str, str]:
+    """(format, dtype) from query parameters, else the Accept header"""
+    accept_fmt, accept_dtype = "json", None
+    for part in (accept or "").split(","):
+        media, *params = [p.strip() for p in part.split(";")]
+        found = {BINARY_TYPE: "binary", BASE64_TYPE: "base64"}.get(media.lower())
+        if found:
+            accept_fmt = found
+            accept_dtype = next((p.split("=", 1)[1].strip() for p in params if p.startswith("dtype=")), None)
+            break
+    fmt = (fmt or accept_fmt).lower()
+    dtype = (dtype or accept_dtype or "float32").lower()
+    if fmt not in FORMATS:
+        raise HTTPException(400, f"Unknown format '{fmt}', expected one of {FORMATS}")
+    if dtype not in DTYPES:
+        raise HTTPException(400, f"Unknown dtype '{dtype}', expected one of {tuple(DTYPES)}")
+    return fmt, dtype
+
+
+def pack(embeddings: np.ndarray, dtype: str) -> bytes:
+    """Row-major little-endian bytes of the (n x dim) matrix"""
+    return np.ascontiguousarray(embeddings, dtype=DTYPES[dtype]).tobytes()
+
+
+def render(embeddings: np.ndarray, fmt: str, dtype: str, key: str = "embeddings",
+           extra: Optional[Dict[str, Any]] = None):
+    """
+    Response for the negotiated format: a dict for json / base64
+    (serialized by the app as usual), raw bytes for binary. `key` names
+    the vector field ("embeddings" here, "vectors" in ai-embed).
+    """
+    extra = extra or {}
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if fmt == "json":
+        return {key: embeddings.tolist(), **extra}
+    shape = embeddings.shape
+    if fmt == "binary":
+        return Response(pack(embeddings, dtype), media_type=BINARY_TYPE, headers={
+            "X-Embedding-Shape": ",".join(map(str, shape)),
+            "X-Embedding-Dtype": dtype,
+        })
+    return {f"{key}_b64": base64.b64encode(pack(embeddings, dtype)).decode("ascii"),
+            "dtype": dtype, "shape": list(shape), **extra}
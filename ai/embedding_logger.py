@@ -1,24 +1,99 @@
 """
 Embedding Process Logger
 Tracks vector sync in detail with timing and consistency checks
+
+log() only appends to a bounded in-memory ring buffer; a background
+writer thread drains it in batches to embedding_sync.log (JSON lines),
+echoes entries to stdout, and rotates the file by size. When producers
+outrun the writer the oldest buffered entries are dropped (and counted)
+instead of blocking the request path.
 """
 
+import atexit
 import json
+import os
+import threading
 import time
+from collections import deque
 from pathlib import Path
 from datetime import datetime
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional
+
+LOG_FILE = Path(os.getenv("EMBED_LOG_FILE", "./embedding_sync.log"))
+# Entries buffered in memory before the oldest are dropped
+LOG_BUFFER_SIZE = int(os.getenv("EMBED_LOG_BUFFER", "10000"))
+# Writer wakes at least this often, or as soon as LOG_BATCH entries wait
+LOG_FLUSH_SEC = float(os.getenv("EMBED_LOG_FLUSH_SEC", "1.0"))
+LOG_BATCH = int(os.getenv("EMBED_LOG_BATCH", "256"))
+# Rotate at this size, keeping LOG_BACKUPS old files (.1 newest)
+LOG_MAX_BYTES = int(os.getenv("EMBED_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.getenv("EMBED_LOG_BACKUPS", "3"))
+# Echo entries to stdout (from the writer thread)
+LOG_ECHO = os.getenv("EMBED_LOG_ECHO", "1") == "1"
+
+# Bytes read per step by tail()
+TAIL_BLOCK = 8192
+
 
-LOG_FILE = Path("./embedding_sync.log")
+def _format(entry: Dict[str, Any]) -> str:
+    lines = [f"[{entry.get('timestamp', '')}] {entry.get('message', '')}"]
+    for k, v in (entry.get("details") or {}).items():
+        lines.append(f"    {k}: {v}")
+    return "\n".join(lines)
+
+
+def _last_lines(path: Path, n: int) -> List[str]:
+    """Last n lines of a file, read backwards block by block from the end"""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b""
+        while pos > 0 and data.count(b"\n") <= n:
+            step = min(TAIL_BLOCK, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+    lines = data.splitlines()
+    if pos > 0:
+        lines = lines[1:]  # first line may be cut in the middle
+    return [line.decode("utf-8", errors="replace") for line in lines[-n:] if line] if n > 0 else []
 
 
 class EmbeddingLogger:
     """Detailed logger for embedding operations"""
     
-    def __init__(self):
-        self.logs = []
+    def __init__(self, path: Path = LOG_FILE, buffer_size: int = LOG_BUFFER_SIZE,
+                 flush_sec: float = LOG_FLUSH_SEC, max_bytes: int = LOG_MAX_BYTES,
+                 backups: int = LOG_BACKUPS, echo: bool = LOG_ECHO):
+        self.path = Path(path)
+        self.flush_sec = flush_sec
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.echo = echo
+        # Ring buffer: deque.append from any thread, drained by the writer
+        self.logs = deque(maxlen=buffer_size)
+        self.dropped = 0
+        self.written = 0
         self.current_operation = None
         self.operation_start = None
+        self._wake = threading.Event()
+        self._write_lock = threading.Lock()
+        self._writer: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        atexit.register(self.flush)
+    
+    def _ensure_writer(self):
+        if self._writer is None:
+            with self._start_lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._run, name="embedding-logger", daemon=True)
+                    self._writer.start()
+    
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_sec)
+            self._wake.clear()
+            self.flush()
     
     def start_operation(self, operation_name: str):
         """Start timing an operation"""
@@ -34,22 +109,21 @@ class EmbeddingLogger:
             self.current_operation = None
     
     def log(self, message: str, details: Dict[str, Any] = None):
-        """Log a message with optional details"""
-        timestamp = datetime.now().isoformat()
+        """Log a message with optional details (buffered; written by the writer thread)"""
         log_entry = {
-            "timestamp": timestamp,
+            "timestamp": datetime.now().isoformat(),
             "message": message
         }
         
         if details:
             log_entry["details"] = details
         
+        if len(self.logs) == self.logs.maxlen:
+            self.dropped += 1  # deque drops the oldest entry
         self.logs.append(log_entry)
-        print(f"[{timestamp}] {message}")
-        
-        if details:
-            for k, v in details.items():
-                print(f"    {k}: {v}")
+        if len(self.logs) >= LOG_BATCH:
+            self._wake.set()
+        self._ensure_writer()
     
     def log_sync_start(self, zones_count: int):
         """Log sync start"""
@@ -94,6 +168,14 @@ class EmbeddingLogger:
             "index_type": "FLAT (IP)"
         })
     
+    def log_index_update(self, added: int, replaced: int, vectors_count: int):
+        """Log incremental index update"""
+        self.log(f"🔧 [Upsert] FAISS index updated", {
+            "added": added,
+            "replaced": replaced,
+            "vectors": vectors_count
+        })
+
     def log_consistency_check(self, vectors: int, metadata: int, consistent: bool):
         """Log consistency check result"""
         status = "✅ CONSISTENT" if consistent else "❌ MISMATCH"
@@ -120,38 +202,84 @@ class EmbeddingLogger:
         })
     
     def save(self):
-        """Save logs to file"""
-        try:
-            with open(LOG_FILE, 'a', encoding='utf-8') as f:
-                for log in self.logs:
-                    f.write(json.dumps(log, ensure_ascii=False) + "\n")
-            self.logs = []  # Clear after saving
-        except Exception as e:
-            print(f"⚠️  Failed to save logs: {e}")
+        """Ask the writer thread to flush the buffer now (does not block)"""
+        self._wake.set()
+        self._ensure_writer()
+    
+    def flush(self):
+        """Drain the buffer to the log file (and stdout), rotating by size"""
+        with self._write_lock:
+            batch = []
+            while self.logs:
+                try:
+                    batch.append(self.logs.popleft())
+                except IndexError:
+                    break
+            if not batch:
+                return
+            if self.echo:
+                print("\n".join(_format(entry) for entry in batch), flush=True)
+            try:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write("".join(json.dumps(log, ensure_ascii=False, default=str) + "\n" for log in batch))
+                    size = f.tell()
+                self.written += len(batch)
+                if self.max_bytes and size >= self.max_bytes:
+                    self._rotate()
+            except Exception as e:
+                print(f"⚠️  Failed to save logs: {e}")
+    
+    def _rotate(self):
+        """embedding_sync.log -> .1 -> .2 ... (oldest beyond LOG_BACKUPS removed)"""
+        if self.backups <= 0:
+            os.remove(self.path)
+            return
+        for i in range(self.backups - 1, 0, -1):
+            src = self.path.with_name(f"{self.path.name}.{i}")
+            if src.exists():
+                os.replace(src, self.path.with_name(f"{self.path.name}.{i + 1}"))
+        os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+    
+    def stats(self) -> Dict[str, Any]:
+        """Buffer counters"""
+        return {
+            "buffered": len(self.logs),
+            "buffer_size": self.logs.maxlen,
+            "written": self.written,
+            "dropped": self.dropped,
+        }
+    
+    def entries(self, lines: int = 50) -> List[Dict[str, Any]]:
+        """Last N entries written to disk (newest last), reaching into rotated files if needed"""
+        found: List[str] = []
+        for path in [self.path] + [self.path.with_name(f"{self.path.name}.{i}") for i in range(1, self.backups + 1)]:
+            if len(found) >= lines:
+                break
+            if not path.exists():
+                continue
+            found = _last_lines(path, lines - len(found)) + found
+        entries = []
+        for line in found:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+        return entries
     
     def tail(self, lines: int = 50):
-        """Get last N lines from log file"""
+        """Print the last N entries of the log file"""
         try:
-            with open(LOG_FILE, 'r', encoding='utf-8') as f:
-                all_lines = f.readlines()
+            self.flush()
+            entries = self.entries(lines)
+            if not entries:
+                print("⚠️  No log file found")
+                return
             
-            print(f"\n📋 Last {min(lines, len(all_lines))} log entries:")
+            print(f"\n📋 Last {len(entries)} log entries:")
             print("=" * 80)
-            
-            for line in all_lines[-lines:]:
-                log = json.loads(line)
-                timestamp = log.get('timestamp', '')
-                message = log.get('message', '')
-                details = log.get('details', {})
-                
-                print(f"[{timestamp}] {message}")
-                if details:
-                    for k, v in details.items():
-                        print(f"    {k}: {v}")
-            
+            for entry in entries:
+                print(_format(entry))
             print("=" * 80 + "\n")
-        except FileNotFoundError:
-            print("⚠️  No log file found")
         except Exception as e:
             print(f"⚠️  Error reading logs: {e}")
 
@@ -163,14 +291,19 @@ logger = EmbeddingLogger()
 def show_vector_comparison():
     """Show vector vs metadata comparison"""
     try:
+        from metadata_store import MetadataStore
+        
+        store = MetadataStore.load(Path("./index"))
         meta_path = Path("./index/meta.json")
-        if not meta_path.exists():
-            print("⚠️  No meta.json found")
+        if store is not None:
+            metadata = list(store.items())
+        elif meta_path.exists():
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                metadata = json.load(f)
+        else:
+            print("⚠️  No metadata found")
             return
         
-        with open(meta_path, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
-        
         import faiss
         idx_path = Path("./index/faiss.index")
         index = faiss.read_index(str(idx_path))
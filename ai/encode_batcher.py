@@ -0,0 +1,107 @@
+"""
+Encode Batcher
+Dynamic micro-batching of model.encode calls from concurrent requests
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+
+
+class _Pending:
+    __slots__ = ("texts", "future")
+
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.future: Future = Future()
+
+
+class EncodeBatcher:
+    """
+    Queues texts from many callers and encodes them together on one thread.
+
+    A request that finds nothing else queued is encoded right away, so a
+    lone caller pays no batching delay. Otherwise (concurrent callers) the
+    batch is flushed when it reaches max_batch_size texts or when the
+    oldest queued request has waited max_wait_ms.
+    """
+
+    def __init__(self, encode_fn: Callable[[List[str]], np.ndarray],
+                 max_batch_size: int = 32, max_wait_ms: float = 5.0):
+        self.encode_fn = encode_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.batches = 0
+        self.items = 0
+        self.max_seen = 0
+        self.immediate = 0
+        self._queue: "queue.Queue[_Pending]" = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="encode-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, texts: List[str]) -> Future:
+        """Queue texts; the future resolves to an (n, dim) float32 array"""
+        pending = _Pending(list(texts))
+        self._queue.put(pending)
+        return pending.future
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Blocking helper with the same signature as the raw encoder"""
+        return self.submit(texts).result()
+
+    def _collect(self) -> List[_Pending]:
+        batch = [self._queue.get()]
+        size = len(batch[0].texts)
+        if self._queue.empty():
+            # No other encode waiting: don't hold this one for the window
+            self.immediate += 1
+            return batch
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                pending = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(pending)
+            size += len(pending.texts)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            texts = [t for p in batch for t in p.texts]
+            try:
+                vectors = np.asarray(self.encode_fn(texts), dtype=np.float32)
+            except Exception as e:
+                for p in batch:
+                    p.future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.items += len(texts)
+            self.max_seen = max(self.max_seen, len(texts))
+
+            offset = 0
+            for p in batch:
+                p.future.set_result(vectors[offset:offset + len(p.texts)])
+                offset += len(p.texts)
+
+    def stats(self) -> Dict[str, Any]:
+        """Batching counters for /stats"""
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "queued": self._queue.qsize(),
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "largest_batch": self.max_seen,
+            "immediate_batches": self.immediate,
+        }
@@ -0,0 +1,127 @@
+"""
+Encode Pipeline
+Bulk encoding for large upserts and index rebuilds.
+
+Texts are ordered by token length and cut into batches of `batch_size`,
+so a batch pads to roughly its own length instead of the longest zone
+description in the corpus. Batches are encoded in-process (through the
+shared encoder, so queries keep interleaving with a sync) or, with
+`workers` > 0 and enough texts, fanned out to a pool of processes that
+each load their own copy of the model and use cpu_count / workers
+threads. Vectors come back in the caller's order either way.
+
+  pipeline = EncodePipeline(encode_fn, batch_size=64, workers=4,
+                            model_args=(MODEL_NAME, "torch", None, "avx2"),
+                            length_fn=token_lengths(model))
+  vectors = pipeline.encode(texts)          # (len(texts), dim) float32
+"""
+
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Model of a worker process, loaded once by _init_worker
+_worker_model = None
+
+
+def _init_worker(model_args: Tuple, threads: int):
+    global _worker_model
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    from encoders import load_encoder
+    _worker_model = load_encoder(*model_args)
+
+
+def _encode_in_worker(texts: List[str]) -> np.ndarray:
+    return _worker_model.encode(texts, batch_size=len(texts), normalize_embeddings=True,
+                                show_progress_bar=False, convert_to_numpy=True)
+
+
+def token_lengths(model) -> Callable[[List[str]], np.ndarray]:
+    """Length function counting the model's tokens (characters if it has no tokenizer)"""
+    tokenizer = getattr(model, "tokenizer", None)
+
+    def lengths(texts: List[str]) -> np.ndarray:
+        if tokenizer is None:
+            return np.fromiter((len(t) for t in texts), dtype=np.int64, count=len(texts))
+        ids = tokenizer(list(texts), add_special_tokens=False, truncation=True)["input_ids"]
+        return np.fromiter((len(i) for i in ids), dtype=np.int64, count=len(texts))
+    return lengths
+
+
+class EncodePipeline:
+    """Length-bucketed batches, optionally spread over worker processes"""
+
+    def __init__(self, encode_fn: Callable[[List[str]], np.ndarray], batch_size: int = 64,
+                 workers: int = 0, model_args: Optional[Tuple] = None,
+                 length_fn: Optional[Callable[[List[str]], np.ndarray]] = None,
+                 min_parallel: int = 0):
+        self.encode_fn = encode_fn
+        self.batch_size = max(1, batch_size)
+        self.workers = workers if model_args is not None else 0
+        self.model_args = model_args
+        self.length_fn = length_fn or (lambda texts: np.array([len(t) for t in texts], dtype=np.int64))
+        # Below this many texts the pool (and its first model load) is not worth it
+        self.min_parallel = min_parallel or 2 * self.batch_size * max(1, workers)
+        self.batches = 0
+        self.parallel_runs = 0
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _batches(self, texts: Sequence[str]) -> Tuple[np.ndarray, List[List[str]]]:
+        """(order, batches): texts[order] split into consecutive batches"""
+        order = np.argsort(self.length_fn(list(texts)), kind="stable")
+        ordered = [texts[i] for i in order]
+        return order, [ordered[i:i + self.batch_size] for i in range(0, len(ordered), self.batch_size)]
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                threads = max(1, (os.cpu_count() or 1) // self.workers)
+                # spawn: the parent already runs torch / FAISS threads, which fork would copy mid-state
+                self._pool = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker, initargs=(self.model_args, threads),
+                )
+                atexit.register(self.close)
+            return self._pool
+
+    def encode(self, texts: Sequence[str]) -> np.ndarray:
+        """(len(texts), dim) float32 vectors, in the order of `texts`"""
+        if not len(texts):
+            return self.encode_fn([])
+        order, batches = self._batches(texts)
+        self.batches += len(batches)
+        if self.workers > 0 and len(texts) >= self.min_parallel:
+            self.parallel_runs += 1
+            # Workers pull the next batch as they finish, so long and short batches even out
+            parts = list(self._get_pool().map(_encode_in_worker, batches))
+        else:
+            parts = [self.encode_fn(batch) for batch in batches]
+        vectors = np.vstack(parts).astype(np.float32, copy=False)
+        out = np.empty_like(vectors)
+        out[order] = vectors
+        return out
+
+    def stats(self) -> dict:
+        return {
+            "batch_size": self.batch_size,
+            "workers": self.workers,
+            "pool_started": self._pool is not None,
+            "batches": self.batches,
+            "parallel_runs": self.parallel_runs,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
@@ -0,0 +1,139 @@
+"""
+Encoder Backends
+Pluggable SentenceTransformer inference backends for CPU serving:
+
+  - torch      full-precision PyTorch (default)
+  - onnx       exported ONNX Runtime graph
+  - onnx-int8  dynamically int8-quantized ONNX graph
+
+Offline export + validation (cosine agreement against torch):
+
+  python encoders.py export   [--out ./onnx_model] [--quant avx2]
+  python encoders.py validate [--out ./onnx_model] [--quant avx2] [--index ./index]
+"""
+
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+BACKENDS = ("torch", "onnx", "onnx-int8")
+
+# Used by `validate` when no index is available to sample texts from
+SAMPLE_TEXTS = [
+    "biển",
+    "yên tĩnh",
+    "đi một tuần với người yêu, yên tĩnh, ít ồn, ngắm hoàng hôn",
+    "Bán đảo Sơn Trà. Thiên nhiên yên tĩnh, ngắm biển, hoàng hôn, ảnh đẹp.",
+    "Khu An Thượng. Ẩm thực, bar club, gần biển, sôi động về đêm, phù hợp cặp đôi.",
+    "Phố cổ Hội An, đèn lồng, ẩm thực địa phương, đi bộ buổi tối",
+    "Bà Nà Hills, cầu Vàng, khí hậu mát mẻ, vui chơi gia đình",
+    "chợ đêm, món ăn đường phố, giá rẻ",
+    "leo núi, cắm trại, săn mây",
+    "bảo tàng, lịch sử, kiến trúc Pháp",
+]
+
+
+def onnx_file(backend: str, quant: str) -> str:
+    """Path of the ONNX graph inside an exported model directory"""
+    if backend == "onnx-int8":
+        return f"onnx/model_qint8_{quant}.onnx"
+    return "onnx/model.onnx"
+
+
+def load_encoder(model_name: str, backend: str = "torch",
+                 onnx_dir: Optional[Path] = None, quant: str = "avx2") -> SentenceTransformer:
+    """Load the model with the requested backend (ONNX graphs come from `export`)"""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown ENCODER_BACKEND '{backend}', expected one of {BACKENDS}")
+    if backend == "torch":
+        return SentenceTransformer(model_name)
+
+    file_name = onnx_file(backend, quant)
+    if onnx_dir is None or not (Path(onnx_dir) / file_name).exists():
+        raise FileNotFoundError(
+            f"{file_name} not found in {onnx_dir}; run `python encoders.py export --out {onnx_dir}` first"
+        )
+    return SentenceTransformer(str(onnx_dir), backend="onnx", model_kwargs={"file_name": file_name})
+
+
+def export(model_name: str, out_dir: Path, quant: str = "avx2"):
+    """Export the ONNX graph and its int8 dynamic-quantized variant to out_dir"""
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    out_dir = Path(out_dir)
+    print(f"📦 Exporting {model_name} to ONNX -> {out_dir}")
+    t0 = time.time()
+    model = SentenceTransformer(model_name, backend="onnx")
+    model.save_pretrained(str(out_dir))
+    print(f"✅ ONNX graph saved in {time.time() - t0:.1f}s")
+
+    t0 = time.time()
+    export_dynamic_quantized_onnx_model(model, quant, str(out_dir))
+    print(f"✅ int8 ({quant}) graph saved in {time.time() - t0:.1f}s")
+
+
+def _encode(model: SentenceTransformer, texts: List[str]) -> np.ndarray:
+    return model.encode(texts, normalize_embeddings=True, show_progress_bar=False, convert_to_numpy=True)
+
+
+def _latency_ms(model: SentenceTransformer, texts: List[str]) -> float:
+    """Mean single-query latency"""
+    _encode(model, texts[:1])  # warm-up
+    t0 = time.perf_counter()
+    for t in texts:
+        _encode(model, [t])
+    return (time.perf_counter() - t0) * 1000.0 / len(texts)
+
+
+def validate(model_name: str, onnx_dir: Path, quant: str, texts: List[str]) -> Dict[str, Dict[str, float]]:
+    """Cosine agreement and latency of every backend against torch"""
+    reference = load_encoder(model_name, "torch")
+    ref = _encode(reference, texts)
+    report = {"torch": {"cosine_mean": 1.0, "cosine_min": 1.0, "latency_ms": _latency_ms(reference, texts)}}
+    for backend in BACKENDS[1:]:
+        try:
+            model = load_encoder(model_name, backend, onnx_dir, quant)
+        except FileNotFoundError as e:
+            print(f"⚠️  {backend}: {e}")
+            continue
+        cos = np.sum(_encode(model, texts) * ref, axis=1)
+        report[backend] = {
+            "cosine_mean": float(cos.mean()),
+            "cosine_min": float(cos.min()),
+            "latency_ms": _latency_ms(model, texts),
+        }
+    return report
+
+
+def _texts_from_index(index_dir: Path, limit: int) -> List[str]:
+    from metadata_store import MetadataStore
+
+    store = MetadataStore.load(index_dir)
+    if store is None:
+        return []
+    return [m["text"] for _, m in zip(range(limit), store.items())]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export / validate ONNX encoder backends")
+    parser.add_argument("command", choices=["export", "validate"])
+    parser.add_argument("--model", default=os.getenv("EMBEDDING_MODEL", "AITeamVN/Vietnamese_Embedding_v2"))
+    parser.add_argument("--out", default=os.getenv("ENCODER_ONNX_DIR", "./onnx_model"))
+    parser.add_argument("--quant", default=os.getenv("ENCODER_QUANT", "avx2"),
+                        help="arm64 | avx2 | avx512 | avx512_vnni")
+    parser.add_argument("--index", default=None, help="sample validation texts from this index dir")
+    parser.add_argument("--limit", type=int, default=200)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export(args.model, Path(args.out), args.quant)
+    else:
+        texts = _texts_from_index(Path(args.index), args.limit) if args.index else []
+        report = validate(args.model, Path(args.out), args.quant, texts or SAMPLE_TEXTS)
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,133 @@
+"""
+Exact Vectors
+Full-precision (float32) copy of every vector, for re-scoring the
+shortlist of a compressed index.
+
+  - vectors.npy        N x d float32, rows sorted by label
+  - vector_labels.npy  the N labels
+
+The files are part of a checkpoint and memory-mapped; writes between
+checkpoints only touch a small in-memory overlay (replaced / new rows and
+removed labels), so an upsert costs its batch size, not the corpus size.
+Only the rows a request re-scores are paged in, so the resident cost is
+the compressed index, the overlay and whatever the OS keeps in page cache.
+"""
+
+import os
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+
+VECTORS_FILE = "vectors.npy"
+LABELS_FILE = "vector_labels.npy"
+
+# Rows copied per step when writing a new file
+CHUNK_ROWS = 4096
+
+
+def _lookup(sorted_labels: np.ndarray, labels: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """(positions, found mask) of labels in a sorted label array"""
+    if not len(sorted_labels):
+        return np.zeros(len(labels), dtype=np.int64), np.zeros(len(labels), dtype=bool)
+    pos = np.minimum(np.searchsorted(sorted_labels, labels), len(sorted_labels) - 1)
+    return pos, sorted_labels[pos] == labels
+
+
+class ExactVectors:
+    """Immutable, label-addressed float32 vectors; with_changes() returns a new set"""
+
+    def __init__(self, labels: np.ndarray, vectors: np.ndarray,
+                 delta_labels: Optional[np.ndarray] = None, delta_vectors: Optional[np.ndarray] = None,
+                 dropped: Optional[np.ndarray] = None):
+        # Base rows (memory-mapped checkpoint file)
+        self.labels = labels
+        self.vectors = vectors
+        # Overlay since the checkpoint: rows written (win over the base) and
+        # base labels removed without being written again, all sorted
+        self.delta_labels = delta_labels if delta_labels is not None else np.zeros(0, dtype=np.int64)
+        self.delta_vectors = delta_vectors if delta_vectors is not None else np.zeros(
+            (0, vectors.shape[1]), dtype=np.float32)
+        self.dropped = dropped if dropped is not None else np.zeros(0, dtype=np.int64)
+
+    @property
+    def dim(self) -> int:
+        return self.vectors.shape[1]
+
+    def __len__(self) -> int:
+        _, in_base = _lookup(self.labels, self.delta_labels)
+        return len(self.labels) - len(self.dropped) + int((~in_base).sum())
+
+    @classmethod
+    def empty(cls, dim: int) -> "ExactVectors":
+        return cls(np.zeros(0, dtype=np.int64), np.zeros((0, dim), dtype=np.float32))
+
+    @classmethod
+    def load(cls, directory: Path) -> Optional["ExactVectors"]:
+        directory = Path(directory)
+        vec_path, lab_path = directory / VECTORS_FILE, directory / LABELS_FILE
+        if not vec_path.exists() or not lab_path.exists():
+            return None
+        labels = np.load(lab_path)
+        vectors = np.load(vec_path, mmap_mode="r")
+        if len(labels) != len(vectors):
+            return None  # interrupted write; callers fall back to the index
+        return cls(labels, vectors)
+
+    def get(self, labels: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(vectors, found mask) for labels; rows not found are zero"""
+        labels = np.asarray(labels, dtype=np.int64)
+        out = np.zeros((len(labels), self.dim), dtype=np.float32)
+        pos, found = _lookup(self.delta_labels, labels)
+        out[found] = self.delta_vectors[pos[found]]
+        rest = np.flatnonzero(~found)
+        if len(rest):
+            _, gone = _lookup(self.dropped, labels[rest])
+            rest = rest[~gone]
+            pos, hit = _lookup(self.labels, labels[rest])
+            out[rest[hit]] = self.vectors[pos[hit]]
+            found[rest[hit]] = True
+        return out, found
+
+    def with_changes(self, removed: np.ndarray, new_labels: np.ndarray,
+                     new_vectors: Optional[np.ndarray]) -> "ExactVectors":
+        """New set without `removed` labels and with `new_vectors` for `new_labels` (base file shared)"""
+        removed = np.asarray(removed, dtype=np.int64)
+        new_labels = np.asarray(new_labels, dtype=np.int64)
+        keep = ~np.isin(self.delta_labels, np.concatenate([removed, new_labels]))
+        labels = np.concatenate([self.delta_labels[keep], new_labels])
+        vectors = self.delta_vectors[keep]
+        if len(new_labels):
+            vectors = np.vstack([vectors, np.asarray(new_vectors, dtype=np.float32)])
+        order = np.argsort(labels)
+        _, in_base = _lookup(self.labels, removed)
+        dropped = np.setdiff1d(np.union1d(self.dropped, removed[in_base]), new_labels).astype(np.int64)
+        return ExactVectors(self.labels, self.vectors, labels[order], vectors[order], dropped)
+
+    def save(self, directory: Path, labels: np.ndarray, fallback: Callable[[np.ndarray], np.ndarray]):
+        """
+        Write the vectors for `labels` (sorted, the whole corpus) to
+        `directory` in chunks; rows missing here come from `fallback(labels)`
+        (e.g. index.reconstruct_batch). Written next to the target and
+        renamed into place, since readers may still map the old file.
+        """
+        directory = Path(directory)
+        labels = np.asarray(labels, dtype=np.int64)
+        tmp = directory / (VECTORS_FILE + ".tmp.npy")
+        if not len(labels):
+            np.save(tmp, np.zeros((0, self.dim), dtype=np.float32))
+        else:
+            out = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=(len(labels), self.dim))
+            for start in range(0, len(labels), CHUNK_ROWS):
+                chunk = labels[start:start + CHUNK_ROWS]
+                rows, found = self.get(chunk)
+                if not found.all():
+                    rows[~found] = fallback(chunk[~found])
+                out[start:start + CHUNK_ROWS] = rows
+            out.flush()
+            del out
+
+        lab_tmp = directory / (LABELS_FILE + ".tmp.npy")
+        np.save(lab_tmp, labels)
+        os.replace(tmp, directory / VECTORS_FILE)
+        os.replace(lab_tmp, directory / LABELS_FILE)
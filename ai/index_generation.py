@@ -0,0 +1,259 @@
+"""
+Index Generation
+Immutable snapshot of the FAISS index, its metadata, keyword postings, the
+BM25 lexical index, the geo grid, the optional full-precision vectors
+used to re-score compressed indexes, the tombstones (deleted labels still
+physically present) and derived lookup tables.
+
+Readers grab the current generation once per request and use only that
+object; writers build the next generation off to the side and publish it
+with a single reference assignment. Writes never copy the FAISS index:
+they go to a small delta (float32 vectors scored by brute force, plus the
+index labels they shadow) that a checkpoint folds into a new index.
+"""
+
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from bm25_index import BM25Index
+from exact_vectors import ExactVectors
+from geo_index import GeoIndex
+from index_factory import index_kind, search_params
+from keyword_index import KeywordIndex
+from metadata_store import MetadataStore
+
+
+class IndexDelta:
+    """
+    Vectors written since the FAISS index was built: sorted labels, their
+    float32 vectors, and the sorted index labels they replace or remove
+    (shadowed: skipped when searching the index). Immutable.
+    """
+
+    def __init__(self, labels: np.ndarray, vectors: np.ndarray, shadowed: Optional[np.ndarray] = None):
+        self.labels = labels
+        self.vectors = vectors
+        self.shadowed = shadowed if shadowed is not None else np.zeros(0, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    @classmethod
+    def empty(cls, dim: int) -> "IndexDelta":
+        return cls(np.zeros(0, dtype=np.int64), np.zeros((0, dim), dtype=np.float32))
+
+    def with_changes(self, removed: np.ndarray, labels: np.ndarray,
+                     vectors: Optional[np.ndarray]) -> "IndexDelta":
+        """New delta without `removed` labels and with `vectors` for `labels` (cost: delta + batch size)"""
+        removed = np.asarray(removed, dtype=np.int64)
+        labels = np.asarray(labels, dtype=np.int64)
+        # Removed labels not in the delta live in the index: shadow them
+        in_delta = np.isin(removed, self.labels)
+        shadowed = np.union1d(self.shadowed, removed[~in_delta]).astype(np.int64)
+        keep = ~np.isin(self.labels, np.concatenate([removed, labels]))
+        all_labels = np.concatenate([self.labels[keep], labels])
+        all_vectors = self.vectors[keep]
+        if len(labels):
+            all_vectors = np.vstack([all_vectors, np.asarray(vectors, dtype=np.float32)])
+        order = np.argsort(all_labels)
+        return IndexDelta(all_labels[order], all_vectors[order], shadowed)
+
+
+class IndexGeneration:
+    """Vectors + metadata + filter selectors that never change once published"""
+
+    def __init__(self, number: int, index, metadata: MetadataStore,
+                 keywords: Optional[KeywordIndex] = None, lexical: Optional[BM25Index] = None,
+                 exact: Optional[ExactVectors] = None, geo: Optional[GeoIndex] = None,
+                 tombstones: Optional[np.ndarray] = None, delta: Optional[IndexDelta] = None):
+        self.number = number
+        self.index = index
+        self.delta = delta if delta is not None else IndexDelta.empty(index.d)
+        self.metadata = metadata
+        self.keywords = keywords if keywords is not None else KeywordIndex()
+        self.lexical = lexical if lexical is not None else BM25Index()
+        self.exact = exact
+        self.geo = geo if geo is not None else GeoIndex()
+        # Sorted labels deleted but not yet compacted away: excluded by every
+        # filter selector (built once per generation), so hits pay nothing
+        self.tombstones = tombstones if tombstones is not None else np.zeros(0, dtype=np.int64)
+        self.created_at = time.time()
+        # Derived lazily by readers; identical for every reader of this generation.
+        # Only the (read-only) selectors and label arrays are cached:
+        # SearchParameters are built per search, see index_factory.search_params
+        self._selectors: Dict[tuple, Tuple[int, Any, np.ndarray, np.ndarray]] = {}
+        self._hashes: Optional[Dict[str, str]] = None
+        self._live: Optional[Tuple[Any, Any]] = None
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal - len(self.delta.shadowed) + len(self.delta)
+
+    @property
+    def live(self) -> int:
+        """Searchable vectors (ntotal minus tombstones)"""
+        return self.ntotal - len(self.tombstones)
+
+    def alive(self, labels: np.ndarray) -> np.ndarray:
+        """Boolean mask of labels that are not tombstoned"""
+        if not len(self.tombstones):
+            return np.ones(len(labels), dtype=bool)
+        return ~np.isin(labels, self.tombstones)
+
+    def hashes(self) -> Dict[str, str]:
+        """id -> content hash for /sync/manifest, decoded once per generation"""
+        if self._hashes is None:
+            self._hashes = self.metadata.hashes(exclude=self.tombstones)
+        return self._hashes
+
+    def derive(self, index, metadata: MetadataStore,
+               keywords: Optional[KeywordIndex] = None,
+               lexical: Optional[BM25Index] = None,
+               exact: Optional[ExactVectors] = None,
+               geo: Optional[GeoIndex] = None,
+               tombstones: Optional[np.ndarray] = None,
+               delta: Optional[IndexDelta] = None) -> "IndexGeneration":
+        """Next generation from a new index/metadata (/keywords/lexical/exact/geo/tombstones/delta) set"""
+        return IndexGeneration(self.number + 1, index, metadata, keywords, lexical, exact, geo, tombstones, delta)
+
+    def with_tombstones(self, labels: np.ndarray) -> "IndexGeneration":
+        """Next generation sharing everything, with `labels` tombstoned as well"""
+        return IndexGeneration(self.number + 1, self.index, self.metadata, self.keywords, self.lexical,
+                               self.exact, self.geo, np.union1d(self.tombstones, labels).astype(np.int64),
+                               self.delta)
+
+    def _live_selector(self):
+        """IDSelector excluding the tombstones and shadowed labels (None when there are none)"""
+        excluded = np.union1d(self.tombstones, self.delta.shadowed) if len(self.delta.shadowed) else self.tombstones
+        if not len(excluded):
+            return None
+        if self._live is None:
+            inner = faiss.IDSelectorBatch(excluded)
+            # IDSelectorNot keeps a raw pointer: hold on to `inner` as well
+            self._live = (faiss.IDSelectorNot(inner), inner)
+        return self._live[0]
+
+    def _selection(self, labels: np.ndarray):
+        """(count, IDSelector over the index part or None, labels, delta part) of sorted allowed labels"""
+        in_index = np.setdiff1d(labels, self.delta.shadowed, assume_unique=True) \
+            if len(self.delta.shadowed) else labels
+        sel = faiss.IDSelectorBatch(in_index) if len(in_index) else None
+        return len(labels), sel, labels, np.intersect1d(labels, self.delta.labels, assume_unique=True)
+
+    def _filter(self, filter_type: Optional[str], filter_province: Optional[str]):
+        key = (filter_type or None, filter_province or None)
+        cached = self._selectors.get(key)
+        if cached is None:
+            labels = self.metadata.labels[self.metadata.mask(filter_type, filter_province)]
+            if len(self.tombstones):
+                labels = labels[self.alive(labels)]
+            cached = self._selection(labels)
+            self._selectors[key] = cached
+        return cached
+
+    def _restrict(self, filter_type: Optional[str], filter_province: Optional[str], allowed: np.ndarray):
+        """Type/province filter intersected with an extra sorted label set (not cached)"""
+        if filter_type or filter_province:
+            allowed = np.intersect1d(self._filter(filter_type, filter_province)[2], allowed, assume_unique=True)
+        elif len(self.tombstones):
+            allowed = np.setdiff1d(allowed, self.tombstones, assume_unique=True)
+        return self._selection(allowed)
+
+    def filter_selector(self, filter_type: Optional[str], filter_province: Optional[str],
+                        allowed: Optional[np.ndarray] = None):
+        """
+        (allowed candidate count, IDSelector) for a type/province filter,
+        optionally restricted to `allowed` labels (e.g. a geo query).
+        No filter => (live vectors, tombstone-excluding selector or None).
+        """
+        if allowed is not None:
+            return self._restrict(filter_type, filter_province, allowed)[:2]
+        if not filter_type and not filter_province:
+            return self.live, self._live_selector()
+        return self._filter(filter_type, filter_province)[:2]
+
+    def search(self, query_emb: np.ndarray, k: int,
+               filter_type: Optional[str] = None, filter_province: Optional[str] = None,
+               ef_search: Optional[int] = None, nprobe: Optional[int] = None,
+               exact_threshold: int = 0, rerank: int = 0, allowed: Optional[np.ndarray] = None):
+        """
+        index.search of the query matrix (nq x d, one row per query)
+        restricted to the filter (only allowed labels are scored), and to
+        the sorted `allowed` labels when given. ANN indexes switch to exact
+        scoring of the allowed vectors when fewer than exact_threshold pass
+        the filter. With full-precision vectors available, rerank > 1
+        fetches k * rerank candidates from the (compressed) index and
+        re-scores them exactly. Delta vectors are scored exactly and merged.
+        """
+        fetch = k * rerank if rerank > 1 and self.exact is not None else k
+        if allowed is None and not filter_type and not filter_province:
+            params = search_params(self.index, self._live_selector(), ef_search, nprobe)
+            in_delta = self.delta.labels[self.alive(self.delta.labels)]
+        else:
+            n_allowed, sel, labels, in_delta = (self._filter(filter_type, filter_province) if allowed is None
+                                                else self._restrict(filter_type, filter_province, allowed))
+            if n_allowed < exact_threshold and index_kind(self.index) != "FLAT":
+                return self.exact_search(query_emb, k, labels)
+            params = search_params(self.index, sel, ef_search, nprobe) if sel is not None else None
+            if sel is None:
+                # Every allowed label is in the delta: nothing to search in the index
+                return self.exact_search(query_emb, k, in_delta)
+        scores, ids = self.index.search(query_emb, fetch, params=params)
+        if len(in_delta):
+            delta_scores, delta_ids = self.exact_search(query_emb, fetch, in_delta)
+            scores, ids = np.hstack([scores, delta_scores]), np.hstack([ids, delta_ids])
+            top = np.argsort(-scores, axis=1, kind="stable")[:, :fetch]
+            scores, ids = np.take_along_axis(scores, top, axis=1), np.take_along_axis(ids, top, axis=1)
+        if fetch > k:
+            return self._rescore(query_emb, k, scores, ids)
+        return scores, ids
+
+    def _rescore(self, query_emb: np.ndarray, k: int, scores: np.ndarray, ids: np.ndarray):
+        """Exact inner products for each query's shortlist, best k kept"""
+        out_scores = np.full((len(ids), k), -np.inf, dtype=np.float32)
+        out_ids = np.full((len(ids), k), -1, dtype=np.int64)
+        # Shortlists of a batch overlap; look every label up once
+        uniq = np.unique(ids[ids >= 0])
+        vecs, found = self.exact.get(uniq)
+        for i in range(len(ids)):
+            valid = ids[i] >= 0
+            labels = ids[i][valid]
+            pos = np.searchsorted(uniq, labels)
+            hit = found[pos]
+            sims = scores[i][valid].copy()
+            sims[hit] = vecs[pos[hit]] @ query_emb[i]
+            top = np.argsort(-sims, kind="stable")[:k]
+            out_scores[i, :len(top)] = sims[top]
+            out_ids[i, :len(top)] = labels[top]
+        return out_scores, out_ids
+
+    def vectors(self, labels: np.ndarray) -> np.ndarray:
+        """Stored vectors for labels: delta or full precision when kept, else index.reconstruct"""
+        labels = np.asarray(labels, dtype=np.int64)
+        if self.exact is not None:
+            vecs, found = self.exact.get(labels)
+        else:
+            vecs = np.zeros((len(labels), self.index.d), dtype=np.float32)
+            found = np.zeros(len(labels), dtype=bool)
+            if len(self.delta):
+                pos = np.minimum(np.searchsorted(self.delta.labels, labels), len(self.delta) - 1)
+                found = self.delta.labels[pos] == labels
+                vecs[found] = self.delta.vectors[pos[found]]
+        if not found.all():
+            vecs[~found] = self.index.reconstruct_batch(labels[~found])
+        return vecs
+
+    def exact_search(self, query_emb: np.ndarray, k: int, labels: np.ndarray):
+        """Brute-force inner product of every query against the stored vectors of `labels`"""
+        scores = np.full((len(query_emb), k), -np.inf, dtype=np.float32)
+        ids = np.full((len(query_emb), k), -1, dtype=np.int64)
+        if not len(labels):
+            return scores, ids
+        sims = query_emb @ self.vectors(labels).T
+        top = np.argsort(-sims, axis=1, kind="stable")[:, :k]
+        scores[:, :top.shape[1]] = np.take_along_axis(sims, top, axis=1)
+        ids[:, :top.shape[1]] = labels[top]
+        return scores, ids
@@ -0,0 +1,146 @@
+"""
+Keyword Index
+Term -> posting list (sorted int64 FAISS labels) for vibe/avoid matching.
+
+A term matches an item when it is a substring of the lowercased item text
+or equals one of its payload vibes. Postings exist only for terms the data
+defines (payload vibes) plus an optional fixed list of configured terms, so
+the index does not grow with query traffic; other query terms are matched
+against candidate text at query time.
+"""
+
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+KEYWORDS_FILE = "keywords.npz"
+
+# (label, text, vibes) as seen by the index
+Record = Tuple[int, str, Iterable[str]]
+
+
+def normalize_term(term: str) -> str:
+    return " ".join(str(term or "").lower().split())
+
+
+def _record_terms(vibes: Iterable[str]) -> set:
+    if isinstance(vibes, str):
+        vibes = [vibes]
+    return {normalize_term(v) for v in vibes or [] if normalize_term(v)}
+
+
+def _matches(term: str, text_lower: str, vibes: set) -> bool:
+    return term in vibes or term in text_lower
+
+
+def record_of(item: Dict) -> Record:
+    """(label, text, vibes) of a metadata record / upsert item dict"""
+    return item["label"], item.get("text", ""), (item.get("payload") or {}).get("vibes")
+
+
+def record_matches(term: str, item: Dict) -> bool:
+    """Same rule the postings use, for a single decoded record"""
+    _, text, vibes = record_of(item)
+    return _matches(normalize_term(term), (text or "").lower(), _record_terms(vibes))
+
+
+class KeywordIndex:
+    """Immutable once built; with_changes() returns a new index"""
+
+    def __init__(self, postings: Optional[Dict[str, np.ndarray]] = None, terms: Iterable[str] = ()):
+        self.postings: Dict[str, np.ndarray] = postings or {}
+        # Configured terms keep a posting even when nothing matches them
+        self.terms = frozenset(t for t in map(normalize_term, terms) if t)
+
+    def __contains__(self, term: str) -> bool:
+        return term in self.postings
+
+    def __len__(self) -> int:
+        return len(self.postings)
+
+    def posting(self, term: str) -> Optional[np.ndarray]:
+        """Sorted labels matching the term, or None when the term is not indexed"""
+        return self.postings.get(normalize_term(term))
+
+    def with_changes(self, removed: np.ndarray, added: Iterable[Record],
+                     all_records: Optional[Iterable[Record]] = None) -> "KeywordIndex":
+        """
+        Drop `removed` labels and index `added` records. A term not indexed
+        yet (a vibe seen for the first time, or a configured term) needs one
+        pass over `all_records`, the post-change corpus; it is only read then.
+        Postings left empty are dropped.
+        """
+        added = [(int(l), (t or "").lower(), _record_terms(v)) for l, t, v in added]
+        drop = np.unique(np.concatenate([
+            np.asarray(removed, dtype=np.int64),
+            np.array([l for l, _, _ in added], dtype=np.int64),
+        ]))
+
+        new_terms = set(self.terms)
+        for _, _, vibes in added:
+            new_terms |= vibes
+        new_terms -= set(self.postings)
+
+        postings: Dict[str, np.ndarray] = {}
+        for term, post in self.postings.items():
+            if len(drop):
+                post = post[~np.isin(post, drop, assume_unique=True)]
+            hits = [l for l, text, vibes in added if _matches(term, text, vibes)]
+            if hits:
+                post = np.union1d(post, np.array(hits, dtype=np.int64))
+            postings[term] = post
+
+        if new_terms:
+            found: Dict[str, list] = {t: [] for t in new_terms}
+            for label, text, vibes in (all_records if all_records is not None else added):
+                text, vibes = (text or "").lower(), _record_terms(vibes)
+                for term in new_terms:
+                    if _matches(term, text, vibes):
+                        found[term].append(int(label))
+            for term, labels in found.items():
+                postings[term] = np.unique(np.array(labels, dtype=np.int64))
+        return KeywordIndex({t: p for t, p in postings.items() if len(p) or t in self.terms}, self.terms)
+
+    def match_counts(self, labels: np.ndarray, terms: Iterable[str]) -> np.ndarray:
+        """Number of indexed terms each label matches (unindexed terms count 0)"""
+        counts = np.zeros(len(labels), dtype=np.int32)
+        for term in terms:
+            post = self.posting(term)
+            if post is not None and len(post):
+                counts += np.isin(labels, post)
+        return counts
+
+    def union(self, terms: Iterable[str]) -> np.ndarray:
+        """Labels matching any of the indexed terms"""
+        posts = [p for p in (self.posting(t) for t in terms) if p is not None and len(p)]
+        if not posts:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(posts))
+
+    # ---------- persistence ----------
+
+    def save(self, directory: Path):
+        directory = Path(directory)
+        terms = list(self.postings)
+        lengths = np.array([len(self.postings[t]) for t in terms], dtype=np.int64)
+        flat = np.concatenate([self.postings[t] for t in terms]) if terms else np.zeros(0, dtype=np.int64)
+        tmp = directory / (KEYWORDS_FILE + ".tmp")
+        with open(tmp, "wb") as f:
+            np.savez(f, terms=np.array(json.dumps(terms, ensure_ascii=False)), lengths=lengths, labels=flat)
+        os.replace(tmp, directory / KEYWORDS_FILE)
+
+    @classmethod
+    def load(cls, directory: Path, terms: Iterable[str] = ()) -> Optional["KeywordIndex"]:
+        path = Path(directory) / KEYWORDS_FILE
+        if not path.exists():
+            return None
+        with np.load(path) as data:
+            names = json.loads(str(data["terms"]))
+            lengths = data["lengths"]
+            flat = data["labels"]
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        return cls({t: flat[s:e] for t, s, e in zip(names, starts, ends)}, terms)
@@ -0,0 +1,263 @@
+"""
+Metadata Store
+Columnar, array-backed metadata for the vector index.
+
+  - label / type / province live in NumPy columns (type and province are
+    integer codes into small vocabularies), rows sorted by label
+  - id, text, payload and the content hash are packed as one UTF-8 JSON
+    record per row in an offset-indexed blob that is memory-mapped from disk and decoded
+    only for the rows a request actually returns
+
+On disk: meta.npz (columns + vocabularies) and meta.blob (records).
+JSON stays available as an export format (export_json / __main__).
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import sys
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+COLUMNS_FILE = "meta.npz"
+BLOB_FILE = "meta.blob"
+
+
+def content_hash(type: str, text: str, payload: Optional[Dict[str, Any]]) -> str:
+    """Stable hash of what an item is indexed from (used when the client sends none)"""
+    body = json.dumps({"type": type, "text": text, "payload": payload or {}},
+                      ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(body.encode("utf-8")).hexdigest()
+
+
+def _encode_record(item: Dict[str, Any]) -> bytes:
+    record = {"id": item["id"], "text": item.get("text", ""), "payload": item.get("payload") or {}}
+    if item.get("hash"):
+        record["hash"] = item["hash"]
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class MetadataStore:
+    """Immutable once built; with_changes() returns a new store"""
+
+    def __init__(self, labels: np.ndarray, type_codes: np.ndarray, province_codes: np.ndarray,
+                 segs: np.ndarray, offsets: np.ndarray, lengths: np.ndarray,
+                 types: List[str], provinces: List[str], segments: List[Any]):
+        self.labels = labels
+        self.type_codes = type_codes
+        self.province_codes = province_codes
+        self.segs = segs
+        self.offsets = offsets
+        self.lengths = lengths
+        self.types = types
+        self.provinces = provinces
+        self.segments = segments
+        self._type_lookup = {t: i for i, t in enumerate(types)}
+        self._province_lookup = {p: i for i, p in enumerate(provinces)}
+
+    # ---------- construction ----------
+
+    @classmethod
+    def empty(cls) -> "MetadataStore":
+        return cls.from_items([])
+
+    @classmethod
+    def from_items(cls, items: Iterable[Dict[str, Any]]) -> "MetadataStore":
+        """Build from dicts with id, label, type, text, payload (e.g. legacy meta.json)"""
+        empty = cls(
+            np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32),
+            np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32),
+            [], [], [],
+        )
+        return empty.with_changes(np.zeros(0, dtype=np.int64), list(items))
+
+    @classmethod
+    def load(cls, directory: Path) -> Optional["MetadataStore"]:
+        """Load columns into memory and memory-map the record blob"""
+        directory = Path(directory)
+        cols_path, blob_path = directory / COLUMNS_FILE, directory / BLOB_FILE
+        if not cols_path.exists() or not blob_path.exists():
+            return None
+        with np.load(cols_path) as cols:
+            vocab = json.loads(str(cols["vocab"]))
+            labels = cols["labels"]
+            type_codes = cols["type_codes"]
+            province_codes = cols["province_codes"]
+            offsets = cols["offsets"]
+            lengths = cols["lengths"]
+        if blob_path.stat().st_size > 0:
+            with open(blob_path, "rb") as f:
+                blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            blob = b""
+        return cls(labels, type_codes, province_codes, np.zeros(len(labels), dtype=np.int32),
+                   offsets, lengths, vocab["types"], vocab["provinces"], [blob])
+
+    def save(self, directory: Path):
+        """
+        Write meta.npz + meta.blob (blob compacted to live records only).
+
+        Files are written next to the targets and renamed into place: a
+        loaded store may still be reading the old blob through mmap.
+        """
+        directory = Path(directory)
+        lengths = self.lengths.astype(np.int64)
+        offsets = np.zeros(len(self), dtype=np.int64)
+        if len(self):
+            offsets[1:] = np.cumsum(lengths)[:-1]
+        blob_tmp = directory / (BLOB_FILE + ".tmp")
+        cols_tmp = directory / (COLUMNS_FILE + ".tmp")
+        with open(blob_tmp, "wb") as f:
+            for row in range(len(self)):
+                f.write(self._raw(row))
+        with open(cols_tmp, "wb") as f:
+            np.savez(
+                f,
+                labels=self.labels,
+                type_codes=self.type_codes,
+                province_codes=self.province_codes,
+                offsets=offsets,
+                lengths=self.lengths,
+                vocab=np.array(json.dumps({"types": self.types, "provinces": self.provinces},
+                                          ensure_ascii=False)),
+            )
+        os.replace(blob_tmp, directory / BLOB_FILE)
+        os.replace(cols_tmp, directory / COLUMNS_FILE)
+
+    # ---------- reads ----------
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def rows(self, labels: np.ndarray) -> np.ndarray:
+        """Row for each label, -1 where the label is absent"""
+        labels = np.asarray(labels, dtype=np.int64)
+        if not len(self.labels):
+            return np.full(len(labels), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.labels, labels), len(self.labels) - 1)
+        return np.where(self.labels[pos] == labels, pos, -1)
+
+    def contains(self, labels: np.ndarray) -> np.ndarray:
+        return self.rows(labels) >= 0
+
+    def _raw(self, row: int) -> bytes:
+        seg = self.segments[self.segs[row]]
+        off = int(self.offsets[row])
+        return seg[off:off + int(self.lengths[row])]
+
+    def record(self, row: int) -> Dict[str, Any]:
+        """Decode one row into the classic {id, label, type, text, payload} dict"""
+        rec = json.loads(self._raw(row))
+        return {
+            "id": rec["id"],
+            "label": int(self.labels[row]),
+            "type": self.types[self.type_codes[row]],
+            "text": rec["text"],
+            "payload": rec["payload"],
+        }
+
+    def hashes(self, exclude: Optional[np.ndarray] = None) -> Dict[str, str]:
+        """id -> content hash of every row (computed for records stored without one)"""
+        out = {}
+        rows = range(len(self))
+        if exclude is not None and len(exclude):
+            rows = np.flatnonzero(~np.isin(self.labels, exclude))
+        for row in rows:
+            rec = json.loads(self._raw(row))
+            out[rec["id"]] = rec.get("hash") or content_hash(
+                self.types[self.type_codes[row]], rec["text"], rec["payload"])
+        return out
+
+    def get(self, label: int) -> Optional[Dict[str, Any]]:
+        row = int(self.rows(np.array([label]))[0])
+        return self.record(row) if row >= 0 else None
+
+    def items(self) -> Iterator[Dict[str, Any]]:
+        for row in range(len(self)):
+            yield self.record(row)
+
+    def mask(self, filter_type: Optional[str] = None, filter_province: Optional[str] = None) -> np.ndarray:
+        """Boolean row mask for a type/province filter"""
+        mask = np.ones(len(self), dtype=bool)
+        if filter_type:
+            code = self._type_lookup.get(filter_type)
+            mask &= (self.type_codes == code) if code is not None else False
+        if filter_province:
+            code = self._province_lookup.get(filter_province)
+            mask &= (self.province_codes == code) if code is not None else False
+        return mask
+
+    def counts(self) -> Dict[str, Dict[str, int]]:
+        """Items per type and per province"""
+        return {
+            "types": {t: int(n) for t, n in zip(self.types, np.bincount(self.type_codes, minlength=len(self.types))) if n},
+            "provinces": {p: int(n) for p, n in zip(self.provinces, np.bincount(self.province_codes, minlength=len(self.provinces))) if n},
+        }
+
+    # ---------- writes (copy-on-write) ----------
+
+    def with_changes(self, removed: np.ndarray, added: List[Dict[str, Any]]) -> "MetadataStore":
+        """
+        New store without the `removed` labels and with `added` records
+        (each needs id, label, type, text, payload). Existing records are
+        shared, not copied: the added ones go to a new in-memory segment
+        until save() packs the live records into one blob that load() maps.
+        """
+        types, provinces = list(self.types), list(self.provinces)
+        type_lookup, province_lookup = dict(self._type_lookup), dict(self._province_lookup)
+
+        def code(vocab, lookup, value):
+            if value not in lookup:
+                lookup[value] = len(vocab)
+                vocab.append(value)
+            return lookup[value]
+
+        new_labels = np.array([a["label"] for a in added], dtype=np.int64)
+        drop = np.concatenate([np.asarray(removed, dtype=np.int64), new_labels])
+        keep = ~np.isin(self.labels, drop) if len(drop) else np.ones(len(self), dtype=bool)
+
+        records = [_encode_record(a) for a in added]
+        lengths = np.array([len(r) for r in records], dtype=np.int32)
+        offsets = np.zeros(len(records), dtype=np.int64)
+        if len(records):
+            offsets[1:] = np.cumsum(lengths, dtype=np.int64)[:-1]
+        segments = self.segments + ([b"".join(records)] if records else [])
+        new_seg = len(segments) - 1
+
+        labels = np.concatenate([self.labels[keep], new_labels])
+        order = np.argsort(labels, kind="stable")
+        store = MetadataStore(
+            labels[order],
+            np.concatenate([self.type_codes[keep], np.array(
+                [code(types, type_lookup, a["type"]) for a in added], dtype=np.int32)])[order],
+            np.concatenate([self.province_codes[keep], np.array(
+                [code(provinces, province_lookup, (a.get("payload") or {}).get("province", ""))
+                 for a in added], dtype=np.int32)])[order],
+            np.concatenate([self.segs[keep], np.full(len(added), new_seg, dtype=np.int32)])[order],
+            np.concatenate([self.offsets[keep], offsets])[order],
+            np.concatenate([self.lengths[keep], lengths])[order],
+            types, provinces, segments,
+        )
+        return store
+
+    # ---------- export ----------
+
+    def export_json(self, path: Path):
+        """Write the classic meta.json list (id, label, type, text, payload)"""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(list(self.items()), f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    # python metadata_store.py ./index meta.json
+    src = Path(sys.argv[1] if len(sys.argv) > 1 else "./index")
+    dst = Path(sys.argv[2] if len(sys.argv) > 2 else src / "meta.export.json")
+    store = MetadataStore.load(src)
+    if store is None:
+        print(f"⚠️  No {COLUMNS_FILE}/{BLOB_FILE} in {src}")
+        sys.exit(1)
+    store.export_json(dst)
+    print(f"✅ Exported {len(store)} records to {dst}")
@@ -0,0 +1,61 @@
+"""
+Shared fixtures: the service module imported against a temporary
+INDEX_DIR, with benchmark.HashEncoder in place of the model (nothing is
+downloaded). Importing it again on the same directory is a restart.
+"""
+
+import importlib.util
+import itertools
+import os
+import sys
+import tempfile
+import types
+from pathlib import Path
+
+import pytest
+
+AI_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(AI_DIR))
+
+from benchmark import HashEncoder  # noqa: E402
+
+DIM = 16
+_imports = itertools.count()
+
+# embedding_logger reads these once, at its first import
+os.environ.setdefault("EMBED_LOG_FILE", os.path.join(tempfile.mkdtemp(), "embedding_sync.log"))
+os.environ.setdefault("EMBED_LOG_ECHO", "0")
+
+
+@pytest.fixture
+def index_dir(tmp_path, monkeypatch):
+    directory = tmp_path / "index"
+    monkeypatch.setenv("INDEX_DIR", str(directory))
+    monkeypatch.setenv("EMBED_CACHE_SIZE", "0")
+    monkeypatch.setenv("ENCODE_BATCHING", "0")
+    monkeypatch.setenv("WAL_FSYNC", "0")
+    # Checkpoints only when a test asks for one
+    monkeypatch.setenv("CHECKPOINT_INTERVAL_SEC", "3600")
+    monkeypatch.setitem(sys.modules, "encoders", types.SimpleNamespace(
+        load_encoder=lambda *args, **kwargs: HashEncoder(DIM)))
+    return directory
+
+
+@pytest.fixture
+def start_service(index_dir):
+    """start_service() -> a freshly imported (and started) app module on index_dir"""
+    def start(run_startup: bool = True):
+        spec = importlib.util.spec_from_file_location(f"app_under_test_{next(_imports)}", AI_DIR / "app.py")
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        if run_startup:
+            module.startup()
+        return module
+    return start
+
+
+def zone(i: int, **fields) -> dict:
+    item = {"id": f"zone:{i}", "type": "zone", "text": f"khu {i} biển yên tĩnh hoàng hôn",
+            "payload": {"province": "Đà Nẵng"}}
+    item.update(fields)
+    return item
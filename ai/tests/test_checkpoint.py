@@ -0,0 +1,113 @@
+"""Checkpoint / WAL interplay of ai/app.py"""
+
+import threading
+
+import pytest
+
+from conftest import zone
+
+
+def upsert(service, ids):
+    return service.apply_upsert([service.UpsertItem(**zone(i)) for i in ids])
+
+
+def assert_readable(service, count):
+    gen = service.generation
+    assert gen.ntotal == count
+    assert len(gen.metadata) == count
+    vecs = gen.vectors(gen.metadata.labels)
+    assert vecs.shape == (count, gen.index.d)
+
+
+def test_upsert_between_fold_and_capture_survives_restart(start_service):
+    service = start_service()
+    upsert(service, range(20))
+
+    fold_delta = service.fold_delta
+    jobs = []
+
+    def fold_then_upsert():
+        fold_delta()
+        # A client upsert arriving right after the fold must not slip into
+        # the checkpoint's generation as unsaved delta
+        job = service.upsert_jobs.submit([service.UpsertItem(**zone(i)) for i in (20, 21)])
+        jobs.append(job)
+        job.done.wait(timeout=0.5)
+
+    service.fold_delta = fold_then_upsert
+    service.checkpoint()
+    service.fold_delta = fold_delta
+    assert jobs[0].done.wait(timeout=10) and jobs[0].status == "done"
+    assert_readable(service, 22)
+
+    restarted = start_service()
+    assert_readable(restarted, 22)
+
+
+def test_save_index_rejects_unfolded_delta(start_service):
+    service = start_service()
+    upsert(service, range(3))
+    assert len(service.generation.delta) == 3
+    with pytest.raises(ValueError, match="unfolded delta"):
+        service.save_index(service.generation, service.wal.seq)
+
+
+def ids_of(service):
+    return sorted(m["id"] for m in service.generation.metadata.items())
+
+
+def test_wal_replays_writes_after_crash(start_service, index_dir):
+    service = start_service()
+    upsert(service, range(10))
+    service.checkpoint()
+    upsert(service, [3, 10, 11])
+    service.delete(service.DeleteRequest(ids=["zone:4", "zone:11"]))
+    before = service.generation
+    # No checkpoint: the process just stops
+    restarted = start_service()
+    gen = restarted.generation
+    assert restarted.last_checkpoint["seq"] < restarted.wal.seq
+    assert gen.number == before.number
+    # Replayed deletes are removed outright rather than tombstoned
+    assert ids_of(restarted) == sorted(f"zone:{i}" for i in set(range(12)) - {4, 11})
+    assert_readable(restarted, 10)
+
+
+def test_torn_wal_tail_is_dropped(start_service, index_dir):
+    service = start_service()
+    upsert(service, range(4))
+    upsert(service, [4])
+    segment = sorted((index_dir / "wal").glob("*.log"))[-1]
+    data = segment.read_bytes()
+    segment.write_bytes(data[:-7])  # crash in the middle of the last append
+    restarted = start_service()
+    assert ids_of(restarted) == [f"zone:{i}" for i in range(4)]
+
+
+def test_checkpoint_interleaved_with_upserts(start_service):
+    service = start_service()
+    upsert(service, range(50))
+    stop = threading.Event()
+    written = []
+
+    def writer():
+        i = 50
+        while not stop.is_set():
+            job = service.upsert_jobs.submit([service.UpsertItem(**zone(i))])
+            job.done.wait()
+            written.append(i)
+            i += 1
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        for _ in range(50):
+            service.checkpoint()
+    finally:
+        stop.set()
+        thread.join()
+
+    restarted = start_service()
+    expected = 50 + len(written)
+    assert_readable(restarted, expected)
+    assert ids_of(restarted) == sorted(f"zone:{i}" for i in range(expected))
@@ -0,0 +1,71 @@
+"""/delete ordering against queued and running upsert jobs"""
+
+import time
+
+from conftest import zone
+
+
+def wait_for(predicate, timeout=10.0):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def live_ids(service):
+    gen = service.generation
+    return sorted(m["id"] for m in gen.metadata.items() if m["label"] not in set(gen.tombstones.tolist()))
+
+
+def test_delete_wins_over_earlier_upserts_not_yet_written(start_service):
+    service = start_service()
+    service.apply_upsert([service.UpsertItem(**zone(0))])
+    with service.upsert_jobs.writer_lock:
+        # The worker takes `running` and then waits for the lock; `queued` stays queued
+        running = service.upsert_jobs.submit([service.UpsertItem(**zone(i)) for i in (1, 2)])
+        wait_for(lambda: running.status == "running")
+        queued = service.upsert_jobs.submit([service.UpsertItem(**zone(i)) for i in (3, 4)])
+        result = service.delete(service.DeleteRequest(ids=["zone:0", "zone:1", "zone:3"]))
+    assert result["deleted"] == 3
+    assert running.done.wait(timeout=10) and queued.done.wait(timeout=10)
+    assert queued.cancelled == 1
+    assert live_ids(service) == ["zone:2", "zone:4"]
+    assert set(service.sync_manifest()["items"]) == {"zone:2", "zone:4"}
+
+    # A later upsert of a deleted id brings it back
+    service.upsert(service.UpsertRequest(items=[service.UpsertItem(**zone(1))]), wait=True)
+    assert live_ids(service) == ["zone:1", "zone:2", "zone:4"]
+
+    restarted = start_service()
+    assert sorted(m["id"] for m in restarted.generation.metadata.items()) == ["zone:1", "zone:2", "zone:4"]
+
+
+def test_compaction_removes_vectors_from_the_index(start_service, monkeypatch):
+    service = start_service()
+    service.apply_upsert([service.UpsertItem(**zone(i)) for i in range(10)])
+    service.checkpoint()
+    assert service.generation.index.ntotal == 10
+    monkeypatch.setattr(service, "TOMBSTONE_COMPACT_RATIO", 0.3)
+    service.delete(service.DeleteRequest(ids=[f"zone:{i}" for i in range(4)]))
+    service.compaction_thread.join(timeout=10)
+    gen = service.generation
+    assert len(gen.tombstones) == 0 and len(gen.delta.shadowed) == 0
+    assert gen.index.ntotal == 6
+    assert live_ids(service) == [f"zone:{i}" for i in range(4, 10)]
+
+
+def test_fully_cancelled_job_skips_the_write(start_service):
+    service = start_service()
+    service.apply_upsert([service.UpsertItem(**zone(0))])
+    before = service.generation.number
+    with service.upsert_jobs.writer_lock:
+        running = service.upsert_jobs.submit([service.UpsertItem(**zone(1))])
+        wait_for(lambda: running.status == "running")
+        queued = service.upsert_jobs.submit([service.UpsertItem(**zone(i)) for i in (2, 3)])
+        service.delete(service.DeleteRequest(ids=["zone:2", "zone:3"]))
+    assert running.done.wait(timeout=10) and queued.done.wait(timeout=10)
+    assert queued.status == "done" and queued.result == {"cancelled": True}
+    assert queued.cancelled == 2
+    # Only the running job published a generation
+    assert service.generation.number == before + 1
+    assert live_ids(service) == ["zone:0", "zone:1"]
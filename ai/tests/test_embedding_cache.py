@@ -0,0 +1,65 @@
+"""Persistent, content-addressed document embedding cache"""
+
+import numpy as np
+
+from embedding_cache import EmbeddingCache
+
+
+class CountingEncoder:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, texts):
+        self.calls.append(list(texts))
+        return np.array([[len(t), 1.0] for t in texts], dtype=np.float32)
+
+
+def test_only_misses_are_encoded_and_survive_reopening(tmp_path):
+    path = tmp_path / "cache.sqlite"
+    encoder = CountingEncoder()
+    cache = EmbeddingCache(path, "model-a")
+    first = cache.encode(["biển", "núi  cao", "biển"], encoder)
+    assert encoder.calls == [["biển", "núi cao"]]
+
+    reopened = EmbeddingCache(path, "model-a")
+    again = reopened.encode(["núi cao", "biển", "phố cổ"], encoder)
+    assert encoder.calls[1:] == [["phố cổ"]]
+    np.testing.assert_array_equal(again[:2], first[[1, 0]])
+    assert reopened.stats()["hits"] == 2
+
+    # Another model (or backend / quantization) never sees these vectors
+    EmbeddingCache(path, "model-a#onnx-int8#arm64").encode(["biển"], encoder)
+    assert encoder.calls[-1] == ["biển"]
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    encoder = CountingEncoder()
+    cache = EmbeddingCache(tmp_path / "cache.sqlite", "m", max_entries=2)
+    cache.encode(["a"], encoder)
+    cache.encode(["b"], encoder)
+    cache.encode(["a"], encoder)  # refresh a
+    cache.encode(["c"], encoder)  # evicts b
+    assert cache.stats()["entries"] == 2 and cache.stats()["evictions"] == 1
+    calls = len(encoder.calls)
+    cache.encode(["a", "c"], encoder)
+    assert len(encoder.calls) == calls
+
+
+def test_hits_do_not_write_until_flushed(tmp_path):
+    path = tmp_path / "cache.sqlite"
+    encoder = CountingEncoder()
+    cache = EmbeddingCache(path, "m", flush_every=3)
+    cache.encode(["a", "b", "c"], encoder)
+    written = cache._conn.total_changes
+    cache.encode(["a"], encoder)
+    cache.encode(["b"], encoder)
+    assert cache._conn.total_changes == written
+    cache.encode(["c"], encoder)  # third touched key triggers the batch
+    assert cache._conn.total_changes == written + 3
+
+    cache.encode(["a"], encoder)
+    cache.flush()
+    (a_used,) = cache._conn.execute(
+        "SELECT last_used FROM embeddings WHERE key = ?", (cache.key("a"),)
+    ).fetchone()
+    assert a_used == cache._clock
@@ -0,0 +1,40 @@
+"""Length-bucketed batching of EncodePipeline"""
+
+import numpy as np
+from fastapi.testclient import TestClient
+
+from encode_pipeline import EncodePipeline
+
+
+def test_batches_are_length_sorted_and_results_keep_input_order():
+    batches = []
+
+    def encode(texts):
+        batches.append(list(texts))
+        return np.array([[len(t), i] for i, t in enumerate(texts)], dtype=np.float32)
+
+    texts = ["x" * n for n in (9, 1, 7, 3, 5, 2, 8)]
+    pipeline = EncodePipeline(encode, batch_size=3)
+    vectors = pipeline.encode(texts)
+
+    assert [[len(t) for t in b] for b in batches] == [[1, 2, 3], [5, 7, 8], [9]]
+    np.testing.assert_array_equal(vectors[:, 0], [len(t) for t in texts])
+    assert pipeline.stats()["batches"] == 3 and not pipeline.stats()["pool_started"]
+
+
+def test_no_pool_without_model_args():
+    pipeline = EncodePipeline(lambda texts: np.zeros((len(texts), 2), dtype=np.float32), workers=4)
+    assert pipeline.workers == 0
+    assert pipeline.encode(["a"] * 500).shape == (500, 2)
+
+
+def test_service_import_is_cheap_and_lifespan_starts_it(start_service, index_dir):
+    # Spawned encode workers re-import the parent's __main__: that must not
+    # load the model, open the WAL or start threads
+    service = start_service(run_startup=False)
+    assert service.model is None and service.generation is None
+    assert not (index_dir / "wal").exists()
+
+    with TestClient(service.app) as client:
+        assert client.get("/healthz").status_code == 200
+    assert service.DIM == 16 and (index_dir / "wal").exists()
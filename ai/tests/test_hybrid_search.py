@@ -0,0 +1,19 @@
+"""/hybrid-search ranking of ai/app.py"""
+
+import pytest
+
+from conftest import zone
+
+
+@pytest.mark.parametrize("lexical", [False, True])
+def test_hits_are_ordered_by_score(start_service, lexical):
+    service = start_service()
+    service.apply_upsert([service.UpsertItem(**zone(i, text=f"khu {i} " + "biển " * (i % 4) + "chợ đêm"))
+                          for i in range(30)])
+    result = service.hybrid_search(service.HybridSearchRequest(
+        free_text="biển chợ đêm", vibes=["biển"], top_k=10, lexical=lexical))
+    scores = [hit["score"] for hit in result["hits"]]
+    assert len(scores) == 10
+    assert scores == sorted(scores, reverse=True)
+    assert ("semantic_score" in result["hits"][0]) == (result["lexical_candidates"] > 0)
+    assert bool(result["lexical_candidates"]) == lexical
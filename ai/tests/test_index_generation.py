@@ -0,0 +1,77 @@
+"""IndexDelta bookkeeping, delta-aware search and the checkpoint fold"""
+
+import faiss
+import numpy as np
+
+from index_generation import IndexDelta, IndexGeneration
+from metadata_store import MetadataStore
+
+from conftest import zone
+
+DIM = 8
+
+
+def unit(rows):
+    vecs = np.random.default_rng(rows).standard_normal((rows, DIM)).astype(np.float32)
+    return vecs / np.linalg.norm(vecs, axis=1, keepdims=True)
+
+
+def generation(labels, vectors, delta=None, tombstones=None):
+    index = faiss.IndexIDMap2(faiss.IndexFlatIP(DIM))
+    index.add_with_ids(vectors, labels)
+    all_labels = np.union1d(labels, delta.labels if delta is not None else [])
+    metadata = MetadataStore.from_items(
+        [{"id": f"zone:{l}", "label": int(l), "type": "zone", "text": "", "payload": {}} for l in all_labels])
+    return IndexGeneration(1, index, metadata, tombstones=tombstones, delta=delta)
+
+
+def test_delta_shadows_index_labels_and_replaces_its_own():
+    vecs = unit(3)
+    delta = IndexDelta.empty(DIM).with_changes(np.array([10, 11]), np.array([10, 20]), vecs[:2])
+    # 10 is rewritten: replaced label in the index is shadowed, new vector sits in the delta
+    np.testing.assert_array_equal(delta.labels, [10, 20])
+    np.testing.assert_array_equal(delta.shadowed, [10, 11])
+
+    delta = delta.with_changes(np.array([20]), np.array([30]), vecs[2:])
+    # 20 only ever lived in the delta: dropped, not shadowed
+    np.testing.assert_array_equal(delta.labels, [10, 30])
+    np.testing.assert_array_equal(delta.shadowed, [10, 11])
+    np.testing.assert_allclose(delta.vectors, vecs[[0, 2]])
+
+
+def test_search_merges_delta_and_skips_shadowed_and_tombstoned():
+    vecs = unit(6)
+    labels = np.array([1, 2, 3, 4], dtype=np.int64)
+    # 1 is rewritten with vector 4, 2 removed, 5 added with vector 5
+    delta = IndexDelta.empty(DIM).with_changes(np.array([1, 2]), np.array([1, 5]), vecs[[4, 5]])
+    gen = generation(labels, vecs[:4], delta, tombstones=np.array([3], dtype=np.int64))
+    assert gen.ntotal == 4 and gen.live == 3
+
+    scores, ids = gen.search(vecs[[4]], 4)
+    found = ids[0][ids[0] >= 0]
+    assert found[0] == 1 and np.isclose(scores[0][0], 1.0)
+    assert set(found) == {1, 4, 5}
+    np.testing.assert_allclose(gen.vectors(np.array([1, 4, 5])), vecs[[4, 3, 5]], rtol=1e-6)
+
+
+def test_checkpoint_folds_delta(start_service):
+    service = start_service()
+
+    def upsert(ids):
+        service.apply_upsert([service.UpsertItem(**zone(i)) for i in ids])
+
+    upsert(range(5))
+    upsert([1, 2])  # replaces index-free delta rows, nothing shadowed yet
+    service.checkpoint()
+    gen = service.generation
+    assert len(gen.delta) == 0 and gen.index.ntotal == 5
+
+    upsert([0, 7])  # 0 shadows its indexed vector
+    gen = service.generation
+    assert len(gen.delta) == 2 and len(gen.delta.shadowed) == 1 and gen.ntotal == 6
+    service.checkpoint()
+    gen = service.generation
+    assert len(gen.delta) == 0 and len(gen.delta.shadowed) == 0
+    assert gen.index.ntotal == 6
+    expected = service.encode_texts([zone(7)["text"]])
+    np.testing.assert_allclose(gen.vectors(np.array([service.label_for("zone:7")])), expected, rtol=1e-5)
@@ -0,0 +1,39 @@
+"""Posting lists of keyword_index.KeywordIndex"""
+
+import numpy as np
+
+from keyword_index import KeywordIndex
+
+NONE = np.zeros(0, dtype=np.int64)
+
+
+def labels(index, term):
+    post = index.posting(term)
+    return None if post is None else post.tolist()
+
+
+def test_postings_come_from_payload_vibes_and_configured_terms():
+    index = KeywordIndex(terms=["ồn ào"]).with_changes(NONE, [
+        (1, "Bãi biển yên tĩnh", ["Biển"]),
+        (2, "Phố cổ về đêm", ["đêm"]),
+        (3, "Chợ đêm ồn ào", []),
+    ])
+    # A vibe posting also picks up items whose text contains the term
+    assert labels(index, "đêm") == [2, 3]
+    assert labels(index, "biển") == [1]
+    assert labels(index, "ồn ào") == [3]
+    # Words only found in text (or only queried) get no posting
+    assert "yên tĩnh" not in index
+
+
+def test_new_vibe_scans_the_corpus_and_empty_postings_are_dropped():
+    corpus = [(1, "Bãi biển yên tĩnh", []), (2, "Phố cổ", ["cổ kính"])]
+    index = KeywordIndex(terms=["karaoke"]).with_changes(NONE, corpus)
+    corpus.append((3, "Đồi chè", ["yên tĩnh"]))
+    index = index.with_changes(NONE, corpus[-1:], corpus)
+    assert labels(index, "yên tĩnh") == [1, 3]
+
+    index = index.with_changes(np.array([2], dtype=np.int64), [])
+    assert "cổ kính" not in index
+    # Configured terms stay indexed even with nothing to match
+    assert labels(index, "karaoke") == []
@@ -0,0 +1,44 @@
+"""MetadataStore segments and the save / load round trip"""
+
+import mmap
+
+import numpy as np
+
+from metadata_store import BLOB_FILE, MetadataStore
+
+
+def record(i, text=None):
+    return {"id": f"zone:{i}", "label": 1000 - i, "type": "zone" if i % 2 else "poi",
+            "text": text or f"khu {i}", "payload": {"province": "Huế" if i % 3 else "Đà Nẵng"}}
+
+
+def test_changes_share_records_until_save(tmp_path):
+    store = MetadataStore.empty()
+    for i in range(40):
+        store = store.with_changes(np.zeros(0, dtype=np.int64), [record(i)])
+    # Replace every other record, delete two
+    store = store.with_changes(np.array([1000 - 3, 1000 - 5]), [record(i, f"mới {i}") for i in range(0, 40, 2)])
+    assert len(store.segments) == 41
+    expected = list(store.items())
+
+    store.save(tmp_path)
+    loaded = MetadataStore.load(tmp_path)
+    assert list(loaded.items()) == expected
+    assert len(loaded.segments) == 1 and isinstance(loaded.segments[0], mmap.mmap)
+    # Replaced and deleted records are not written
+    assert (tmp_path / BLOB_FILE).stat().st_size == int(loaded.lengths.sum())
+    assert loaded.counts() == store.counts()
+    np.testing.assert_array_equal(loaded.mask("zone", "Huế"), store.mask("zone", "Huế"))
+    assert loaded.get(1000 - 4)["text"] == "mới 4"
+    assert loaded.get(1000 - 3) is None
+
+
+def test_checkpoint_maps_metadata_back_from_disk(start_service):
+    service = start_service()
+    for i in range(5):
+        service.apply_upsert([service.UpsertItem(id=f"zone:{i}", type="zone", text=f"khu {i}")])
+    assert len(service.generation.metadata.segments) == 5
+    service.checkpoint()
+    metadata = service.generation.metadata
+    assert len(metadata.segments) == 1 and isinstance(metadata.segments[0], mmap.mmap)
+    assert sorted(m["id"] for m in metadata.items()) == [f"zone:{i}" for i in range(5)]
@@ -0,0 +1,38 @@
+"""In-memory query vector cache"""
+
+import time
+
+import numpy as np
+
+from embedding_cache import QueryCache
+
+
+class CountingEncoder:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, texts):
+        self.calls.append(list(texts))
+        return np.array([[len(t), 1.0] for t in texts], dtype=np.float32)
+
+
+def test_query_cache_encodes_misses_in_one_call():
+    encoder = CountingEncoder()
+    cache = QueryCache(max_entries=8, ttl_sec=60)
+    cache.encode("biển", encoder)
+    vecs = cache.encode_many(["biển", "núi", "phố cổ"], encoder)
+    assert encoder.calls == [["biển"], ["núi", "phố cổ"]]
+    assert vecs.shape == (3, 2)
+    assert cache.stats()["hits"] == 1
+
+
+def test_entries_expire_and_the_oldest_are_evicted(monkeypatch):
+    encoder = CountingEncoder()
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    cache = QueryCache(max_entries=2, ttl_sec=10)
+    for text in ("a", "b", "a", "c"):  # c evicts b, the least recently used
+        cache.encode(text, encoder)
+    assert cache.get("b") is None and cache.get("a") is not None
+    now[0] += 11
+    assert cache.get("a") is None
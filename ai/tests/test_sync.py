@@ -0,0 +1,30 @@
+"""/sync/manifest and /sync/apply"""
+
+import pytest
+from fastapi import HTTPException
+
+from conftest import zone
+
+
+def test_sync_apply_rejects_a_stale_base(start_service):
+    service = start_service()
+    manifest = service.sync_manifest()
+    base = manifest["generation"]
+    assert manifest["items"] == {}
+
+    applied = service.sync_apply(service.SyncApplyRequest(
+        base_generation=base, upsert=[service.UpsertItem(**zone(i)) for i in range(3)]))
+    assert applied["added"] == 3 and applied["generation"] == base + 1
+
+    # Another write moved the index past the client's manifest
+    with pytest.raises(HTTPException) as stale:
+        service.sync_apply(service.SyncApplyRequest(base_generation=base, delete=["zone:0"]))
+    assert stale.value.status_code == 409
+    assert len(service.generation.metadata) == 3
+
+    manifest = service.sync_manifest()
+    assert set(manifest["items"]) == {"zone:0", "zone:1", "zone:2"}
+    applied = service.sync_apply(service.SyncApplyRequest(
+        base_generation=manifest["generation"], delete=["zone:0"]))
+    assert applied["deleted"] == 1
+    assert set(service.sync_manifest()["items"]) == {"zone:1", "zone:2"}
@@ -0,0 +1,17 @@
+"""Modules ai-embed ships as copies of this directory's (its image is built from ai-embed/ alone)"""
+
+from pathlib import Path
+
+import pytest
+
+AI_DIR = Path(__file__).resolve().parent.parent
+EMBED_DIR = AI_DIR.parent / "ai-embed"
+
+VENDORED = ["metrics.py", "geo_index.py", "embedding_format.py", "bulk_embed.py", "index_factory.py"]
+
+
+@pytest.mark.parametrize("name", VENDORED)
+def test_ai_embed_copy_matches(name):
+    # Same code; only the line endings of the two directories differ
+    source = (AI_DIR / name).read_bytes().replace(b"\r\n", b"\n")
+    assert (EMBED_DIR / name).read_bytes() == source, f"ai-embed/{name} drifted from ai/{name}: copy it again"
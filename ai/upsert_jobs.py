@@ -0,0 +1,146 @@
+"""
+Upsert Jobs
+Background single-writer queue for index updates with pollable job status
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+
+class UpsertJob:
+    """One submitted /upsert batch"""
+
+    def __init__(self, items: List[Any]):
+        self.id = uuid.uuid4().hex
+        self.items = items
+        self.item_count = len(items)
+        self.status = "queued"  # queued -> running -> done | failed
+        self.stage: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.coalesced = 1
+        self.cancelled = 0  # Items dropped by a /delete accepted while queued
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.done = threading.Event()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "items": self.item_count,
+            "coalesced": self.coalesced,
+            "cancelled": self.cancelled,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class UpsertJobQueue:
+    """
+    Applies upsert jobs in submission order on one background thread.
+
+    Jobs that are already queued when the worker picks up work are merged
+    into a single apply call (later items win on duplicate ids). A delete
+    accepted after a submit must win over it: cancel() drops the ids from
+    queued jobs and reports which ones are in the batch being applied.
+    """
+
+    def __init__(self, apply_fn: Callable[[List[Any], Callable[[str], None]], Dict[str, Any]],
+                 max_history: int = 200):
+        self.apply_fn = apply_fn
+        self.max_history = max_history
+        # Held while the index is being written; other writers (e.g. /reset) take it too
+        self.writer_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._pending: "deque[UpsertJob]" = deque()
+        self._jobs: "OrderedDict[str, UpsertJob]" = OrderedDict()
+        # Ids of the batch the worker is applying
+        self._running: Set[str] = set()
+        self._worker = threading.Thread(target=self._run, name="upsert-worker", daemon=True)
+        self._worker.start()
+
+    def submit(self, items: List[Any]) -> UpsertJob:
+        job = UpsertJob(items)
+        with self._cond:
+            self._jobs[job.id] = job
+            self._pending.append(job)
+            self._trim()
+            self._cond.notify()
+        return job
+
+    def get(self, job_id: str) -> Optional[UpsertJob]:
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def cancel(self, ids: Iterable[str]) -> Tuple[Set[str], Set[str]]:
+        """Drop `ids` from queued jobs; returns (ids dropped, ids in the batch being applied)"""
+        ids = set(ids)
+        cancelled = set()
+        with self._cond:
+            for job in self._pending:
+                kept = [item for item in job.items if item.id not in ids]
+                if len(kept) < len(job.items):
+                    cancelled.update(item.id for item in job.items if item.id in ids)
+                    job.cancelled += len(job.items) - len(kept)
+                    job.items = kept
+            return cancelled, ids & self._running
+
+    def _trim(self):
+        # Forget the oldest finished jobs beyond max_history
+        finished = [j for j in self._jobs.values() if j.done.is_set()]
+        for job in finished[:max(0, len(finished) - self.max_history)]:
+            del self._jobs[job.id]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                group = list(self._pending)
+                self._pending.clear()
+                merged: Dict[str, Any] = {}
+                for job in group:
+                    job.status = "running"
+                    job.started_at = time.time()
+                    job.coalesced = len(group)
+                    for item in job.items:
+                        merged[item.id] = item
+                self._running = set(merged)
+
+            def progress(stage: str):
+                for job in group:
+                    job.stage = stage
+
+            if not merged:
+                # Every item was cancelled by a /delete while queued: nothing to write
+                result, status, error = {"cancelled": True}, "done", None
+            else:
+                try:
+                    with self.writer_lock:
+                        result = self.apply_fn(list(merged.values()), progress)
+                    status, error = "done", None
+                except Exception as e:
+                    result, status, error = None, "failed", str(e)
+            with self._cond:
+                self._running = set()
+
+            for job in group:
+                job.result = result
+                job.error = error
+                job.status = status
+                job.finished_at = time.time()
+                job.items = []  # Release the payload, keep only the status
+                job.done.set()
@@ -0,0 +1,235 @@
+"""
+Write-Ahead Log
+Append-only log of index writes, plus the staged-directory protocol used
+for the full checkpoints it is replayed on top of.
+
+Every write (upsert batch, delete, reset) is appended as one record
+
+  <crc32 hex> {"seq": 42, "op": "upsert", "items": [...], "deleted": [...]}\\n
+
+and fsynced before the new generation is published, so a request costs
+one small sequential write instead of a rewrite of the whole index. Records
+live in segments named after their first sequence number; a checkpoint
+rotates to a new segment, writes the snapshot, then drops the segments it
+covers. A torn record (crash mid-append) ends the log: it is cut off when
+the log is opened.
+
+Checkpoints are written to a staging directory, fsynced, and sealed by a
+marker file; only then are the files renamed into place. A crash before
+the marker leaves the previous checkpoint untouched (the staging
+directory is discarded), a crash after it is finished by commit_staged on
+the next start.
+
+  wal = WriteAheadLog(Path("index/wal"))
+  seq = wal.append({"op": "delete", "ids": ["zone:1"]})
+  for record in wal.records(after=checkpoint_seq):
+      ...
+"""
+
+import json
+import os
+import shutil
+import threading
+import zlib
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+SEGMENT_SUFFIX = ".log"
+
+
+def fsync_path(path: Path):
+    """fsync a file or directory (directories make renames / new files durable)"""
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _encode(record: Dict[str, Any]) -> bytes:
+    body = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return b"%08x " % zlib.crc32(body) + body + b"\n"
+
+
+def _decode(line: bytes) -> Optional[Dict[str, Any]]:
+    """Record of a complete line, None when torn or corrupt"""
+    if not line.endswith(b"\n") or len(line) < 10 or line[8:9] != b" ":
+        return None
+    body = line[9:-1]
+    try:
+        if int(line[:8], 16) != zlib.crc32(body):
+            return None
+        return json.loads(body)
+    except ValueError:
+        return None
+
+
+class WriteAheadLog:
+    """Segmented, checksummed append-only record log (thread-safe)"""
+
+    def __init__(self, directory: Path, fsync: bool = True):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._file = None
+        self.seq = 0
+        self.appends = 0
+        # Bytes appended since the last truncate (checkpoint size policy)
+        self.pending_bytes = 0
+        self._open()
+
+    def _segments(self) -> List[Tuple[int, Path]]:
+        """(first seq, path) of every segment, oldest first"""
+        found = []
+        for path in self.directory.glob("*" + SEGMENT_SUFFIX):
+            try:
+                found.append((int(path.stem), path))
+            except ValueError:
+                continue
+        return sorted(found)
+
+    def _scan(self, path: Path) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """(end offset, record) of the valid prefix of a segment"""
+        offset = 0
+        with open(path, "rb") as f:
+            for line in f:
+                record = _decode(line)
+                if record is None:
+                    return
+                offset += len(line)
+                yield offset, record
+
+    def _open(self):
+        """Find the last sequence number, cutting a torn tail off the last segment"""
+        segments = self._segments()
+        for _, path in segments:
+            self.pending_bytes += path.stat().st_size
+        if not segments:
+            return
+        _, last = segments[-1]
+        valid = 0
+        for valid, record in self._scan(last):
+            self.seq = record["seq"]
+        if valid < last.stat().st_size:
+            self.pending_bytes -= last.stat().st_size - valid
+            with open(last, "r+b") as f:
+                f.truncate(valid)
+        if not self.seq:
+            # Last segment empty: sequence continues from its name
+            self.seq = segments[-1][0] - 1
+        self._file = open(last, "ab")
+
+    def advance(self, seq: int):
+        """Never hand out numbers at or below `seq` (e.g. a checkpoint's, when the log was lost)"""
+        with self._lock:
+            if seq > self.seq:
+                self.seq = seq
+                self._close()
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def append(self, record: Dict[str, Any]) -> int:
+        """Write one record durably; returns its sequence number"""
+        with self._lock:
+            seq = self.seq + 1
+            data = _encode({"seq": seq, **record})
+            if self._file is None:
+                self._file = open(self.directory / f"{seq:012d}{SEGMENT_SUFFIX}", "ab")
+            self._file.write(data)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self.seq = seq
+            self.appends += 1
+            self.pending_bytes += len(data)
+            return seq
+
+    def rotate(self) -> int:
+        """Start a new segment with the next append; returns the last sequence number"""
+        with self._lock:
+            self._close()
+            return self.seq
+
+    def records(self, after: int = 0) -> Iterator[Dict[str, Any]]:
+        """Records with seq > after, in order, up to the first torn one"""
+        segments = self._segments()
+        for i, (first, path) in enumerate(segments):
+            if i + 1 < len(segments) and segments[i + 1][0] <= after + 1:
+                continue
+            for _, record in self._scan(path):
+                if record["seq"] > after:
+                    yield record
+
+    def truncate(self, upto: int):
+        """
+        Delete segments holding only records <= upto. `upto` must be the
+        rotate() taken together with the checkpointed snapshot (no write
+        published in between), and the saved files must already hold every
+        record up to it: anything truncated is gone for good.
+        """
+        with self._lock:
+            segments = self._segments()
+            for i, (first, path) in enumerate(segments):
+                if i + 1 < len(segments) and segments[i + 1][0] <= upto + 1:
+                    path.unlink()
+                elif i + 1 == len(segments) and self._file is None and self.seq <= upto:
+                    path.unlink()
+            self.pending_bytes = sum(path.stat().st_size for _, path in self._segments())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "seq": self.seq,
+            "segments": len(self._segments()),
+            "pending_bytes": self.pending_bytes,
+            "appends": self.appends,
+            "fsync": self.fsync,
+        }
+
+
+def commit_staged(staging: Path, target: Path, marker: str) -> bool:
+    """
+    Move the files of a sealed staging directory (one containing `marker`)
+    into `target`, marker last, and remove it. An unsealed staging directory
+    is an interrupted checkpoint and is discarded. Safe to re-run after a
+    crash part way through. Returns whether a checkpoint was committed.
+    """
+    staging, target = Path(staging), Path(target)
+    if not staging.exists():
+        return False
+    if not (staging / marker).exists():
+        shutil.rmtree(staging, ignore_errors=True)
+        return False
+    for path in staging.iterdir():
+        if path.name != marker:
+            os.replace(path, target / path.name)
+    os.replace(staging / marker, target / marker)
+    fsync_path(target)
+    staging.rmdir()
+    return True
+
+
+def seal_staged(staging: Path, marker: str, info: Dict[str, Any]):
+    """fsync every staged file, then write the marker that makes the checkpoint committable"""
+    staging = Path(staging)
+    for path in staging.iterdir():
+        fsync_path(path)
+    tmp = staging / (marker + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(info, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, staging / marker)
+    fsync_path(staging)
+
+
+def read_marker(directory: Path, marker: str) -> Dict[str, Any]:
+    """Info of the committed checkpoint ({} for an index saved before checkpoints)"""
+    path = Path(directory) / marker
+    if not path.exists():
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
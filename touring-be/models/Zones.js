@@ -87,6 +87,7 @@ const zoneSchema = new mongoose.Schema(
     // Allows FAISS index to be rebuilt without calling HuggingFace API on restart
     embedding: { type: [Number], default: undefined, select: false },
     embeddingText: { type: String, default: undefined, select: false }, // hash of text used for cache invalidation
+    embeddingModel: { type: String, default: undefined, select: false }, // model that produced `embedding`
   },
   {
     timestamps: true,
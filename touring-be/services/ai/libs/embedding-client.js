@@ -19,10 +19,55 @@ async function fetchWithTimeout(url, options = {}, timeout = 10000) {
   }
 }
 
-async function embed(texts) {
+/**
+ * Float16 (IEEE half) bit patterns → Float32Array
+ */
+function halfToFloat32(halves) {
+  const out = new Float32Array(halves.length);
+  for (let i = 0; i < halves.length; i++) {
+    const h = halves[i];
+    const sign = h & 0x8000 ? -1 : 1;
+    const exp = (h >> 10) & 0x1f;
+    const frac = h & 0x3ff;
+    if (exp === 0) out[i] = sign * frac * 2 ** -24;
+    else if (exp === 0x1f) out[i] = frac ? NaN : sign * Infinity;
+    else out[i] = sign * (1 + frac / 1024) * 2 ** (exp - 15);
+  }
+  return out;
+}
+
+/**
+ * Little-endian float32/float16 rows → one Float32Array per vector
+ */
+function decodeRows(buffer, shape, dtype) {
+  const [n, dim] = shape;
+  const bytes = new Uint8Array(buffer);
+  // Copy so the typed array starts on an aligned offset
+  const aligned = bytes.byteOffset % 4 === 0 ? bytes : bytes.slice();
+  const flat = dtype === 'float16'
+    ? halfToFloat32(new Uint16Array(aligned.buffer, aligned.byteOffset, n * dim))
+    : new Float32Array(aligned.buffer, aligned.byteOffset, n * dim);
+  return Array.from({ length: n }, (_, i) => flat.subarray(i * dim, (i + 1) * dim));
+}
+
+/**
+ * Embed texts.
+ * format 'json' (default) returns the service JSON as is; 'binary'
+ * (application/octet-stream) and 'base64' return
+ * { vectors: Float32Array[], shape: [n, dim], dtype }, with dtype
+ * 'float32' or 'float16' (half the bytes on the wire).
+ */
+async function embed(texts, { format = 'json', dtype = 'float32' } = {}) {
+  const accept = {
+    json: 'application/json',
+    binary: `application/octet-stream; dtype=${dtype}`,
+    base64: `application/vnd.embeddings+json; dtype=${dtype}`
+  }[format];
+  if (!accept) throw new Error(`Unknown embed format: ${format}`);
+  
   const res = await fetchWithTimeout(`${EMBED_URL}/embed`, {
     method: 'POST',
-    headers: { 'Content-Type': 'application/json' },
+    headers: { 'Content-Type': 'application/json', Accept: accept },
     body: JSON.stringify({ texts })
   }, 20000); // Increased timeout: 10s → 20s for long text
   
@@ -31,7 +76,65 @@ async function embed(texts) {
     throw new Error(`Embed error: ${res.status} ${text}`);
   }
   
-  return res.json();
+  if (format === 'binary') {
+    const shape = (res.headers.get('x-embedding-shape') || '0,0').split(',').map(Number);
+    const rowType = res.headers.get('x-embedding-dtype') || dtype;
+    return { vectors: decodeRows(await res.arrayBuffer(), shape, rowType), shape, dtype: rowType };
+  }
+  
+  const result = await res.json();
+  if (format === 'base64') {
+    // ai-embed packs "vectors", the ai service "embeddings"
+    const packed = result.vectors_b64 ?? result.embeddings_b64;
+    return { vectors: decodeRows(Buffer.from(packed, 'base64'), result.shape, result.dtype), shape: result.shape, dtype: result.dtype };
+  }
+  return result;
+}
+
+/**
+ * Bulk embed through /embed/stream, with no per-request size limit.
+ * `records` is any (async) iterable of { id, text }; it is uploaded as
+ * NDJSON while results stream back, and only as fast as they are read.
+ * Yields { id, embedding } (or { id | line, error }) in batch order, not
+ * input order; throws if the stream ends without its summary line.
+ */
+async function* embedStream(records, { signal } = {}) {
+  async function* ndjson() {
+    for await (const record of records) {
+      yield Buffer.from(JSON.stringify(record) + '\n');
+    }
+  }
+  
+  const res = await fetch(`${EMBED_URL}/embed/stream`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/x-ndjson', Accept: 'application/x-ndjson' },
+    body: ndjson(),
+    duplex: 'half',
+    signal
+  });
+  
+  if (!res.ok) {
+    const text = await res.text();
+    throw new Error(`Embed stream error: ${res.status} ${text}`);
+  }
+  
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let summary = null;
+  for await (const chunk of res.body) {
+    buffer += decoder.decode(chunk, { stream: true });
+    const lines = buffer.split('\n');
+    buffer = lines.pop();
+    for (const line of lines) {
+      if (!line.trim()) continue;
+      const result = JSON.parse(line);
+      if (result.done) summary = result;
+      else yield result;
+    }
+  }
+  
+  if (!summary) throw new Error('Embed stream ended early');
+  console.log(`✅ [EmbedClient] embedStream: ${summary.count} embedded, ${summary.errors} errors`);
 }
 
 /**
@@ -49,9 +152,98 @@ async function upsert(items) {
     throw new Error(`Upsert error: ${res.status} ${text}`);
   }
   
+  const result = await res.json();
+  
+  // Services that apply upserts in the background answer with a job id
+  if (result.job_id && (result.status === 'queued' || result.status === 'running')) {
+    return waitForJob(result.job_id);
+  }
+  
+  return result;
+}
+
+/**
+ * Current index state for delta sync: { model, generation, count, items: { id: hash } }
+ */
+async function syncManifest() {
+  const res = await fetchWithTimeout(`${EMBED_URL}/sync/manifest`, {}, 30000);
+  
+  if (!res.ok) {
+    const text = await res.text();
+    const error = new Error(`Sync manifest error: ${res.status} ${text}`);
+    error.status = res.status;
+    throw error;
+  }
+  
+  return res.json();
+}
+
+/**
+ * Apply only changed items: { base_generation, upsert: [items], delete: [ids] }.
+ * A stale base (another write landed since the manifest) throws with status 409.
+ */
+async function syncApply({ base_generation, upsert = [], delete: remove = [] }) {
+  const res = await fetchWithTimeout(`${EMBED_URL}/sync/apply`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ base_generation, upsert, delete: remove })
+  }, 60000);
+  
+  if (!res.ok) {
+    const text = await res.text();
+    const error = new Error(`Sync apply error: ${res.status} ${text}`);
+    error.status = res.status;
+    throw error;
+  }
+  
+  return res.json();
+}
+
+/**
+ * Delete items by id. They are tombstoned (gone from searches right away) and
+ * compacted out of the index in the background; unknown ids are ignored.
+ * Returns { deleted, tombstones, total, generation }
+ */
+async function deleteItems(ids) {
+  const res = await fetchWithTimeout(`${EMBED_URL}/delete`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ ids })
+  }, 30000);
+  
+  if (!res.ok) {
+    const text = await res.text();
+    const error = new Error(`Delete error: ${res.status} ${text}`);
+    error.status = res.status;
+    throw error;
+  }
+  
   return res.json();
 }
 
+/**
+ * Poll /jobs/:id until a background upsert finishes
+ */
+async function waitForJob(jobId, { interval = 1000, timeout = 600000 } = {}) {
+  const deadline = Date.now() + timeout;
+  
+  while (Date.now() < deadline) {
+    const res = await fetchWithTimeout(`${EMBED_URL}/jobs/${jobId}`, {}, 10000);
+    if (!res.ok) {
+      const text = await res.text();
+      throw new Error(`Job status error: ${res.status} ${text}`);
+    }
+    
+    const job = await res.json();
+    if (job.status === 'done') return { ...job.result, job_id: jobId };
+    if (job.status === 'failed') throw new Error(`Upsert job ${jobId} failed: ${job.error}`);
+    
+    await new Promise(resolve => setTimeout(resolve, interval));
+  }
+  
+  throw new Error(`Upsert job ${jobId} did not finish within ${timeout}ms`);
+}
+
 /**
  * Basic semantic search
  */
@@ -158,6 +350,51 @@ async function hybridSearch(options = {}) {
   }
 }
 
+/**
+ * Many searches in one request (one encode pass + one FAISS call per filter).
+ * `queries` are /search bodies; results come back in the same order.
+ */
+async function searchBatch(queries) {
+  const res = await fetchWithTimeout(`${EMBED_URL}/search/batch`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ queries })
+  }, 20000);
+  
+  if (!res.ok) {
+    const text = await res.text();
+    throw new Error(`Batch search error: ${res.status} ${text}`);
+  }
+  
+  return (await res.json()).results;
+}
+
+/**
+ * Batched /hybrid-search; `queries` are hybridSearch option objects
+ */
+async function hybridSearchBatch(queries) {
+  const res = await fetchWithTimeout(`${EMBED_URL}/hybrid-search/batch`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({
+      queries: queries.map(({ vibes = [], avoid = [], top_k = 10, boost_vibes = 1.2, ...rest }) => ({
+        ...rest,
+        vibes,
+        ...(avoid && avoid.length > 0 && { avoid }),
+        top_k,
+        boost_vibes
+      }))
+    })
+  }, 20000);
+  
+  if (!res.ok) {
+    const text = await res.text();
+    throw new Error(`Batch hybrid search error: ${res.status} ${text}`);
+  }
+  
+  return (await res.json()).results;
+}
+
 async function health() {
   try {
     const res = await fetchWithTimeout(`${EMBED_URL}/healthz`, {}, 3000);
@@ -222,9 +459,16 @@ async function isAvailable() {
 }
 module.exports = {
   embed,
+  embedStream,
   upsert,
+  syncManifest,
+  syncApply,
+  deleteItems,
+  waitForJob,
   search,
   hybridSearch,
+  searchBatch,
+  hybridSearchBatch,
   health,
   isAvailable
 };
\ No newline at end of file
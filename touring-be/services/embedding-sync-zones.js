@@ -1,3 +1,4 @@
+const crypto = require('crypto');
 const mongoose = require('mongoose');
 const path = require('path');
 require('dotenv').config({
@@ -5,10 +6,21 @@ require('dotenv').config({
 });
 
 const Zone = require('../models/Zones');
-const { embed, upsert: upsertToFAISS } = require('./ai/libs/embedding-client');
+const {
+  embed,
+  upsert: upsertToFAISS,
+  syncManifest,
+  syncApply,
+} = require('./ai/libs/embedding-client');
 
 const EMBED_URL = process.env.AI_EMBED_URL || 'https://ai-embed.travyytouring.page';
 
+// Another write between /sync/manifest and /sync/apply → recompute the delta
+const MAX_STALE_RETRIES = 3;
+
+// ai-embed /embed accepts at most 100 texts per request
+const EMBED_CHUNK = 100;
+
 /**
  * Build rich semantic text for embedding.
  * Matches what was used to compute any cached vector.
@@ -29,6 +41,185 @@ function buildSemanticText(zone) {
   return full.length > 1000 ? full.substring(0, 1000) + '...' : full;
 }
 
+/**
+ * Index item for a zone (without vector). `hash` covers everything the
+ * service indexes, so an unchanged zone is skipped by the delta sync.
+ */
+function buildItem(zone) {
+  const item = {
+    id: zone.id,
+    type: 'zone',
+    text: zone._semanticText,
+    payload: {
+      name: zone.name,
+      province: zone.province,
+      tags: zone.tags || [],
+      vibes: zone.vibeKeywords || [],
+      rating: zone.rating || 0,
+      bestTime: zone.bestTime || 'anytime',
+      center: zone.center ? { lat: zone.center.lat, lng: zone.center.lng } : null,
+      radiusM: zone.radiusM || null,
+      poly: zone.poly || null,
+    },
+  };
+  item.hash = crypto
+    .createHash('sha1')
+    .update(JSON.stringify([item.type, item.text, item.payload]))
+    .digest('hex');
+  return item;
+}
+
+/**
+ * Record `model` on zones whose cached vector predates embeddingModel
+ * tracking but still matches their text, so a first sync with a known
+ * model does not re-embed (and resend) the whole corpus. Returns the
+ * zones that were updated.
+ */
+async function backfillModel(zones, model) {
+  const untracked = zones.filter(
+    zone =>
+      zone.embedding?.length > 0 &&
+      zone.embeddingText === zone._semanticText &&
+      zone.embeddingModel == null
+  );
+  if (untracked.length === 0) return untracked;
+
+  await Zone.bulkWrite(
+    untracked.map(zone => ({
+      updateOne: { filter: { _id: zone._id }, update: { $set: { embeddingModel: model } } },
+    }))
+  );
+  untracked.forEach(zone => {
+    zone.embeddingModel = model;
+  });
+  console.log(`🏷️  Recorded model ${model} on ${untracked.length} cached vectors`);
+  return untracked;
+}
+
+/**
+ * Set zone.embedding for the given zones: cached vector when its text (and,
+ * when known, the service's `model`) is unchanged, else /embed calls
+ * (HF API) of up to EMBED_CHUNK texts whose results are cached in MongoDB.
+ */
+async function attachVectors(zones, model) {
+  // --- Partition: use cached vector vs call HF API ---
+  const needEmbed = zones.filter(
+    zone =>
+      !(
+        zone.embedding?.length > 0 &&
+        zone.embeddingText === zone._semanticText &&
+        (model === undefined || zone.embeddingModel === model)
+      )
+  );
+
+  console.log(`   💾 Cached vectors: ${zones.length - needEmbed.length}`);
+  console.log(`   🌐 Need HF embed: ${needEmbed.length}`);
+
+  // --- Call HF API only for zones without a valid cache ---
+  if (needEmbed.length === 0) return;
+
+  const texts = needEmbed.map(z => z._semanticText);
+  console.log(`📡 Calling HF Inference API for ${texts.length} zones...`);
+
+  // embed() calls ai-embed /embed → HF API
+  const vectors = [];
+  for (let start = 0; start < texts.length; start += EMBED_CHUNK) {
+    const chunk = texts.slice(start, start + EMBED_CHUNK);
+    const embedResult = await embed(chunk);
+    if (!embedResult.vectors || embedResult.vectors.length !== chunk.length) {
+      throw new Error(`Embed returned ${embedResult.vectors?.length} vectors for ${chunk.length} texts`);
+    }
+    vectors.push(...embedResult.vectors);
+  }
+
+  // Store new vectors in MongoDB (select:false fields need explicit $set)
+  const bulkOps = needEmbed.map((zone, i) => ({
+    updateOne: {
+      filter: { _id: zone._id },
+      update: {
+        $set: {
+          embedding: vectors[i],
+          embeddingText: zone._semanticText,
+          ...(model !== undefined && { embeddingModel: model }),
+        },
+      },
+    },
+  }));
+  await Zone.bulkWrite(bulkOps);
+  console.log(`✅ Stored ${needEmbed.length} new vectors in MongoDB`);
+
+  // Update in-memory so items below use them
+  needEmbed.forEach((zone, i) => {
+    zone.embedding = vectors[i];
+    zone.embeddingText = zone._semanticText;
+    if (model !== undefined) zone.embeddingModel = model;
+  });
+}
+
+/**
+ * Send only added / changed / removed zones, diffed against /sync/manifest.
+ * Zones whose vector came from another model than the manifest's are sent
+ * again (re-embedded) even when their hash matches, so a model switch is a
+ * full resync. Returns null when the service has no sync endpoints (full
+ * upsert instead).
+ */
+async function syncDelta(zones) {
+  const items = new Map(zones.map(zone => [zone.id, buildItem(zone)]));
+  const byId = new Map(zones.map(zone => [zone.id, zone]));
+  // Model of each zone's vector before this sync (attachVectors updates it)
+  const embeddedWith = new Map(zones.map(zone => [zone.id, zone.embeddingModel]));
+
+  for (let attempt = 1; attempt <= MAX_STALE_RETRIES; attempt++) {
+    let manifest;
+    try {
+      manifest = await syncManifest();
+    } catch (error) {
+      if (error.status === 404) return null;
+      throw error;
+    }
+
+    // Vectors cached before the model was recorded count as this model's
+    for (const zone of await backfillModel(zones, manifest.model)) {
+      embeddedWith.set(zone.id, manifest.model);
+    }
+
+    const staleModel = zones.filter(zone => embeddedWith.get(zone.id) !== manifest.model).length;
+    if (staleModel > 0) {
+      console.log(`🔁 ${staleModel} zones have vectors from another model than ${manifest.model}: re-embedding them`);
+    }
+    const changed = [...items.values()].filter(
+      item => manifest.items[item.id] !== item.hash || embeddedWith.get(item.id) !== manifest.model
+    );
+    const deleted = Object.keys(manifest.items).filter(id => !items.has(id));
+    console.log(
+      `🧮 Delta vs generation ${manifest.generation} (${manifest.model}): ` +
+        `${changed.length} changed, ${deleted.length} deleted, ` +
+        `${items.size - changed.length} unchanged`
+    );
+
+    if (changed.length === 0 && deleted.length === 0) {
+      return { upToDate: true, generation: manifest.generation, total: manifest.count };
+    }
+
+    const changedZones = changed.map(item => byId.get(item.id));
+    await attachVectors(changedZones, manifest.model);
+    changed.forEach(item => {
+      item.vector = byId.get(item.id).embedding; // ai-embed uses this directly
+    });
+
+    try {
+      return await syncApply({
+        base_generation: manifest.generation,
+        upsert: changed,
+        delete: deleted,
+      });
+    } catch (error) {
+      if (error.status !== 409 || attempt === MAX_STALE_RETRIES) throw error;
+      console.log(`↻ Index moved past generation ${manifest.generation}, recomputing delta...`);
+    }
+  }
+}
+
 async function syncZones(isAutomatic = false) {
   try {
     console.log('🔄 Syncing zones to embedding service...\n');
@@ -42,7 +233,7 @@ async function syncZones(isAutomatic = false) {
 
     // Load zones INCLUDING cached embedding (normally excluded via select:false)
     const zones = await Zone.find({ isActive: true })
-      .select('+embedding +embeddingText')
+      .select('+embedding +embeddingText +embeddingModel')
       .lean();
     console.log(`📦 Found ${zones.length} active zones`);
 
@@ -52,79 +243,25 @@ async function syncZones(isAutomatic = false) {
       return;
     }
 
-    // --- Partition: use cached vector vs call HF API ---
-    const needEmbed = [];
-    const hasCached = [];
-
     for (const zone of zones) {
-      const text = buildSemanticText(zone);
-      zone._semanticText = text;
-      if (zone.embedding?.length > 0 && zone.embeddingText === text) {
-        hasCached.push(zone);
-      } else {
-        needEmbed.push(zone);
-      }
+      zone._semanticText = buildSemanticText(zone);
     }
 
-    console.log(`   💾 Cached vectors: ${hasCached.length}`);
-    console.log(`   🌐 Need HF embed: ${needEmbed.length}`);
-
-    // --- Call HF API only for zones without a valid cache ---
-    if (needEmbed.length > 0) {
-      const texts = needEmbed.map(z => z._semanticText);
-      console.log(`📡 Calling HF Inference API for ${texts.length} zones...`);
-
-      // embed() calls ai-embed /embed → HF API
-      const embedResult = await embed(texts);
-      const vectors = embedResult.vectors;
-
-      if (!vectors || vectors.length !== texts.length) {
-        throw new Error(`Embed returned ${vectors?.length} vectors for ${texts.length} texts`);
-      }
-
-      // Store new vectors in MongoDB (select:false fields need explicit $set)
-      const bulkOps = needEmbed.map((zone, i) => ({
-        updateOne: {
-          filter: { _id: zone._id },
-          update: {
-            $set: {
-              embedding: vectors[i],
-              embeddingText: zone._semanticText,
-            },
-          },
-        },
-      }));
-      await Zone.bulkWrite(bulkOps);
-      console.log(`✅ Stored ${needEmbed.length} new vectors in MongoDB`);
+    // --- Delta sync: only zones whose content hash differs from the index ---
+    const deltaResult = await syncDelta(zones);
+    if (deltaResult) {
+      console.log('✅ Delta sync complete:', deltaResult);
+    } else {
+      // Older service without /sync endpoints: push everything
+      console.log('ℹ️  /sync/manifest not available, falling back to full upsert');
+      await attachVectors(zones);
+      const items = zones.map(zone => ({ ...buildItem(zone), vector: zone.embedding }));
 
-      // Update in-memory so items array below uses them
-      needEmbed.forEach((zone, i) => {
-        zone.embedding = vectors[i];
-      });
+      console.log(`\n📤 Upserting ${items.length} items to FAISS (all pre-computed)...`);
+      const upsertResult = await upsertToFAISS(items);
+      console.log('✅ Upsert complete:', upsertResult);
     }
 
-    // --- Build upsert items with pre-computed vectors ---
-    const allZones = [...hasCached, ...needEmbed];
-    const items = allZones.map(zone => ({
-      id: zone.id,
-      type: 'zone',
-      text: zone._semanticText,
-      vector: zone.embedding,  // ai-embed uses this directly, no HF API call
-      payload: {
-        name: zone.name,
-        province: zone.province,
-        tags: zone.tags || [],
-        vibes: zone.vibeKeywords || [],
-        rating: zone.rating || 0,
-        bestTime: zone.bestTime || 'anytime',
-        center: zone.center ? { lat: zone.center.lat, lng: zone.center.lng } : null,
-      },
-    }));
-
-    console.log(`\n📤 Upserting ${items.length} items to FAISS (all pre-computed)...`);
-    const upsertResult = await upsertToFAISS(items);
-    console.log('✅ Upsert complete:', upsertResult);
-
     // Verify index
     const healthRes = await fetch(`${EMBED_URL}/healthz`);
     const healthData = await healthRes.json();
@@ -44,7 +44,8 @@ async function getMatchingZones(prefs, options = {}) {
           vibes: prefs.vibes,
           top_k: 20,
           filter_type: 'zone',
-          boost_vibes: 1.3
+          boost_vibes: 1.3,
+          lexical: false  // embedScore below reads hit.score as a cosine; with BM25 it is an RRF value
         });
         
         console.log(`📦 [Matcher] Embedding result: ${embedResult.hits?.length || 0} hits (${embedResult.strategy})`);